@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+# the catalog database has to be redirected before any module from src/ is imported, so the benchmarks never touch assets/all_music.sqlite
+WORK_DIR = tempfile.mkdtemp(prefix="vdj-spotify-link-bench-")
+os.environ["music_database"] = os.path.join(WORK_DIR, "all_music.sqlite")
+
+import synthetic  # noqa: E402
+
+# times the hot paths of the project against synthetic data, fully offline:
+#   helper_index_log     sldl_helper's index upserts and log appends for every track of a run
+#   index_fixer          swapping _index.sldl with the helper's, against a history directory
+#   library_scan         a cold scan of a tagged library and a warm rescan through the library cache
+#   vdjfolder_export     create_vdjfolder_from_playlist against fake_spotify_server.py, uncached and cached
+#   end_to_end           main.py with the stub sldl, yt-dlp and ffmpeg from bench/stubs, one on-complete process per track like the real thing
+#
+#   python bench/run_benchmarks.py --sizes 1000,10000 --output results.json
+#   python bench/run_benchmarks.py --compare results.json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, "stubs")
+
+DEFAULT_SIZES = [1000, 10000]
+# end_to_end starts a process per track, so it runs at its own (smaller) size
+DEFAULT_END_TO_END_SIZE = 200
+HISTORY_COUNT = 20
+# a benchmark that got this much slower than in the compared results is reported as a regression
+REGRESSION_THRESHOLD = 0.2
+
+def scratch_dir(name: str) -> str:
+    path = os.path.join(WORK_DIR, name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+def result(name: str, size: int, seconds: float) -> dict:
+    return {"name": name, "size": size, "seconds": round(seconds, 4), "rate": round(size / seconds, 1) if seconds else None}
+
+def bench_helper_index_log(size: int) -> list:
+    import sldl_helper
+
+    output_path = scratch_dir(f"helper-{size}")
+    rows = synthetic.index_rows(size)
+    context = sldl_helper.get_context(output_path)
+
+    started_at = time.perf_counter()
+    for row in rows:
+        sldl_helper.create_sldl_index_entry(context, *row)
+        sldl_helper.append_log_contents(context, synthetic.log_block(*row))
+    seconds = time.perf_counter() - started_at
+
+    sldl_helper.close_contexts()
+    return [result("helper_index_log", size, seconds)]
+
+def bench_index_fixer(size: int) -> list:
+    import index_fixer
+
+    output_path = scratch_dir(f"index-fixer-{size}")
+    synthetic.make_output_dir(output_path, synthetic.index_rows(size), HISTORY_COUNT)
+
+    argv = sys.argv
+    sys.argv = ["index_fixer.py", output_path]
+    try:
+        started_at = time.perf_counter()
+        index_fixer.main()
+        seconds = time.perf_counter() - started_at
+    finally:
+        sys.argv = argv
+    return [result("index_fixer", size, seconds)]
+
+def bench_library_scan(size: int) -> list:
+    import spotify
+
+    library_dir = scratch_dir(f"library-{size}")
+    synthetic.make_library(library_dir, size, 1, size)
+
+    started_at = time.perf_counter()
+    spotify.process_music_dir([library_dir])
+    cold_seconds = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    spotify.process_music_dir([library_dir])
+    warm_seconds = time.perf_counter() - started_at
+    return [result("library_scan_cold", size, cold_seconds), result("library_scan_warm", size, warm_seconds)]
+
+def bench_vdjfolder_export(size: int) -> list:
+    import spotify
+    from fake_spotify_server import FakeSpotifyServer
+    from spotify_cache import SpotifyCache
+    from track_matcher import TrackMatcher
+
+    export_dir = scratch_dir(f"vdjfolder-{size}")
+    library_dir = scratch_dir(f"vdjfolder-library-{size}")
+    synthetic.make_library(library_dir, size, 1, size)
+    matcher = TrackMatcher(spotify.load_library_tracks([library_dir]))
+
+    results = []
+    with FakeSpotifyServer(playlists=1, tracks_per_playlist=size) as server:
+        # every size gets a new server, so the client has to connect to it again and the cache can't hold the playlist of the previous size
+        spotify.SPOTIFY_API_URL = server.url
+        spotify._spotipy_client = None
+        spotify._spotify_cache = SpotifyCache(os.path.join(export_dir, "spotify_cache.sqlite"))
+        try:
+            # the first export pages the playlist from the server, the second one reads it from the cache
+            for name in ("vdjfolder_export", "vdjfolder_export_cached"):
+                started_at = time.perf_counter()
+                spotify.create_vdjfolder_from_playlist("playlist0", os.path.join(export_dir, f"{name}.vdjfolder"), matcher, None)
+                results.append(result(name, size, time.perf_counter() - started_at))
+        finally:
+            spotify._spotify_cache.close()
+            spotify._spotify_cache = None
+    return results
+
+# writes an sldl.conf from the template whose on-complete line runs src/sldl_helper_client.py
+def write_sldl_conf(conf_filepath: str) -> None:
+    with open(os.path.join(ROOT_DIR, "assets", "sldl_TEMPLATE_.conf"), "r", encoding="utf-8") as template_file:
+        lines = template_file.readlines()
+
+    client_path = os.path.join(ROOT_DIR, "src", "sldl_helper_client.py")
+    with open(conf_filepath, "w", encoding="utf-8") as conf_file:
+        for line in lines:
+            if line.startswith("on-complete"):
+                line = line.replace(line.split('"')[1], client_path)
+            conf_file.write(line)
+
+def bench_end_to_end(size: int) -> list:
+    run_dir = scratch_dir(f"end-to-end-{size}")
+    output_path = os.path.join(run_dir, "output")
+    conf_filepath = os.path.join(run_dir, "sldl.conf")
+    recording_filepath = os.path.join(run_dir, "recording.jsonl")
+    write_sldl_conf(conf_filepath)
+    synthetic.write_sldl_recording(recording_filepath, size)
+
+    env = {
+        **os.environ,
+        "ytdlp_path": os.path.join(STUBS_DIR, "ytdlp_stub.py"),
+        "ffmpeg_path": os.path.join(STUBS_DIR, "ffmpeg_stub.py"),
+        "SLDL_STUB_RECORDING": recording_filepath,
+    }
+    command = [
+        sys.executable, os.path.join(ROOT_DIR, "src", "main.py"),
+        "https://open.spotify.com/playlist/synthetic", output_path,
+        "--sldl-path", os.path.join(STUBS_DIR, "sldl_stub.py"),
+        "--sldl-conf", conf_filepath,
+    ]
+
+    started_at = time.perf_counter()
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+    return [result("end_to_end", size, time.perf_counter() - started_at)]
+
+BENCHMARKS = {
+    "helper_index_log": bench_helper_index_log,
+    "index_fixer": bench_index_fixer,
+    "library_scan": bench_library_scan,
+    "vdjfolder_export": bench_vdjfolder_export,
+    "end_to_end": bench_end_to_end,
+}
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+# prints every benchmark that got more than REGRESSION_THRESHOLD slower than in the old results, returns how many did
+def compare_results(results: list, old_results: list) -> int:
+    old = {(old_result["name"], old_result["size"]): old_result["seconds"] for old_result in old_results}
+    regressions = 0
+    for new_result in results:
+        old_seconds = old.get((new_result["name"], new_result["size"]))
+        if not old_seconds:
+            continue
+        change = new_result["seconds"] / old_seconds - 1
+        flag = "REGRESSION" if change > REGRESSION_THRESHOLD else ""
+        regressions += bool(flag)
+        print(f"{new_result['name']:<26}{new_result['size']:>8}  {old_seconds:>9.3f}s -> {new_result['seconds']:>9.3f}s  {change:>+7.1%}  {flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the project's hot paths against synthetic data")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Comma separated track counts to run every benchmark at, e.g. 1000,10000,100000")
+    parser.add_argument("--end-to-end-size", type=int, default=DEFAULT_END_TO_END_SIZE, help="How many tracks the end to end run downloads")
+    parser.add_argument("--only", help=f"Comma separated benchmarks to run ({', '.join(BENCHMARKS)})")
+    parser.add_argument("--output", help="Write the results to this json file")
+    parser.add_argument("--compare", help="Compare the results against an earlier --output file and exit with 1 if anything regressed")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated data instead of deleting it")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    names = [name.strip() for name in args.only.split(",")] if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(unknown)}")
+
+    results = []
+    try:
+        for name in names:
+            for size in ([args.end_to_end_size] if name == "end_to_end" else sizes):
+                for bench_result in BENCHMARKS[name](size):
+                    print(f"{bench_result['name']:<26}{bench_result['size']:>8}  {bench_result['seconds']:>9.3f}s  {bench_result['rate'] or 0:>10.1f}/s")
+                    results.append(bench_result)
+    finally:
+        if args.keep:
+            print(f"Generated data kept in {WORK_DIR}")
+        else:
+            shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump({"python": platform.python_version(), "platform": platform.platform(), "commit": git_commit(), "results": results}, output_file, indent=4)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as compare_file:
+            regressions = compare_results(results, json.load(compare_file)["results"])
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+import sys
+import shutil
+
+# stands in for ffmpeg in postprocess.py so the post processing pool can be timed offline, set ffmpeg_path to this file to use it
+# it copies the first input (the raw download from ytdlp_stub.py, which is already an mp3) to the output, the last argument, and ignores everything else
+
+def main():
+    args = sys.argv[1:]
+    shutil.copyfile(args[args.index("-i") + 1], args[-1])
+
+if __name__ == "__main__":
+    main()
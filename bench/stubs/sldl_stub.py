@@ -0,0 +1,128 @@
+import os
+import sys
+import csv
+import json
+import hashlib
+import shlex
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import synthetic  # noqa: E402
+from sldl_index import INDEX_HEADER, format_index_entry  # noqa: E402
+
+# stands in for sldl.exe so main.py can be timed offline: run it the way main.py runs sldl
+#   sldl_stub.py <playlist url> --path <output> --profile <profile> --config <sldl.conf>
+# with SLDL_STUB_RECORDING pointing at a .jsonl track list (see synthetic.write_sldl_recording)
+# for every track it replays sldl's recorded console output, writes a small tagged mp3 for downloaded tracks, records the track in
+# <output>/<playlist>/_index.sldl like sldl does, and runs the on-complete command from sldl.conf, concurrent-downloads tracks at a time
+# given a .csv input (main.py --sync and main.py batch) the tracks come from the csv instead, downloaded into a folder named after it like sldl does,
+# and FAILED_RATIO of them (picked by a hash of the title, so the same tracks fail in every run) aren't found
+
+RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "recordings")
+PLAYLIST_NAME = "Synthetic Playlist"
+FAILED_RATIO = 0.2
+
+# returns the tracks of an sldl csv input in the format of a recording
+def read_csv_tracks(csv_filepath: str) -> list:
+    tracks = []
+    with open(csv_filepath, "r", encoding="utf-8", newline="") as csv_file:
+        for row in csv.DictReader(csv_file):
+            failed = hashlib.blake2b(row["Title"].encode(), digest_size=1).digest()[0] < 256 * FAILED_RATIO
+            tracks.append({
+                "title": row["Title"],
+                "artist": row["Artist"],
+                "album": row["Album"],
+                "uri": "",
+                "length": row["Length"],
+                "state": "Failed" if failed else "Downloaded",
+                "failure_reason": "NoSuitableFileFound" if failed else "",
+            })
+    return tracks
+
+# returns the on-complete command (as a list of arguments) and concurrent-downloads from sldl.conf
+def read_conf(conf_filepath: str) -> tuple:
+    on_complete = None
+    concurrent_downloads = 2
+    with open(conf_filepath, "r", encoding="utf-8") as conf_file:
+        for line in conf_file:
+            name, _, value = line.partition("=")
+            name, value = name.strip(), value.strip()
+            if name == "on-complete":
+                # s: runs the command and waits for it, like sldl
+                value = value[2:] if value.startswith("s:") else value
+                on_complete = [part[1:-1] if len(part) > 1 and part[0] == part[-1] == '"' else part for part in shlex.split(value, posix=False)]
+            elif name == "concurrent-downloads" and value.isdigit():
+                concurrent_downloads = int(value)
+    return on_complete, concurrent_downloads
+
+def on_complete_command(template: list, track: dict, filepath: str) -> list:
+    values = {
+        "{path}": filepath,
+        "{title}": track["title"],
+        "{artist}": track["artist"],
+        "{album}": track["album"],
+        "{uri}": track["uri"],
+        "{length}": track["length"],
+        "{failure-reason}": track["failure_reason"],
+        "{state}": track["state"],
+    }
+    command = [values.get(part, part) for part in template]
+    # the template runs "python", use the interpreter running the benchmark
+    if command and command[0] == "python":
+        command[0] = sys.executable
+    return command
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded sldl run")
+    parser.add_argument("playlist_url")
+    parser.add_argument("--path", required=True)
+    parser.add_argument("--profile")
+    parser.add_argument("--config", required=True)
+    args = parser.parse_args()
+
+    if args.playlist_url.endswith(".csv"):
+        tracks = read_csv_tracks(args.playlist_url)
+        playlist_name = os.path.splitext(os.path.basename(args.playlist_url))[0]
+    else:
+        with open(os.environ["SLDL_STUB_RECORDING"], "r", encoding="utf-8") as recording_file:
+            tracks = [json.loads(line) for line in recording_file if line.strip()]
+        playlist_name = PLAYLIST_NAME
+    with open(os.path.join(RECORDINGS_DIR, "sldl_output.json"), "r", encoding="utf-8") as output_file:
+        console_output = json.load(output_file)
+
+    on_complete, concurrent_downloads = read_conf(args.config)
+    playlist_dir = os.path.join(args.path, playlist_name)
+    os.makedirs(playlist_dir, exist_ok=True)
+    index_filepath = os.path.join(playlist_dir, "_index.sldl")
+    if not os.path.exists(index_filepath):
+        with open(index_filepath, "w", encoding="utf-8") as index_file:
+            index_file.write(INDEX_HEADER)
+
+    for line in console_output["start"]:
+        print(line.format(count=len(tracks)))
+
+    # returns the console output and the index entry for a track
+    def handle_track(track: dict) -> tuple:
+        filepath = ""
+        if track["state"] == "Downloaded":
+            filepath = os.path.join(playlist_dir, f"{track['title']} - {track['artist']}.mp3")
+            synthetic.write_tagged_mp3(filepath, track["title"], track["artist"], track["album"], float(track["length"]))
+
+        output = "".join(line.format(filename=os.path.basename(filepath), **track) + "\n" for line in console_output[track["state"]])
+        if on_complete is not None:
+            subprocess.run(on_complete_command(on_complete, track, filepath))
+        return output, format_index_entry(filepath, track["artist"], track["album"], track["title"], track["length"])
+
+    with ThreadPoolExecutor(max_workers=concurrent_downloads) as executor, open(index_filepath, "a", encoding="utf-8") as index_file:
+        for output, index_entry in executor.map(handle_track, tracks):
+            print(output, end="")
+            index_file.write(index_entry + "\n")
+
+    downloaded = sum(1 for track in tracks if track["state"] == "Downloaded")
+    for line in console_output["end"]:
+        print(line.format(downloaded=downloaded, failed=len(tracks) - downloaded))
+
+if __name__ == "__main__":
+    main()
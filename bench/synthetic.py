@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+import random
+import struct
+from datetime import datetime
+
+import bench_paths  # noqa: F401, puts src/ on sys.path
+from fake_spotify_server import synthetic_track_info
+from sldl_index import INDEX_HEADER, format_index_entry
+
+# generators for the synthetic data the benchmarks run on: _index.sldl files, helper logs, index history directories,
+# tagged audio libraries and recordings for the stub sldl. everything is seeded so two runs generate the same data
+
+SEPERATOR = "=" * 150
+
+# one mpeg 1 layer 3 frame header: 128 kbps, 44.1 kHz, joint stereo, which makes every frame 417 bytes
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x64"
+MP3_FRAME_SIZE = 417
+MP3_FRAMES_PER_SECOND = 44100 / 1152
+# the side info of a stereo mpeg 1 frame, the xing header comes right after it
+MP3_SIDE_INFO_SIZE = 32
+
+# returns n (filepath, artist, album, title, length) rows, failed_ratio of them failed downloads with an empty filepath
+def index_rows(n: int, failed_ratio: float = 0.1, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        artist, title = f"Artist {i % 997}", f"Track {i}"
+        filepath = "" if rng.random() < failed_ratio else f"C:\\Music\\Synthetic\\{title} - {artist}.mp3"
+        rows.append((filepath, artist, f"Album {i % 331}", title, str(120 + i % 240)))
+    return rows
+
+def write_sldl_index(index_filepath: str, rows: list) -> None:
+    os.makedirs(os.path.dirname(index_filepath) or ".", exist_ok=True)
+    with open(index_filepath, "w", encoding="utf-8") as file:
+        file.write(INDEX_HEADER)
+        for row in rows:
+            file.write(format_index_entry(*row) + "\n")
+
+# a log block in the same format sldl_helper.py writes for a soulseek download
+def log_block(filepath: str, artist: str, album: str, title: str, length: str) -> str:
+    timestamp = datetime(2024, 1, 1).strftime("%Y-%m-%d %H:%M:%S")
+    return (
+        f"Downloading from SoulSeek...\n"
+        f"Title: {title}\n"
+        f"Artist: {artist}\n"
+        f"Spotify URI: spotify:track:{hashlib.blake2b(f'{artist}{title}'.encode(), digest_size=11).hexdigest()}\n"
+        f"Time: {timestamp}\n"
+        f"Filepath: '{filepath}'\n"
+        f"SLDL Index Entry: {format_index_entry(filepath, artist, album, title, length)}\n\n"
+        f"{SEPERATOR}\n\n"
+    )
+
+def write_helper_log(log_filepath: str, rows: list) -> None:
+    os.makedirs(os.path.dirname(log_filepath) or ".", exist_ok=True)
+    with open(log_filepath, "w", encoding="utf-8") as file:
+        for row in rows:
+            file.write(log_block(*row))
+
+# creates the layout index_fixer.py expects: <output>/<playlist>/_index.sldl from sldl, <output>/sldl_helper/_index.sldl from the helper,
+# and history_count older copies of sldl's index in <output>/sldl_helper/_index_history
+def make_output_dir(output_path: str, rows: list, history_count: int = 0) -> None:
+    write_sldl_index(os.path.join(output_path, "Synthetic Playlist", "_index.sldl"), rows)
+    write_sldl_index(os.path.join(output_path, "sldl_helper", "_index.sldl"), [(row[0] or f"C:\\Music\\yt\\{row[3]}.mp3", *row[1:]) for row in rows])
+
+    history_dir = os.path.join(output_path, "sldl_helper", "_index_history")
+    os.makedirs(history_dir, exist_ok=True)
+    for i in range(history_count):
+        # every history file is an older, shorter version of the index
+        write_sldl_index(os.path.join(history_dir, f"_index_{i}.sldl"), rows[:max(1, len(rows) * (i + 1) // (history_count + 1))])
+
+def _syncsafe(size: int) -> bytes:
+    return bytes(((size >> shift) & 0x7F) for shift in (21, 14, 7, 0))
+
+def _id3_frame(frame_id: str, text: str) -> bytes:
+    # encoding 3 is utf-8 (id3v2.4)
+    data = b"\x03" + text.encode("utf-8")
+    return frame_id.encode() + _syncsafe(len(data)) + b"\x00\x00" + data
+
+# writes a small mp3 with id3v2.4 tags that tag readers report as seconds long: a xing header gives the frame count, so only a few frames are actually written
+def write_tagged_mp3(filepath: str, title: str, artist: str, album: str, seconds: float) -> None:
+    frames = _id3_frame("TIT2", title) + _id3_frame("TPE1", artist) + _id3_frame("TALB", album)
+    id3 = b"ID3\x04\x00\x00" + _syncsafe(len(frames)) + frames
+
+    frame_count = int(seconds * MP3_FRAMES_PER_SECOND)
+    # flags 0x3: the frame count and the byte count of the stream follow
+    xing = b"Xing" + struct.pack(">III", 0x3, frame_count, frame_count * MP3_FRAME_SIZE)
+    first_frame = MP3_FRAME_HEADER + bytes(MP3_SIDE_INFO_SIZE) + xing
+    first_frame += bytes(MP3_FRAME_SIZE - len(first_frame))
+    audio_frame = MP3_FRAME_HEADER + bytes(MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    with open(filepath, "wb") as file:
+        file.write(id3 + first_frame + audio_frame * 3)
+
+# fills root with n tagged mp3s spread over nested folders, named like the tracks fake_spotify_server.py serves so playlists match against it
+# returns the number of files written
+def make_library(root: str, n: int, playlist_count: int, tracks_per_playlist: int) -> int:
+    for i in range(n):
+        playlist_index, position = divmod(i, tracks_per_playlist)
+        playlist_index %= max(playlist_count, 1)
+        artist, title = synthetic_track_info(playlist_index, position)
+        folder = os.path.join(root, f"Artist {i % 50}", f"Album {i % 7}")
+        seconds = (150000 + (playlist_index * 31 + position * 17) % 150000) / 1000
+        write_tagged_mp3(os.path.join(folder, f"{i:06d} {title}.mp3"), title, artist, f"Album {i % 7}", seconds)
+    return n
+
+# writes the track list the stub sldl replays, failed_ratio of the tracks are "not found" on soulseek and go to the youtube fallback
+def write_sldl_recording(recording_filepath: str, n: int, failed_ratio: float = 0.2, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    with open(recording_filepath, "w", encoding="utf-8") as file:
+        for i in range(n):
+            artist, title = synthetic_track_info(0, i)
+            failed = rng.random() < failed_ratio
+            file.write(json.dumps({
+                "title": title,
+                "artist": artist,
+                "album": f"Album {i % 7}",
+                "uri": f"spotify:track:{i:022d}",
+                "length": str(150 + i % 150),
+                "state": "Failed" if failed else "Downloaded",
+                "failure_reason": "NoSuitableFileFound" if failed else "",
+            }) + "\n")
@@ -0,0 +1,415 @@
+import os
+import time
+import wave
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import subprocess
+import threading
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from library_scanner import map_chunks, walk_audio_files
+from music_database import DATABASE_FILEPATH
+
+# tempo, key and loudness for every track in the library, since spotify's audio features endpoint is gone
+# audio is decoded to mono pcm (ffmpeg, or the wave module for .wav files when ffmpeg isn't installed) and analyzed with numpy, a batch of frames at a time:
+#   - tempo: a spectral flux onset envelope, autocorrelated, with a preference for tempos around 120 bpm
+#   - key: a chroma vector (the energy of each pitch class) correlated with the krumhansl-kessler major and minor key profiles
+#   - loudness: integrated loudness in LUFS (ITU-R BS.1770), the k-weighting filter is applied to the spectrum of each 400ms block instead of sample by sample
+# files are analyzed on a process pool, and results are cached in the catalog database by a hash of the file's contents,
+# so only new files are analyzed, and a file that was moved or renamed is only hashed, not analyzed again
+#
+#   python src/audio_analysis.py <library folder> [<library folder>...]
+
+ANALYSIS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS audio_analysis (
+    content_hash TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    bpm REAL,
+    key TEXT,
+    loudness REAL,
+    error TEXT,
+    analyzed_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS audio_analysis_files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+
+# bump this when the analysis changes, cached results from older versions are analyzed again
+ANALYSIS_VERSION = 1
+
+SAMPLE_RATE = 22050
+FRAME_SIZE = 2048
+HOP_SIZE = 512
+# how many stft frames go through one batched fft, about 12 seconds of audio
+BATCH_FRAMES = 512
+
+MIN_BPM = 60
+MAX_BPM = 200
+# tempos are weighted by a log normal curve around this tempo, so e.g. 128 wins over its half and double
+PREFERRED_BPM = 120
+PREFERRED_BPM_OCTAVES = 1.0
+
+# pitch classes are taken from this frequency range
+MIN_CHROMA_FREQUENCY = 55.0
+MAX_CHROMA_FREQUENCY = 5000.0
+PITCH_CLASSES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+MAJOR_PROFILE = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
+MINOR_PROFILE = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+
+LOUDNESS_BLOCK_SECONDS = 0.4
+LOUDNESS_OVERLAP = 0.75
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# files per task sent to the pool: hashing is cheap, analysis takes a second or more per file
+HASH_TASK_SIZE = 64
+ANALYSIS_TASK_SIZE = 2
+# below this many files the pool isn't worth starting
+MIN_PARALLEL_FILES = 4
+
+# error is set (and the other fields are None) if the file couldn't be decoded or analyzed
+AnalysisResult = namedtuple("AnalysisResult", ["bpm", "key", "loudness", "error"], defaults=(None,))
+
+class AudioDecodeError(Exception):
+    pass
+
+def content_hash(filepath: str) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filepath, "rb") as file:
+        while True:
+            chunk = file.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# returns the audio of a file as mono float32 samples at sample_rate
+def decode_audio(filepath: str, sample_rate: int = SAMPLE_RATE):
+    if shutil.which("ffmpeg"):
+        result = subprocess.run(["ffmpeg", "-v", "error", "-nostdin", "-i", filepath, "-f", "f32le", "-ac", "1", "-ar", str(sample_rate), "-"], capture_output=True)
+        if result.returncode != 0:
+            raise AudioDecodeError(result.stderr.decode("utf-8", errors="replace").strip() or f"ffmpeg exited with {result.returncode}")
+        return np.frombuffer(result.stdout, dtype=np.float32)
+
+    if os.path.splitext(filepath)[1].lower() != ".wav":
+        raise AudioDecodeError("ffmpeg is needed to decode anything but .wav files")
+    return _decode_wav(filepath, sample_rate)
+
+def _decode_wav(filepath: str, sample_rate: int):
+    try:
+        with wave.open(filepath, "rb") as wav_file:
+            channels, sample_width, file_rate = wav_file.getnchannels(), wav_file.getsampwidth(), wav_file.getframerate()
+            raw = wav_file.readframes(wav_file.getnframes())
+    except (wave.Error, EOFError) as e:
+        raise AudioDecodeError(str(e) or "not a readable wav file")
+
+    if sample_width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width in (2, 4):
+        dtype = np.int16 if sample_width == 2 else np.int32
+        samples = np.frombuffer(raw, dtype=dtype).astype(np.float32) / np.iinfo(dtype).max
+    else:
+        raise AudioDecodeError(f"unsupported sample width {sample_width}")
+
+    samples = samples.reshape(-1, channels).mean(axis=1)
+    if file_rate != sample_rate:
+        # linear interpolation is plenty for tempo, key and loudness
+        positions = np.arange(0, len(samples) * sample_rate // file_rate) * (file_rate / sample_rate)
+        samples = np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+    return samples
+
+# the matrix that sums the power of each fft bin into its pitch class, bins outside the chroma range are left out
+def _chroma_matrix(frame_size: int, sample_rate: int):
+    frequencies = np.fft.rfftfreq(frame_size, 1 / sample_rate)
+    in_range = (frequencies >= MIN_CHROMA_FREQUENCY) & (frequencies <= MAX_CHROMA_FREQUENCY)
+    pitch_classes = np.round(12 * np.log2(np.where(in_range, frequencies, 1.0) / 440.0) + 9).astype(int) % 12
+    matrix = np.zeros((len(frequencies), 12), dtype=np.float32)
+    matrix[np.flatnonzero(in_range), pitch_classes[in_range]] = 1.0
+    return matrix
+
+# |H|^2 of the BS.1770 k-weighting filter (a high shelf and a high pass) at the rfft bins of a block, for any sample rate
+def _k_weighting_power(block_size: int, sample_rate: int):
+    def biquad_power(b, a):
+        z = np.exp(-1j * 2 * np.pi * np.fft.rfftfreq(block_size, 1 / sample_rate) / sample_rate)
+        return np.abs((b[0] + b[1] * z + b[2] * z ** 2) / (a[0] + a[1] * z + a[2] * z ** 2)) ** 2
+
+    k = np.tan(np.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = biquad_power([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0], [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+
+    k = np.tan(np.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = biquad_power([1, -2, 1], [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    return (shelf * high_pass).astype(np.float32)
+
+# yields the frames of samples (frame_size long, hop apart) in batches, as views into samples
+def _frame_batches(samples, frame_size: int, hop: int, batch_frames: int):
+    if len(samples) < frame_size:
+        samples = np.pad(samples, (0, frame_size - len(samples)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, frame_size)[::hop]
+    for start in range(0, len(frames), batch_frames):
+        yield frames[start:start + batch_frames]
+
+# returns the onset envelope (one value per frame) and the summed chroma vector of samples
+def onset_envelope_and_chroma(samples, sample_rate: int = SAMPLE_RATE):
+    window = np.hanning(FRAME_SIZE).astype(np.float32)
+    chroma_matrix = _chroma_matrix(FRAME_SIZE, sample_rate)
+    envelope = []
+    chroma = np.zeros(12, dtype=np.float64)
+    previous = None
+
+    for batch in _frame_batches(samples, FRAME_SIZE, HOP_SIZE, BATCH_FRAMES):
+        magnitudes = np.abs(np.fft.rfft(batch * window, axis=1)).astype(np.float32)
+
+        # spectral flux: how much the (log compressed) spectrum grew since the previous frame, summed over the bins
+        compressed = np.log1p(1000 * magnitudes)
+        if previous is None:
+            previous = compressed[:1]
+        flux = np.diff(np.concatenate([previous, compressed]), axis=0)
+        envelope.append(np.maximum(flux, 0).sum(axis=1))
+        previous = compressed[-1:]
+
+        # every frame's chroma is normalized, so quiet passages count as much as loud ones
+        frame_chroma = (magnitudes ** 2) @ chroma_matrix
+        chroma += (frame_chroma / np.maximum(frame_chroma.max(axis=1, keepdims=True), 1e-10)).sum(axis=0)
+
+    return np.concatenate(envelope) if envelope else np.zeros(0, dtype=np.float32), chroma
+
+# returns the tempo in bpm, or None if there is no usable onset envelope
+def estimate_tempo(envelope, frame_rate: float):
+    if len(envelope) < 4 or not envelope.any():
+        return None
+
+    # remove the slowly changing part of the envelope, only the pulses matter
+    smoothing = max(int(frame_rate), 1)
+    envelope = envelope - np.convolve(envelope, np.ones(smoothing) / smoothing, mode="same")
+    envelope = np.maximum(envelope, 0)
+
+    # autocorrelation through the fft, zero padded so it doesn't wrap around
+    size = 1 << int(np.ceil(np.log2(2 * len(envelope))))
+    spectrum = np.fft.rfft(envelope, size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), size)[:len(envelope)]
+
+    min_lag = max(int(np.floor(60 * frame_rate / MAX_BPM)), 1)
+    max_lag = min(int(np.ceil(60 * frame_rate / MIN_BPM)), len(autocorrelation) - 2)
+    if max_lag <= min_lag:
+        return None
+
+    lags = np.arange(min_lag, max_lag + 1)
+    bpms = 60 * frame_rate / lags
+    weights = np.exp(-0.5 * (np.log2(bpms / PREFERRED_BPM) / PREFERRED_BPM_OCTAVES) ** 2)
+    best = min_lag + int(np.argmax(autocorrelation[lags] * weights))
+
+    # parabolic interpolation between the neighbouring lags for a fractional lag
+    left, center, right = autocorrelation[best - 1], autocorrelation[best], autocorrelation[best + 1]
+    denominator = left - 2 * center + right
+    offset = 0.5 * (left - right) / denominator if denominator != 0 else 0.0
+    return round(float(60 * frame_rate / (best + np.clip(offset, -0.5, 0.5))), 2)
+
+# returns the key (e.g. "Am" or "F#") that best matches a chroma vector, or None for silence
+def estimate_key(chroma):
+    if not chroma.any():
+        return None
+
+    # the profile of every key is the major or minor profile rotated to its tonic, all 24 are correlated at once
+    rotations = (np.arange(12)[None, :] - np.arange(12)[:, None]) % 12
+    profiles = np.concatenate([np.asarray(MAJOR_PROFILE)[rotations], np.asarray(MINOR_PROFILE)[rotations]])
+    profiles = profiles - profiles.mean(axis=1, keepdims=True)
+    centered = chroma - chroma.mean()
+    correlations = profiles @ centered / (np.linalg.norm(profiles, axis=1) * max(np.linalg.norm(centered), 1e-10))
+
+    best = int(np.argmax(correlations))
+    return PITCH_CLASSES[best % 12] + ("m" if best >= 12 else "")
+
+# returns the integrated loudness in LUFS, or None if the audio is silent or shorter than one block
+def integrated_loudness(samples, sample_rate: int = SAMPLE_RATE):
+    block_size = int(LOUDNESS_BLOCK_SECONDS * sample_rate)
+    hop = int(block_size * (1 - LOUDNESS_OVERLAP))
+    if len(samples) < block_size:
+        return None
+
+    weighting = _k_weighting_power(block_size, sample_rate)
+    # parseval: the mean square of a block is the (one sided) sum of its power spectrum, the dc and nyquist bins only count once
+    bin_weights = np.full(len(weighting), 2.0, dtype=np.float32)
+    bin_weights[0] = 1.0
+    if block_size % 2 == 0:
+        bin_weights[-1] = 1.0
+    bin_weights *= weighting / (block_size * block_size)
+
+    mean_squares = np.concatenate([
+        (np.abs(np.fft.rfft(batch, axis=1)) ** 2) @ bin_weights
+        for batch in _frame_batches(samples, block_size, hop, BATCH_FRAMES)
+    ])
+
+    with np.errstate(divide="ignore"):
+        block_loudness = -0.691 + 10 * np.log10(mean_squares)
+    gated = mean_squares[block_loudness > ABSOLUTE_GATE]
+    if len(gated) == 0:
+        return None
+    relative_gate = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE
+    gated = mean_squares[(block_loudness > ABSOLUTE_GATE) & (block_loudness > relative_gate)]
+    return round(float(-0.691 + 10 * np.log10(gated.mean())), 2)
+
+def analyze_samples(samples, sample_rate: int = SAMPLE_RATE) -> AnalysisResult:
+    envelope, chroma = onset_envelope_and_chroma(samples, sample_rate)
+    return AnalysisResult(estimate_tempo(envelope, sample_rate / HOP_SIZE), estimate_key(chroma), integrated_loudness(samples, sample_rate))
+
+def analyze_file(filepath: str) -> AnalysisResult:
+    if np is None:
+        return AnalysisResult(None, None, None, "numpy is not installed")
+    try:
+        return analyze_samples(decode_audio(filepath))
+    except (AudioDecodeError, OSError, ValueError) as e:
+        return AnalysisResult(None, None, None, str(e) or type(e).__name__)
+
+# these run in the worker processes
+def _hash_chunk(paths: list) -> list:
+    hashes = []
+    for path in paths:
+        try:
+            hashes.append(content_hash(path))
+        except OSError:
+            hashes.append(None)
+    return hashes
+
+def _analyze_chunk(paths: list) -> list:
+    return [analyze_file(path) for path in paths]
+
+# counts what an analysis run did and reports it
+class AnalysisStats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.files = 0
+        self.hashed = 0
+        self.analyzed = 0
+        self.failed = 0
+
+    def report(self) -> str:
+        elapsed = time.perf_counter() - self.started_at
+        return f"{self.files} files, {self.hashed} hashed, {self.analyzed} analyzed ({self.failed} failed) in {elapsed:.2f}s"
+
+class AudioAnalysisCache:
+    def __init__(self, db_filepath: str = DATABASE_FILEPATH):
+        self.db_filepath = db_filepath
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_filepath, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.executescript(ANALYSIS_SCHEMA)
+        self.stats = AnalysisStats()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    # returns {path: AnalysisResult} for the files whose cached result is still valid (same size and mtime, current analysis version)
+    def lookup(self, paths: list) -> dict:
+        results = {}
+        for path, (mtime_ns, size) in self._stat_paths(paths).items():
+            with self._lock:
+                row = self.conn.execute(
+                    "SELECT f.mtime_ns, f.size, a.bpm, a.key, a.loudness, a.error FROM audio_analysis_files f JOIN audio_analysis a ON a.content_hash = f.content_hash WHERE f.path = ? AND a.version = ?",
+                    (path, ANALYSIS_VERSION),
+                ).fetchone()
+            if row is not None and (row[0], row[1]) == (mtime_ns, size):
+                results[path] = AnalysisResult(*row[2:])
+        return results
+
+    # analyzes every file that isn't in the cache yet and returns {path: AnalysisResult} for all of them
+    def analyze(self, paths: list, workers: int = None) -> dict:
+        if np is None:
+            print("numpy is not installed, only cached audio analysis results are used")
+            return self.lookup(paths)
+
+        self.stats = AnalysisStats()
+        stats = self._stat_paths(paths)
+        self.stats.files = len(stats)
+
+        # files whose size or mtime changed (or that were never seen) need to be hashed again
+        with self._lock:
+            known = {path: (mtime_ns, size, digest) for path, mtime_ns, size, digest in self.conn.execute("SELECT path, mtime_ns, size, content_hash FROM audio_analysis_files")}
+        hashes = {path: known[path][2] for path, stat in stats.items() if path in known and known[path][:2] == stat}
+        to_hash = [(path, *stats[path]) for path in stats if path not in hashes]
+
+        hashed_rows = []
+        for (path, mtime_ns, size), digest in map_chunks(_hash_chunk, to_hash, workers, HASH_TASK_SIZE, MIN_PARALLEL_FILES):
+            if digest is not None:
+                hashes[path] = digest
+                hashed_rows.append((path, mtime_ns, size, digest))
+        self.stats.hashed = len(hashed_rows)
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO audio_analysis_files (path, mtime_ns, size, content_hash) VALUES (?, ?, ?, ?)", hashed_rows)
+
+        # each new content hash is analyzed once, through whichever path has it
+        with self._lock:
+            analyzed = {digest: AnalysisResult(*row) for digest, *row in self.conn.execute("SELECT content_hash, bpm, key, loudness, error FROM audio_analysis WHERE version = ?", (ANALYSIS_VERSION,))}
+        to_analyze = list({digest: (path, digest) for path, digest in hashes.items() if digest not in analyzed}.values())
+
+        batch = []
+        for (path, digest), result in map_chunks(_analyze_chunk, to_analyze, workers, ANALYSIS_TASK_SIZE, MIN_PARALLEL_FILES):
+            analyzed[digest] = result
+            self.stats.analyzed += 1
+            self.stats.failed += result.error is not None
+            batch.append((digest, ANALYSIS_VERSION, *result, time.time()))
+            # write as we go, so an interrupted run keeps what it already analyzed
+            if len(batch) >= 50:
+                self._store(batch)
+                batch = []
+        self._store(batch)
+
+        return {path: analyzed[digest] for path, digest in hashes.items() if digest in analyzed}
+
+    def _store(self, rows: list) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO audio_analysis (content_hash, version, bpm, key, loudness, error, analyzed_at) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    # returns {absolute path: (mtime_ns, size)} for the paths that exist
+    @staticmethod
+    def _stat_paths(paths: list) -> dict:
+        stats = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[os.path.abspath(path)] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze the tempo, key and loudness of every audio file in music library folders")
+    parser.add_argument("roots", nargs="+", help="Library folders to analyze, including their subfolders")
+    parser.add_argument("--database", default=DATABASE_FILEPATH, help="Path of the catalog database")
+    parser.add_argument("--workers", type=int, default=None, help="How many processes analyze files (default: one per cpu)")
+    args = parser.parse_args()
+
+    if np is None:
+        parser.error("numpy is needed for the analysis, install it with: pip install numpy")
+
+    cache = AudioAnalysisCache(args.database)
+    try:
+        results = cache.analyze([path for _, path, _, _ in walk_audio_files(args.roots)], workers=args.workers)
+        print(cache.stats.report())
+        for path, result in sorted(results.items()):
+            if result.error is not None:
+                print(f"Could not analyze {path}: {result.error}")
+    finally:
+        cache.close()
+
+if __name__ == "__main__":
+    main()
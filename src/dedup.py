@@ -0,0 +1,325 @@
+import os
+import mmap
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import threading
+from collections import defaultdict, namedtuple
+
+from library_cache import LibraryCache
+from library_scanner import map_chunks
+from music_database import DATABASE_FILEPATH, MusicCatalog
+from sldl_index import SldlIndex
+
+# finds files in the library that contain the same audio, e.g. the same song grabbed from soulseek twice, or once from soulseek and once from youtube into another output path
+# files are compared by a hash of their audio payload only: id3v2 tags at the start, id3v1 and apev2 tags at the end, and flac metadata blocks are skipped,
+# so a copy that was retagged (or got its cover art replaced) still matches. other containers (m4a, ogg...) keep their tags inside the stream and are hashed whole
+# a full library would take long to hash, so files are narrowed down first:
+#   - durations come from the library cache (see library_cache.py), only files within DURATION_TOLERANCE of another file's duration are looked at
+#   - of those, only files whose payload has the same size as another one's are hashed, reading the tag headers to find the payload is a couple of small reads
+#   - payload sizes and hashes are cached in the catalog database by path, mtime and size, so a second run only looks at new or changed files
+# files are read through mmap on a process pool
+#
+#   python src/dedup.py report <library folder> [<library folder>...]
+#   python src/dedup.py prune <library folder> [<library folder>...] [--dry-run] [--move-to <folder>]
+# prune keeps one file of every group (see keep_order below) and deletes the others, or moves them to --move-to
+# the catalog rows and the _index.sldl entries (of any output directory under the roots) of removed files are pointed at the file that was kept,
+# so --sync and index_fixer.py don't think the track is missing and download it again
+
+PAYLOAD_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS audio_payloads (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    payload_size INTEGER,
+    payload_hash TEXT
+) WITHOUT ROWID;
+'''
+
+# durations read from the tags of different copies can be a little off, e.g. when they're estimated from the bitrate
+DURATION_TOLERANCE = 1.0
+HASH_CHUNK_SIZE = 1024 * 1024
+# files per task sent to the pool: reading tag headers is a few small reads, hashing reads the whole file
+SPAN_TASK_SIZE = 256
+HASH_TASK_SIZE = 16
+MIN_PARALLEL_FILES = 64
+
+DedupFile = namedtuple("DedupFile", ["path", "root", "mtime_ns", "size", "duration", "tagged"])
+# keep is the DedupFile that prune keeps, duplicates the ones it removes, wasted_bytes is what removing them frees
+DuplicateGroup = namedtuple("DuplicateGroup", ["keep", "duplicates", "wasted_bytes"])
+
+# returns where the tags at the start of a file end: any number of id3v2 tags (some taggers prepend a new one instead of rewriting the old one), then the flac metadata blocks
+def _leading_tags_end(buffer, end: int) -> int:
+    offset = 0
+    while end - offset >= 10 and buffer[offset:offset + 3] == b"ID3":
+        size = buffer[offset + 6:offset + 10]
+        # the size is syncsafe (7 bits per byte) and doesn't include the 10 byte header, or the footer if flag 0x10 is set
+        offset += 10 + ((size[0] << 21) | (size[1] << 14) | (size[2] << 7) | size[3]) + (10 if buffer[offset + 5] & 0x10 else 0)
+
+    if end - offset >= 4 and buffer[offset:offset + 4] == b"fLaC":
+        offset += 4
+        while end - offset >= 4:
+            header = buffer[offset]
+            offset += 4 + int.from_bytes(buffer[offset + 1:offset + 4], "big")
+            # the high bit marks the last metadata block
+            if header & 0x80:
+                break
+    return offset
+
+# returns where the audio before the tags at the end of a file ends: an id3v1 tag, and an apev2 tag before it
+def _trailing_tags_start(buffer, start: int, end: int) -> int:
+    if end - start >= 128 and buffer[end - 128:end - 125] == b"TAG":
+        end -= 128
+    if end - start >= 32 and buffer[end - 32:end - 24] == b"APETAGEX":
+        # the size in the footer includes the footer but not the header, which is there if the high bit of the flags is set
+        size = int.from_bytes(buffer[end - 20:end - 16], "little")
+        flags = int.from_bytes(buffer[end - 12:end - 8], "little")
+        end -= size + (32 if flags & 0x80000000 else 0)
+    return end
+
+# returns the (start, end) byte offsets of the audio payload in a buffer
+# a file without any payload, or whose tag sizes claim more bytes than it has (a truncated or broken tag), raises ValueError:
+# clamping them would give all of those files the same empty payload, and they'd be reported as duplicates of each other
+def payload_span(buffer) -> tuple:
+    start = _leading_tags_end(buffer, len(buffer))
+    end = _trailing_tags_start(buffer, start, len(buffer)) if start < len(buffer) else start
+    if not start < end <= len(buffer):
+        raise ValueError("the file has no audio payload, or its tags overrun it")
+    return start, end
+
+# maps a file read only, empty files (which can't be mapped) raise ValueError like any other file without a payload
+def _map_file(file):
+    if os.fstat(file.fileno()).st_size == 0:
+        raise ValueError("the file is empty")
+    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+# returns the size of a file's audio payload
+def payload_size(filepath: str) -> int:
+    with open(filepath, "rb") as file:
+        with _map_file(file) as mapped:
+            start, end = payload_span(mapped)
+    return end - start
+
+# returns the hash of a file's audio payload
+def payload_hash(filepath: str) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filepath, "rb") as file:
+        mapped = _map_file(file)
+        with mapped, memoryview(mapped) as view:
+            start, end = payload_span(mapped)
+            for offset in range(start, end, HASH_CHUNK_SIZE):
+                digest.update(view[offset:min(offset + HASH_CHUNK_SIZE, end)])
+    return digest.hexdigest()
+
+# these run in the worker processes, a file that can't be read or has no payload gets None
+def _payload_size_chunk(paths: list) -> list:
+    sizes = []
+    for path in paths:
+        try:
+            sizes.append(payload_size(path))
+        except (OSError, ValueError):
+            sizes.append(None)
+    return sizes
+
+def _payload_hash_chunk(paths: list) -> list:
+    hashes = []
+    for path in paths:
+        try:
+            hashes.append(payload_hash(path))
+        except (OSError, ValueError):
+            hashes.append(None)
+    return hashes
+
+# splits files into windows of DURATION_TOLERANCE seconds and returns every pair of neighbouring windows that holds more than one file,
+# so two files within DURATION_TOLERANCE of each other always share a group, and a group never spans more than twice the tolerance
+# (chaining files that are within the tolerance of the previous one would put most of a big library into a single group)
+# a file can be in two groups, files without a duration (their tags couldn't be read) are one group of their own
+def duration_groups(files: list) -> list:
+    windows = defaultdict(list)
+    for file in files:
+        if file.duration is not None:
+            windows[int(file.duration // DURATION_TOLERANCE)].append(file)
+    groups = [windows[window] + windows.get(window + 1, []) for window in sorted(windows)]
+    groups.append([file for file in files if file.duration is None])
+    return [group for group in groups if len(group) > 1]
+
+# the file prune keeps sorts first: files from earlier roots, files the catalog knows about (sldl and the helper wrote them), tagged files,
+# then the biggest file (the most complete tags or cover art), the oldest, and the shortest path
+def keep_order(file: DedupFile, roots: list, catalog_paths: set) -> tuple:
+    return (roots.index(file.root) if file.root in roots else len(roots), file.path not in catalog_paths, not file.tagged, -file.size, file.mtime_ns, len(file.path), file.path)
+
+class DuplicateFinder:
+    def __init__(self, db_filepath: str = DATABASE_FILEPATH):
+        self.db_filepath = db_filepath
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_filepath, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.executescript(PAYLOAD_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    # returns a DuplicateGroup for every set of files under roots with the same audio, the most wasted space first
+    def find(self, roots, workers: int = None) -> list:
+        roots = [os.path.abspath(root) for root in ([roots] if isinstance(roots, str) else roots)]
+        files = self._library_files(roots, workers)
+
+        # only files close to another file's duration can be duplicates
+        groups = duration_groups(files)
+        candidates = list({file.path: file for group in groups for file in group}.values())
+        with self._lock:
+            cached = {path: row for path, *row in self.conn.execute("SELECT path, mtime_ns, size, payload_size, payload_hash FROM audio_payloads")}
+        def is_cached(file):
+            row = cached.get(file.path)
+            return row is not None and (row[0], row[1]) == (file.mtime_ns, file.size)
+
+        payload_sizes = {file.path: cached[file.path][2] for file in candidates if is_cached(file)}
+        hashes = {file.path: cached[file.path][3] for file in candidates if is_cached(file) and cached[file.path][3] is not None}
+        new_sizes = [(file.path, file) for file in candidates if file.path not in payload_sizes]
+        for (path, file), size in map_chunks(_payload_size_chunk, new_sizes, workers, SPAN_TASK_SIZE, MIN_PARALLEL_FILES):
+            payload_sizes[path] = size
+        self._store([(file.path, file.mtime_ns, file.size, payload_sizes[file.path], None) for _, file in new_sizes])
+
+        # of those, only files whose payload is exactly as big as another one's have to be hashed, files without a payload (size None, or 0 cached by older versions) never match
+        by_size = defaultdict(dict)
+        for group in groups:
+            sizes = defaultdict(list)
+            for file in group:
+                if payload_sizes.get(file.path):
+                    sizes[payload_sizes[file.path]].append(file)
+            for size, same_size in sizes.items():
+                if len(same_size) > 1:
+                    by_size[size].update((file.path, file) for file in same_size)
+
+        to_hash = [(file.path, file) for same_size in by_size.values() for file in same_size.values() if file.path not in hashes]
+        rows = []
+        for (path, file), digest in map_chunks(_payload_hash_chunk, to_hash, workers, HASH_TASK_SIZE, MIN_PARALLEL_FILES):
+            hashes[path] = digest
+            rows.append((path, file.mtime_ns, file.size, payload_sizes[path], digest))
+        self._store(rows)
+
+        by_hash = defaultdict(dict)
+        for same_size in by_size.values():
+            for file in same_size.values():
+                if hashes.get(file.path) is not None:
+                    by_hash[hashes[file.path]][file.path] = file
+
+        catalog_paths = self._catalog_paths([path for same_hash in by_hash.values() if len(same_hash) > 1 for path in same_hash])
+        groups = []
+        for same_hash in by_hash.values():
+            if len(same_hash) < 2:
+                continue
+            ordered = sorted(same_hash.values(), key=lambda file: keep_order(file, roots, catalog_paths))
+            groups.append(DuplicateGroup(ordered[0], ordered[1:], sum(file.size for file in ordered[1:])))
+        return sorted(groups, key=lambda group: group.wasted_bytes, reverse=True)
+
+    # brings the library cache up to date and returns every audio file under roots, with or without tags
+    def _library_files(self, roots: list, workers: int) -> list:
+        library_cache = LibraryCache(self.db_filepath)
+        try:
+            library_cache.scan(roots, workers=workers)
+        finally:
+            library_cache.close()
+
+        placeholders = ", ".join("?" for _ in roots)
+        with self._lock:
+            rows = self.conn.execute(f"SELECT path, root, mtime_ns, size, duration, title, artist FROM library_files WHERE root IN ({placeholders})", roots).fetchall()
+        return [DedupFile(path, root, mtime_ns, size, duration or None, bool(title and artist)) for path, root, mtime_ns, size, duration, title, artist in rows]
+
+    # returns the paths the catalog has a song for
+    def _catalog_paths(self, paths: list) -> set:
+        with self._lock:
+            tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if "all_music" not in tables:
+                return set()
+            return {path for path in paths if self.conn.execute("SELECT 1 FROM all_music WHERE filepath = ?", (path,)).fetchone()}
+
+    def _store(self, rows: list) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO audio_payloads (path, mtime_ns, size, payload_size, payload_hash) VALUES (?, ?, ?, ?, ?)", rows)
+
+# removes the duplicates of every group (moving them into move_to if given, keeping their path relative to their root), returns how many bytes were freed
+# the catalog and index entries of every removed file then point at the file its group kept
+def prune(groups: list, move_to: str = None, db_filepath: str = DATABASE_FILEPATH) -> int:
+    freed = 0
+    moves = {}
+    for group in groups:
+        for duplicate in group.duplicates:
+            try:
+                if move_to:
+                    destination = os.path.join(move_to, os.path.relpath(duplicate.path, duplicate.root))
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    shutil.move(duplicate.path, destination)
+                else:
+                    os.remove(duplicate.path)
+            except OSError as e:
+                print(f"Could not remove {duplicate.path}: {e}")
+                continue
+            freed += duplicate.size
+            moves[duplicate.path] = group.keep.path
+
+    if moves:
+        replace_references(moves, sorted({file.root for group in groups for file in (group.keep, *group.duplicates)}), db_filepath)
+    return freed
+
+# points the catalog rows and the entries of every _index.sldl under roots (sldl's own and the helper's) from the removed files to the kept ones
+def replace_references(moves: dict, roots: list, db_filepath: str = DATABASE_FILEPATH) -> None:
+    catalog = MusicCatalog(db_filepath)
+    try:
+        catalog.replace_filepaths(moves)
+    finally:
+        catalog.close()
+
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            if "_index.sldl" in filenames:
+                SldlIndex(os.path.join(dirpath, "_index.sldl")).replace_filepaths(moves)
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+def print_groups(groups: list, action: str) -> None:
+    for group in groups:
+        print(f"Keep {group.keep.path}")
+        for duplicate in group.duplicates:
+            print(f"  {action} {duplicate.path}")
+    print(f"{len(groups)} groups of duplicates, {sum(len(group.duplicates) for group in groups)} duplicate files, {format_size(sum(group.wasted_bytes for group in groups))}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Find (and remove) files in music library folders that contain the same audio")
+    parser.add_argument("--database", default=DATABASE_FILEPATH, help="Path of the catalog database")
+    parser.add_argument("--workers", type=int, default=None, help="How many processes read files (default: one per cpu)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    report_parser = subparsers.add_parser("report", help="List every group of duplicates and the file prune would keep")
+    report_parser.add_argument("roots", nargs="+", help="Library folders to look in, including their subfolders. Files in earlier folders are kept over later ones")
+
+    prune_parser = subparsers.add_parser("prune", help="Keep one file of every group of duplicates and remove the others")
+    prune_parser.add_argument("roots", nargs="+", help="Library folders to look in, including their subfolders. Files in earlier folders are kept over later ones")
+    prune_parser.add_argument("--dry-run", action="store_true", help="Only print what would be removed")
+    prune_parser.add_argument("--move-to", help="Move the duplicates into this folder instead of deleting them")
+
+    args = parser.parse_args()
+    finder = DuplicateFinder(args.database)
+    try:
+        groups = finder.find(args.roots, workers=args.workers)
+    finally:
+        finder.close()
+
+    if args.command == "report":
+        print_groups(groups, "Duplicate")
+    elif args.command == "prune":
+        print_groups(groups, "Would remove" if args.dry_run else "Move" if args.move_to else "Remove")
+        if not args.dry_run:
+            print(f"Freed {format_size(prune(groups, move_to=args.move_to, db_filepath=args.database))}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import time
+import sqlite3
+import argparse
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from music_database import DATABASE_FILEPATH
+from text_normalize import normalize_text
+
+# tracks that failed on both soulseek and youtube are recorded here with how many times they failed, when they last failed and why
+# every failure doubles how long the track is left alone (BASE_BACKOFF, 2 * BASE_BACKOFF, ... up to MAX_BACKOFF), so a track that has never been found
+# stops costing a full soulseek search timeout and a yt-dlp attempt on every run, while a track that failed once is retried soon
+#   - main.py --sync leaves tracks that are still backing off out of sldl's input, and puts the ones that failed the fewest times first (see playlist_sync.py)
+#   - the helper doesn't try the youtube fallback for a track that is still backing off
+#   - a successful download removes the track from the ledger
+# tracks are keyed by their normalized artist and title, so the same song from another album shares its entry
+#
+#   python src/failure_ledger.py list [--backing-off | --due]
+#   python src/failure_ledger.py reset [--artist ARTIST --title TITLE | --all]
+
+FAILURE_LEDGER_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS failure_ledger (
+    norm_artist TEXT NOT NULL,
+    norm_title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    album TEXT NOT NULL,
+    title TEXT NOT NULL,
+    uri TEXT,
+    attempts INTEGER NOT NULL,
+    first_failed_at REAL NOT NULL,
+    last_attempt_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    failure_reason TEXT,
+    PRIMARY KEY (norm_artist, norm_title)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS failure_ledger_next_attempt ON failure_ledger (next_attempt_at);
+'''
+
+BASE_BACKOFF = 12 * 60 * 60
+MAX_BACKOFF = 30 * 24 * 60 * 60
+
+LedgerEntry = namedtuple("LedgerEntry", ["artist", "album", "title", "uri", "attempts", "first_failed_at", "last_attempt_at", "next_attempt_at", "failure_reason"])
+
+# how long a track is left alone after its attempts-th failure
+def backoff_seconds(attempts: int) -> float:
+    return min(BASE_BACKOFF * 2 ** max(attempts - 1, 0), MAX_BACKOFF)
+
+def _key(artist: str, title: str) -> tuple:
+    return normalize_text(artist), normalize_text(title)
+
+class FailureLedger:
+    def __init__(self, db_filepath: str = DATABASE_FILEPATH):
+        self.db_filepath = db_filepath
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_filepath, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            with self._conn:
+                self._conn.executescript(FAILURE_LEDGER_SCHEMA)
+        return self._conn
+
+    # records another failed attempt and schedules the next one, returns the updated entry
+    def record_failure(self, artist: str, album: str, title: str, failure_reason: str = None, uri: str = None, now: float = None) -> LedgerEntry:
+        now = time.time() if now is None else now
+        norm_artist, norm_title = _key(artist, title)
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT attempts, first_failed_at FROM failure_ledger WHERE norm_artist = ? AND norm_title = ?", (norm_artist, norm_title)).fetchone()
+            attempts, first_failed_at = (row[0] + 1, row[1]) if row is not None else (1, now)
+            entry = LedgerEntry(artist, album or "", title, uri or None, attempts, first_failed_at, now, now + backoff_seconds(attempts), failure_reason)
+            conn.execute(
+                "INSERT OR REPLACE INTO failure_ledger (norm_artist, norm_title, artist, album, title, uri, attempts, first_failed_at, last_attempt_at, next_attempt_at, failure_reason) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (norm_artist, norm_title, *entry),
+            )
+        return entry
+
+    # forgets a track, e.g. because it was downloaded after all, returns true if it was in the ledger
+    def record_success(self, artist: str, title: str) -> bool:
+        with self._lock, self._connect() as conn:
+            return conn.execute("DELETE FROM failure_ledger WHERE norm_artist = ? AND norm_title = ?", _key(artist, title)).rowcount > 0
+
+    # returns the ledger entry of a track, or None if it never failed (or was reset)
+    def get(self, artist: str, title: str):
+        with self._lock:
+            row = self._connect().execute(f"SELECT {', '.join(LedgerEntry._fields)} FROM failure_ledger WHERE norm_artist = ? AND norm_title = ?", _key(artist, title)).fetchone()
+        return LedgerEntry(*row) if row is not None else None
+
+    # returns true if the track failed recently enough that it shouldn't be tried yet
+    def is_backing_off(self, artist: str, title: str, now: float = None) -> bool:
+        entry = self.get(artist, title)
+        return entry is not None and entry.next_attempt_at > (time.time() if now is None else now)
+
+    # splits tracks into the ones to try now and the ones still backing off
+    # tracks that never failed keep their order and come first, then due retries with the fewest failures (the most likely to succeed) first
+    # key returns the (artist, title) of a track
+    def schedule(self, tracks: list, key, now: float = None) -> tuple:
+        now = time.time() if now is None else now
+        fresh, retries, backing_off = [], [], []
+        for track in tracks:
+            entry = self.get(*key(track))
+            if entry is None:
+                fresh.append(track)
+            elif entry.next_attempt_at > now:
+                backing_off.append(track)
+            else:
+                retries.append((entry.attempts, -entry.last_attempt_at, len(retries), track))
+
+        return fresh + [track for *_, track in sorted(retries, key=lambda retry: retry[:3])], backing_off
+
+    # returns every entry, optionally only the ones still backing off (backing_off=True) or due for a retry (backing_off=False)
+    def entries(self, backing_off: bool = None, now: float = None) -> list:
+        now = time.time() if now is None else now
+        query = f"SELECT {', '.join(LedgerEntry._fields)} FROM failure_ledger"
+        params = ()
+        if backing_off is not None:
+            query += " WHERE next_attempt_at > ?" if backing_off else " WHERE next_attempt_at <= ?"
+            params = (now,)
+        with self._lock:
+            rows = self._connect().execute(query + " ORDER BY next_attempt_at", params).fetchall()
+        return [LedgerEntry(*row) for row in rows]
+
+    # removes one track (if artist and title are given) or every track from the ledger, returns how many were removed
+    def reset(self, artist: str = None, title: str = None) -> int:
+        with self._lock, self._connect() as conn:
+            if artist is None and title is None:
+                return conn.execute("DELETE FROM failure_ledger").rowcount
+            return conn.execute("DELETE FROM failure_ledger WHERE norm_artist = ? AND norm_title = ?", _key(artist or "", title or "")).rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+def _format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or reset the ledger of tracks that failed to download")
+    parser.add_argument("--database", default=DATABASE_FILEPATH, help="Path of the catalog database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="List the tracks in the ledger, the next one to be retried first")
+    list_filter = list_parser.add_mutually_exclusive_group()
+    list_filter.add_argument("--backing-off", action="store_true", help="Only list tracks that won't be retried yet")
+    list_filter.add_argument("--due", action="store_true", help="Only list tracks that will be retried on the next run")
+
+    reset_parser = subparsers.add_parser("reset", help="Remove tracks from the ledger so they're retried on the next run")
+    reset_parser.add_argument("--artist", help="The artist of the track to reset")
+    reset_parser.add_argument("--title", help="The title of the track to reset")
+    reset_parser.add_argument("--all", action="store_true", help="Reset every track")
+
+    args = parser.parse_args()
+    ledger = FailureLedger(args.database)
+    try:
+        if args.command == "list":
+            entries = ledger.entries(True if args.backing_off else False if args.due else None)
+            for entry in entries:
+                print(f"{entry.artist} - {entry.title} ({entry.album}): {entry.attempts} attempts, last {_format_time(entry.last_attempt_at)}, next {_format_time(entry.next_attempt_at)}, {entry.failure_reason or 'unknown reason'}")
+            print(f"{len(entries)} tracks")
+        elif args.command == "reset":
+            if args.all:
+                count = ledger.reset()
+            elif args.artist and args.title:
+                count = ledger.reset(args.artist, args.title)
+            else:
+                reset_parser.error("Pass --artist and --title, or --all")
+            print(f"Reset {count} tracks")
+    finally:
+        ledger.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import json
+import time
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# a local stand-in for the spotify web api endpoints we use, serving synthetic playlists of any size
+# point spotify.py at it with spotify_api_url=http://127.0.0.1:<port>/v1/ (any token is accepted) to load test or benchmark the fetch and search paths offline
+#
+# served endpoints:
+#   GET  /v1/me
+#   GET  /v1/users/<user>/playlists and /v1/me/playlists             (limit, offset)
+#   GET  /v1/playlists/<id>                                          (fields)
+#   GET  /v1/playlists/<id>/tracks and /v1/playlists/<id>/items      (fields, limit, offset)
+#   POST /v1/users/<user>/playlists and /v1/me/playlists
+#   POST /v1/playlists/<id>/tracks and /v1/playlists/<id>/items      (at most 100 uris, like the real api)
+#   GET  /v1/search                                                  (q, type=track, limit)
+#
+# tracks are generated from (playlist, position) when they are requested, so a huge synthetic account costs no memory
+# optional latency and a requests per second limit (answered with 429 and Retry-After) make it behave more like the real thing
+
+USER_ID = "offline-user"
+MAX_PAGE_SIZE = {"tracks": 100, "playlists": 50}
+ADD_ITEMS_LIMIT = 100
+ARTIST_POOL_SIZE = 500
+
+# returns the artist and title of a synthetic track, shared with anything that builds a matching synthetic library (e.g. the benchmarks)
+def synthetic_track_info(playlist_index: int, position: int) -> tuple:
+    return f"Artist {(playlist_index * 7919 + position) % ARTIST_POOL_SIZE}", f"Track {playlist_index}.{position}"
+
+def synthetic_track(playlist_index: int, position: int) -> dict:
+    artist, title = synthetic_track_info(playlist_index, position)
+    track_id = hashlib.blake2b(f"{playlist_index}.{position}".encode(), digest_size=11).hexdigest()
+    return _track_object(track_id, title, artist, 150000 + (playlist_index * 31 + position * 17) % 150000)
+
+def _track_object(track_id: str, title: str, artist: str, duration_ms: int) -> dict:
+    # includes the bulky fields the real api returns (images, markets) so fields projection makes the same difference it does against spotify
+    return {
+        "id": track_id,
+        "uri": f"spotify:track:{track_id}",
+        "name": title,
+        "duration_ms": duration_ms,
+        "is_local": False,
+        "artists": [{"id": hashlib.blake2b(artist.encode(), digest_size=11).hexdigest(), "name": artist, "type": "artist"}],
+        "album": {
+            "name": f"{title} - Single",
+            "images": [{"url": f"https://i.scdn.co/image/{track_id}{size}", "height": size, "width": size} for size in (640, 300, 64)],
+        },
+        "available_markets": ["US", "GB", "DE", "FR", "NL", "SE", "JP", "BR", "CA", "AU"],
+    }
+
+# parses the fields parameter ("total,items(track(name,artists(name)))") into {"total": None, "items": {"track": {...}}}
+def parse_fields(fields: str) -> dict:
+    spec, position = _parse_field_list(fields, 0)
+    return spec
+
+def _parse_field_list(fields: str, position: int) -> tuple:
+    spec = {}
+    name = ""
+    while position < len(fields):
+        char = fields[position]
+        if char == "(":
+            spec[name.strip()], position = _parse_field_list(fields, position + 1)
+            name = ""
+        elif char == ")":
+            break
+        elif char == ",":
+            if name.strip():
+                spec[name.strip()] = None
+            name = ""
+        else:
+            name += char
+        position += 1
+    if name.strip():
+        spec[name.strip()] = None
+    return spec, position
+
+def project(value, spec):
+    if spec is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, spec) for item in value]
+    if isinstance(value, dict):
+        return {key: project(value[key], sub_spec) for key, sub_spec in spec.items() if key in value}
+    return value
+
+class FakeSpotifyServer:
+    def __init__(self, playlists: int = 20, tracks_per_playlist: int = 500, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, rate_limit: float = None, miss_rate: float = 0.1):
+        self.playlist_count = playlists
+        self.tracks_per_playlist = tracks_per_playlist
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.miss_rate = miss_rate
+        self.request_count = 0
+        self.throttled_count = 0
+        # playlists created through the api: id -> {"name", "uris", "snapshot"}
+        self.created_playlists = {}
+        self._lock = threading.Lock()
+        self._window_started_at = time.monotonic()
+        self._window_requests = 0
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    # the environment variables that point spotify.py at this server
+    def env(self) -> dict:
+        return {"spotify_api_url": self.url, "spotify_api_token": "offline"}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-spotify", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # returns the seconds to wait (the Retry-After) if this request is over the rate limit, otherwise None
+    def _throttle(self):
+        with self._lock:
+            self.request_count += 1
+            if not self.rate_limit:
+                return None
+            now = time.monotonic()
+            if now - self._window_started_at >= 1:
+                self._window_started_at = now
+                self._window_requests = 0
+            self._window_requests += 1
+            if self._window_requests > self.rate_limit:
+                self.throttled_count += 1
+                return 1
+            return None
+
+    def _playlist_index(self, playlist_id: str):
+        if playlist_id.startswith("playlist"):
+            index = playlist_id[len("playlist"):]
+            if index.isdigit() and int(index) < self.playlist_count:
+                return int(index)
+        return None
+
+    def _playlist_object(self, playlist_id: str):
+        index = self._playlist_index(playlist_id)
+        if index is not None:
+            name, total, snapshot = f"Synthetic Playlist {index}", self.tracks_per_playlist, "snapshot0"
+        elif playlist_id in self.created_playlists:
+            created = self.created_playlists[playlist_id]
+            name, total, snapshot = created["name"], len(created["uris"]), f"snapshot{created['snapshot']}"
+        else:
+            return None
+        return {
+            "id": playlist_id,
+            "name": name,
+            "snapshot_id": snapshot,
+            "owner": {"id": USER_ID},
+            "tracks": {"total": total},
+            "images": [{"url": f"https://mosaic.scdn.co/640/{playlist_id}", "height": 640, "width": 640}],
+        }
+
+    def _playlist_items(self, playlist_id: str, offset: int, limit: int):
+        index = self._playlist_index(playlist_id)
+        if index is not None:
+            total = self.tracks_per_playlist
+            tracks = [synthetic_track(index, position) for position in range(offset, min(total, offset + limit))]
+        elif playlist_id in self.created_playlists:
+            uris = self.created_playlists[playlist_id]["uris"]
+            total = len(uris)
+            tracks = [_track_object(uri.rsplit(":", 1)[-1], uri, "Unknown", 200000) for uri in uris[offset:offset + limit]]
+        else:
+            return None
+        return _page([{"added_at": "2024-01-01T00:00:00Z", "is_local": False, "track": track} for track in tracks], total, offset, limit)
+
+    def _search(self, query: str, limit: int) -> dict:
+        # "artist: <artist> track: <title>", a deterministic share of queries finds nothing
+        digest = hashlib.blake2b(query.encode(), digest_size=11).hexdigest()
+        items = []
+        if int(digest[:8], 16) / 0xFFFFFFFF >= self.miss_rate:
+            artist, _, title = query.partition(" track: ")
+            items = [_track_object(digest, title.strip(), artist.replace("artist:", "", 1).strip(), 200000)][:limit]
+        return {"tracks": _page(items, len(items), 0, limit)}
+
+def _page(items: list, total: int, offset: int, limit: int) -> dict:
+    return {"items": items, "total": total, "offset": offset, "limit": limit, "next": None if offset + limit >= total else f"offset={offset + limit}"}
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body=None, headers: dict = None) -> None:
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, message: str, headers: dict = None) -> None:
+        self._send(status, {"error": {"status": status, "message": message}}, headers)
+
+    def _route(self, method: str) -> None:
+        fake = self.server.fake
+        retry_after = fake._throttle()
+        if retry_after is not None:
+            return self._error(429, "API rate limit exceeded", {"Retry-After": str(retry_after)})
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split("/") if part]
+        if parts[:1] != ["v1"]:
+            return self._error(404, "Not found")
+        parts = parts[1:]
+        offset = int(query.get("offset", 0))
+        fields = parse_fields(query["fields"]) if query.get("fields") else None
+
+        if method == "GET" and parts == ["me"]:
+            return self._send(200, {"id": USER_ID, "display_name": "Offline User"})
+
+        if method == "GET" and parts == ["search"]:
+            return self._send(200, fake._search(query.get("q", ""), min(int(query.get("limit", 10)), 50)))
+
+        is_user_playlists = parts == ["me", "playlists"] or (len(parts) == 3 and parts[0] == "users" and parts[2] == "playlists")
+        if is_user_playlists and method == "GET":
+            limit = min(int(query.get("limit", 20)), MAX_PAGE_SIZE["playlists"])
+            playlist_ids = [f"playlist{index}" for index in range(fake.playlist_count)] + list(fake.created_playlists)
+            playlists = [fake._playlist_object(playlist_id) for playlist_id in playlist_ids[offset:offset + limit]]
+            return self._send(200, _page(playlists, len(playlist_ids), offset, limit))
+        if is_user_playlists and method == "POST":
+            body = self._read_json()
+            with fake._lock:
+                playlist_id = f"created{len(fake.created_playlists)}"
+                fake.created_playlists[playlist_id] = {"name": body.get("name", ""), "uris": [], "snapshot": 0}
+            return self._send(201, fake._playlist_object(playlist_id))
+
+        if len(parts) == 2 and parts[0] == "playlists" and method == "GET":
+            playlist = fake._playlist_object(parts[1])
+            if playlist is None:
+                return self._error(404, "Not found.")
+            return self._send(200, project(playlist, fields))
+
+        if len(parts) == 3 and parts[0] == "playlists" and parts[2] in ("tracks", "items"):
+            if method == "GET":
+                limit = min(int(query.get("limit", 100)), MAX_PAGE_SIZE["tracks"])
+                page = fake._playlist_items(parts[1], offset, limit)
+                if page is None:
+                    return self._error(404, "Not found.")
+                return self._send(200, project(page, fields))
+            if method == "POST":
+                # spotipy sends the uris as a bare list, the api docs as {"uris": [...]}
+                body = self._read_json()
+                uris = body if isinstance(body, list) else body.get("uris", [])
+                if len(uris) > ADD_ITEMS_LIMIT:
+                    return self._error(400, f"You can add a maximum of {ADD_ITEMS_LIMIT} tracks per request.")
+                with fake._lock:
+                    created = fake.created_playlists.get(parts[1])
+                    if created is None:
+                        return self._error(404, "Not found.")
+                    created["uris"].extend(uris)
+                    created["snapshot"] += 1
+                    snapshot = created["snapshot"]
+                return self._send(201, {"snapshot_id": f"snapshot{snapshot}"})
+
+        return self._error(404, "Not found")
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def _handle(self, method: str) -> None:
+        try:
+            self._route(method)
+        except Exception as e:
+            self._error(500, f"{type(e).__name__}: {e}")
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic playlists through a local stand-in for the Spotify Web API")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--playlists", type=int, default=20, help="How many synthetic playlists the user has")
+    parser.add_argument("--tracks-per-playlist", type=int, default=500, help="How many tracks each synthetic playlist has")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each request")
+    parser.add_argument("--rate-limit", type=float, default=None, help="Requests per second before answering 429 with Retry-After")
+    parser.add_argument("--miss-rate", type=float, default=0.1, help="Share of searches that find nothing")
+    args = parser.parse_args()
+
+    server = FakeSpotifyServer(args.playlists, args.tracks_per_playlist, port=args.port, latency=args.latency, rate_limit=args.rate_limit, miss_rate=args.miss_rate)
+    print(f"Serving {args.playlists} playlists of {args.tracks_per_playlist} tracks at {server.url}")
+    print(f"Run with spotify_api_url={server.url} to use it")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
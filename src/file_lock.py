@@ -0,0 +1,34 @@
+import os
+import time
+from contextlib import contextmanager
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# sldl runs several downloads at once (concurrent-downloads in sldl.conf), so multiple helper processes can touch the same files at the same time
+# this is a small cross platform exclusive lock built on a sidecar lock file, the lock is released when the with block exits (or the process dies)
+@contextmanager
+def file_lock(lock_filepath: str):
+    with open(lock_filepath, "a+b") as lock_file:
+        if os.name == "nt":
+            # msvcrt.LK_LOCK gives up after ~10 seconds, so keep retrying until we actually own the lock
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,250 @@
+import json
+import os
+import secrets
+import socket
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Listener
+
+import postprocess
+import sldl_helper
+import ytdlp_pool
+from timing import TrackTimer
+
+# sldl runs its on-complete command once per track, and starting a full python interpreter that reimports everything and reopens every file for each one adds up to minutes on big playlists
+# main.py starts this daemon once per run instead. sldl then runs the tiny sldl_helper_client.py, which just forwards its arguments here over a local socket
+# events are handled concurrently on a thread pool (youtube fallbacks go on to the yt-dlp pool), but their index and log writes are committed strictly in the order they arrived
+# every event is spooled to disk before it is acknowledged, so if the daemon dies, events that weren't committed yet are replayed the next time it starts
+
+# the client finds the daemon through these environment variables, which sldl passes down to the commands it runs
+ADDRESS_ENV = "SLDL_HELPER_ADDRESS"
+AUTHKEY_ENV = "SLDL_HELPER_AUTHKEY"
+
+SPOOL_FILENAME = "helper_events.jsonl"
+DEFAULT_WORKERS = 4
+
+class HelperDaemon:
+    def __init__(self, state_dir: str, max_workers: int = DEFAULT_WORKERS, ytdlp_workers: int = ytdlp_pool.DEFAULT_WORKERS, ytdlp_timeout: float = ytdlp_pool.DEFAULT_JOB_TIMEOUT,
+                 postprocess_mode: str = postprocess.POSTPROCESS_MODE, postprocess_workers: int = postprocess.DEFAULT_WORKERS):
+        os.makedirs(state_dir, exist_ok=True)
+        sldl_helper.configure_ytdlp_pool(ytdlp_workers, ytdlp_timeout)
+        sldl_helper.configure_postprocess(postprocess_mode, postprocess_workers)
+        self.spool_filepath = os.path.join(state_dir, SPOOL_FILENAME)
+        self.authkey = secrets.token_bytes(32)
+
+        self._listener = Listener(("127.0.0.1", 0), authkey=self.authkey)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sldl-helper")
+        self._accept_thread = None
+        self._closing = False
+
+        # events get a sequence number when they arrive, finished outcomes wait in _finished until every earlier event has been committed
+        self._next_seq = 0
+        self._next_commit_seq = 0
+        self._finished = {}
+        # events whose outcome couldn't be committed at all, they stay in the spool to be replayed by the next daemon
+        self._uncommitted = {}
+        self._spool_file = None
+        self._cond = threading.Condition()
+
+    @property
+    def address(self) -> str:
+        host, port = self._listener.address
+        return f"{host}:{port}"
+
+    # returns the environment variables that let sldl_helper_client.py reach this daemon
+    def env(self) -> dict:
+        return {ADDRESS_ENV: self.address, AUTHKEY_ENV: self.authkey.hex()}
+
+    # replays anything left over from a crashed run and starts accepting connections
+    def start(self) -> None:
+        leftover_events = self._read_unfinished_spool()
+
+        # write the leftover events into a fresh spool before replacing the old one, so a second crash can't lose them
+        self._rewrite_spool(leftover_events)
+        self._spool_file = open(self.spool_filepath, "a", encoding="utf-8")
+
+        with self._cond:
+            self._next_seq = len(leftover_events)
+        for seq, args in enumerate(leftover_events):
+            self._executor.submit(self._handle, seq, sldl_helper.SldlEvent(*args), TrackTimer())
+
+        self._accept_thread = threading.Thread(target=self._accept_loop, name="sldl-helper-accept", daemon=True)
+        self._accept_thread.start()
+
+    # queues an event (the on-complete arguments), returns once it is safely on disk
+    # raises ValueError for anything that isn't a full list of on-complete arguments, before it's spooled
+    def submit(self, args: list) -> int:
+        # the track's helper span starts as soon as it arrives, so it includes any time spent waiting for a worker
+        timer = TrackTimer()
+        field_count = len(sldl_helper.SldlEvent._fields)
+        if not isinstance(args, list) or len(args) < field_count or not all(isinstance(arg, str) for arg in args[:field_count]):
+            raise ValueError(f"expected {field_count} on-complete arguments, got {args!r}")
+        event = sldl_helper.SldlEvent(*args[:field_count])
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._write_spool({"seq": seq, "args": list(event)})
+
+        self._executor.submit(self._handle, seq, event, timer)
+        return seq
+
+    # blocks until every submitted event has been committed
+    def drain(self) -> None:
+        with self._cond:
+            self._cond.wait_for(lambda: self._next_commit_seq == self._next_seq)
+
+    # stops accepting events, finishes the ones in flight and closes every open file
+    def close(self) -> None:
+        # a blocked accept() isn't interrupted by closing the listener, so wake it up with a throwaway connection
+        self._closing = True
+        if self._accept_thread is not None:
+            with socket.create_connection(self._listener.address):
+                pass
+            self._accept_thread.join()
+        self._listener.close()
+
+        self.drain()
+        self._executor.shutdown(wait=True)
+        sldl_helper.close_ytdlp_pool()
+        sldl_helper.close_postprocess_pool()
+        sldl_helper.close_contexts()
+
+        # everything else was committed, so the spool only keeps the events that couldn't be
+        with self._cond:
+            self._spool_file.close()
+            self._rewrite_spool([self._uncommitted[seq] for seq in sorted(self._uncommitted)])
+
+    def _accept_loop(self) -> None:
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                # e.g. a connection with the wrong authkey, or the wake up connection from close()
+                if self._closing:
+                    return
+                continue
+
+            if self._closing:
+                conn.close()
+                return
+
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _serve_connection(self, conn) -> None:
+        with conn:
+            try:
+                args = conn.recv()
+                try:
+                    reply = self.submit(args)
+                except ValueError as e:
+                    # sldl_helper_client.py prints this instead of handling the track itself, it would fail on the same arguments
+                    reply = {"error": str(e)}
+                conn.send(reply)
+            except (EOFError, OSError):
+                pass
+
+    # runs on a worker thread, youtube fallbacks come back as futures and are finished when the yt-dlp pool (and the post processing pool) is done with them
+    def _handle(self, seq: int, event, timer: TrackTimer) -> None:
+        try:
+            outcome = sldl_helper.handle_event(event, timer)
+        except Exception:
+            traceback.print_exc()
+            outcome = None
+
+        if isinstance(outcome, Future):
+            outcome.add_done_callback(lambda future: self._finish(seq, event, self._future_outcome(future), timer))
+        else:
+            self._finish(seq, event, outcome, timer)
+
+    @staticmethod
+    def _future_outcome(future: Future):
+        try:
+            return future.result()
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    # records a finished event and commits every outcome that is now next in line
+    # the catalog queues its rows (see MusicCatalog.add_song), so it's flushed before the committed events are marked done in the spool,
+    # otherwise a crash would lose queued rows of events that are never replayed
+    def _finish(self, seq: int, event, outcome, timer: TrackTimer) -> None:
+        with self._cond:
+            self._finished[seq] = (event, outcome, timer)
+            committed = []
+            while self._next_commit_seq in self._finished:
+                commit_seq = self._next_commit_seq
+                commit_event, commit_outcome, commit_timer = self._finished.pop(commit_seq)
+                if self._commit(commit_event, commit_outcome, commit_timer):
+                    committed.append(commit_seq)
+                else:
+                    self._uncommitted[commit_seq] = list(commit_event)
+                self._next_commit_seq += 1
+
+            if committed:
+                try:
+                    sldl_helper.get_catalog().flush()
+                except Exception:
+                    # the rows stay queued, and without done markers the events are replayed if the daemon dies before a later flush works
+                    traceback.print_exc()
+                else:
+                    for commit_seq in committed:
+                        self._write_spool({"done": commit_seq})
+            self._cond.notify_all()
+
+    # commits an outcome, returns false if nothing could be committed for the event
+    # an event whose handling raised (outcome is None) or whose commit raised gets a failed index entry and log block instead (see sldl_helper.error_outcome),
+    # only if even that fails is it left unmarked in the spool
+    @staticmethod
+    def _commit(event, outcome, timer: TrackTimer) -> bool:
+        error = "handling the track raised an exception"
+        if outcome is not None:
+            try:
+                sldl_helper.commit_outcome(event, outcome, timer)
+                return True
+            except Exception as e:
+                traceback.print_exc()
+                error = f"committing the outcome raised {e!r}"
+
+        try:
+            sldl_helper.commit_outcome(event, sldl_helper.error_outcome(event, error), TrackTimer())
+            return True
+        except Exception:
+            traceback.print_exc()
+            return False
+
+    # replaces the spool with one that holds only these events (lists of on-complete arguments), numbered from 0
+    def _rewrite_spool(self, events: list) -> None:
+        temp_filepath = self.spool_filepath + ".tmp"
+        with open(temp_filepath, "w", encoding="utf-8") as temp_file:
+            for seq, args in enumerate(events):
+                temp_file.write(json.dumps({"seq": seq, "args": args}) + "\n")
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_filepath, self.spool_filepath)
+
+    # appends a record to the spool and makes sure it hits the disk, must be called while holding _cond
+    def _write_spool(self, record: dict) -> None:
+        self._spool_file.write(json.dumps(record) + "\n")
+        self._spool_file.flush()
+        os.fsync(self._spool_file.fileno())
+
+    # returns the arguments of spooled events that were never committed
+    def _read_unfinished_spool(self) -> list:
+        if not os.path.exists(self.spool_filepath):
+            return []
+
+        received = {}
+        with open(self.spool_filepath, "r", encoding="utf-8") as spool_file:
+            for line in spool_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn last line from a crash, that event was never acknowledged
+                    continue
+                if "done" in record:
+                    received.pop(record["done"], None)
+                elif isinstance(record.get("args"), list) and len(record["args"]) >= len(sldl_helper.SldlEvent._fields):
+                    received[record["seq"]] = record["args"][:len(sldl_helper.SldlEvent._fields)]
+
+        return [received[seq] for seq in sorted(received)]
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+from file_lock import file_lock
+
+# sldl_helper.log is meant to be read by a human searching for failed downloads, so we never want the same block in it twice
+# instead of rereading and regex stripping the whole log for every track, we keep a digest of every block (with its timestamp removed) in a small sqlite table next to the log
+# checking for a duplicate is then a single primary key lookup, and the log itself is rotated by size so no single file grows without bound
+
+TIMESTAMP_PATTERN = re.compile(r"Time: \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+RECORD_TERMINATOR = "=" * 150 + "\n\n"
+
+# rotate once the log reaches this size, keeping this many old logs as sldl_helper.log.1, sldl_helper.log.2, ...
+MAX_LOG_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+# returns the digest used to detect duplicate log blocks, timestamps are removed so reruns of the same track are still caught
+def log_digest(log_contents: str) -> bytes:
+    return hashlib.blake2b(TIMESTAMP_PATTERN.sub("", log_contents).encode("utf-8"), digest_size=16).digest()
+
+class HelperLog:
+    def __init__(self, log_filepath: str, max_bytes: int = MAX_LOG_BYTES, backup_count: int = BACKUP_COUNT):
+        self.log_filepath = log_filepath
+        self.digest_db_filepath = log_filepath + ".digests.sqlite"
+        self.lock_filepath = log_filepath + ".lock"
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self._conn = None
+        self._thread_lock = threading.Lock()
+
+    # appends the new log contents to the log file unless an identical block (ignoring timestamps) was already logged, returns true if it was written
+    def append(self, log_contents: str) -> bool:
+        digest = log_digest(log_contents)
+
+        with self._thread_lock, file_lock(self.lock_filepath):
+            conn = self._connect()
+            with conn:
+                inserted = conn.execute("INSERT OR IGNORE INTO log_digests (digest) VALUES (?)", (digest,)).rowcount == 1
+                if inserted:
+                    # the digest is only committed once the block is actually in the log
+                    self._rotate_if_needed(len(log_contents.encode("utf-8")))
+                    with open(self.log_filepath, "a", encoding="utf-8") as log_file:
+                        log_file.write(log_contents)
+
+        return inserted
+
+    # returns true if the log contents (ignoring timestamps) have already been logged
+    def contains(self, log_contents: str) -> bool:
+        with self._thread_lock:
+            conn = self._connect()
+            return conn.execute("SELECT 1 FROM log_digests WHERE digest = ?", (log_digest(log_contents),)).fetchone() is not None
+
+    def close(self) -> None:
+        with self._thread_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # opens the digest database, creating it from the existing log files the first time
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+
+        conn = sqlite3.connect(self.digest_db_filepath, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        is_new = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'log_digests'").fetchone() is None
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS log_digests (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+            if is_new:
+                conn.executemany("INSERT OR IGNORE INTO log_digests (digest) VALUES (?)", ((log_digest(record),) for record in self._existing_records()))
+
+        self._conn = conn
+        return conn
+
+    # yields every block already written to the log and its rotated backups, used once to seed the digest table for logs written before it existed
+    def _existing_records(self):
+        log_filepaths = [self.log_filepath] + [f"{self.log_filepath}.{i}" for i in range(1, self.backup_count + 1)]
+        for log_filepath in log_filepaths:
+            if not os.path.exists(log_filepath):
+                continue
+
+            with open(log_filepath, "r", encoding="utf-8") as log_file:
+                record = []
+                for line in log_file:
+                    record.append(line)
+                    # every block ends with the separator line followed by a blank line
+                    if line == "\n" and len(record) >= 2 and record[-2] == RECORD_TERMINATOR[:-1]:
+                        yield "".join(record)
+                        record = []
+
+    # shifts sldl_helper.log -> sldl_helper.log.1 -> sldl_helper.log.2 ... when the next write would push it past max_bytes
+    def _rotate_if_needed(self, incoming_bytes: int) -> None:
+        if not os.path.exists(self.log_filepath) or os.path.getsize(self.log_filepath) + incoming_bytes <= self.max_bytes:
+            return
+
+        if self.backup_count <= 0:
+            os.remove(self.log_filepath)
+            return
+
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.log_filepath}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.log_filepath}.{i + 1}")
+        os.replace(self.log_filepath, f"{self.log_filepath}.1")
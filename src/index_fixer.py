@@ -1,58 +1,113 @@
 import os 
 import shutil
 import sys
+import hashlib
+import json
 
-# returns true if two index files have identical contents
-def check_index_file_equality(filepath_a: str, filepath_b: str) -> bool: 
-	are_files_equal: bool = True
+from sldl_index import SldlIndex
 
-	with open(filepath_a, "r", encoding="utf-8") as file_a:
-		with open(filepath_b, "r", encoding="utf-8") as file_b:
-			for line_a, line_b in zip(file_a, file_b):
-				# sldl swaps the state to 3 (file already exists) if ran in the same directory more than once. my script always uses 1 (successfully downloaded), so replace ,3, with ,1, just for the purposes of checking equality
-				cleaned_line_a = line_a.replace(",3,", ",1,")
-				cleaned_line_b = line_b.replace(",3,", ",1,")
-				
-				if cleaned_line_a != cleaned_line_b:
-					are_files_equal = False
-					break
+# _index_history/manifest.json maps every history file to a digest of its normalized contents
+# so checking whether the current index is already in the history is one hash of the current index plus a set lookup, instead of comparing it against every history file
+MANIFEST_FILENAME = "manifest.json"
 
-	return are_files_equal
+# returns a digest of an index file's contents
+def index_file_digest(filepath: str) -> str:
+	digest = hashlib.sha256()
+	with open(filepath, "r", encoding="utf-8") as index_file:
+		for line in index_file:
+			# sldl swaps the state to 3 (file already exists) if ran in the same directory more than once. my script always uses 1 (successfully downloaded), so replace ,3, with ,1, just for the purposes of checking equality
+			digest.update(line.replace(",3,", ",1,").encode("utf-8"))
+
+	return digest.hexdigest()
+
+# returns the {filename: digest} manifest of the history directory, hashing only files it doesn't know about yet
+# history files with identical contents are only kept once
+def load_history_manifest(history_dir: str) -> dict:
+	manifest_path = os.path.join(history_dir, MANIFEST_FILENAME)
+	manifest = {}
+	if os.path.exists(manifest_path):
+		with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+			manifest = json.load(manifest_file)
+
+	history_filenames = [filename for filename in os.listdir(history_dir) if filename != MANIFEST_FILENAME and os.path.isfile(os.path.join(history_dir, filename))]
+	# forget files that were deleted by hand
+	manifest = {filename: digest for filename, digest in manifest.items() if filename in history_filenames}
+	known_digests = set(manifest.values())
+
+	# oldest first, so the first copy of a duplicated snapshot is the one we keep
+	for filename in sorted(history_filenames, key=lambda filename: os.path.getmtime(os.path.join(history_dir, filename))):
+		if filename in manifest:
+			continue
+
+		digest = index_file_digest(os.path.join(history_dir, filename))
+		if digest in known_digests:
+			os.remove(os.path.join(history_dir, filename))
+		else:
+			manifest[filename] = digest
+			known_digests.add(digest)
+
+	return manifest
+
+def save_history_manifest(history_dir: str, manifest: dict) -> None:
+	manifest_path = os.path.join(history_dir, MANIFEST_FILENAME)
+	with open(manifest_path + ".tmp", "w", encoding="utf-8") as manifest_file:
+		json.dump(manifest, manifest_file, indent=4)
+	os.replace(manifest_path + ".tmp", manifest_path)
+
+# returns the next unused _index(n).sldl filename in the history directory
+def next_history_filename(history_dir: str) -> str:
+	number = len(os.listdir(history_dir))
+	while os.path.exists(os.path.join(history_dir, f"_index({number}).sldl")):
+		number += 1
+
+	return f"_index({number}).sldl"
 
 # the purpose of this script is to swap the automatically generated _index.sldl file with the one generated by sldl-helper.py
+#   python index_fixer.py <output dir> [<sldl's _index.sldl>...]
+# without index paths, the one playlist folder sldl created in the output dir is used. main.py batch passes the _index.sldl of every playlist folder it downloaded into
 def main():
 	CURRENT_DIR = sys.argv[1]
-	SLDL_HELPER_DIR = CURRENT_DIR + "\\sldl_helper"
-	SLDL_HELPER_INDEX_PATH = SLDL_HELPER_DIR + "\\_index.sldl"
-	SLDL_INDEX_HISTORY_DIR = SLDL_HELPER_DIR + "\\_index_history"
-	subfolder_names = [item for item in os.listdir(CURRENT_DIR) if os.path.isdir(os.path.join(CURRENT_DIR, item))]
-
-	# if the number of subfolders in the directory is 2, one is the sldl-helper directory, and the other is the directory created by sldl containing _index.sldl
-	subfolder_names = [item for item in os.listdir(CURRENT_DIR) if os.path.isdir(os.path.join(CURRENT_DIR, item))]	
-	if len(subfolder_names) == 2:
-		subfolder_names.remove('sldl_helper')
-		SLDL_INDEX_PATH = f"{CURRENT_DIR}\\{subfolder_names[0]}\\_index.sldl"
-	# if there are more than two subdirectories, we don't know which one contains _index.sldl so we need its path from the user
+	SLDL_HELPER_DIR = os.path.join(CURRENT_DIR, "sldl_helper")
+	SLDL_HELPER_INDEX_PATH = os.path.join(SLDL_HELPER_DIR, "_index.sldl")
+	SLDL_INDEX_HISTORY_DIR = os.path.join(SLDL_HELPER_DIR, "_index_history")
+
+	if len(sys.argv) > 2:
+		SLDL_INDEX_PATHS = sys.argv[2:]
 	else:
-		SLDL_INDEX_PATH = input("Could not find automatically find _index.sldl, please enter its path: ")
+		# if the number of subfolders in the directory is 2, one is the sldl-helper directory, and the other is the directory created by sldl containing _index.sldl
+		subfolder_names = [item for item in os.listdir(CURRENT_DIR) if os.path.isdir(os.path.join(CURRENT_DIR, item))]
+		if len(subfolder_names) == 2:
+			subfolder_names.remove('sldl_helper')
+			SLDL_INDEX_PATHS = [os.path.join(CURRENT_DIR, subfolder_names[0], "_index.sldl")]
+		# if there are more than two subdirectories, we don't know which one contains _index.sldl so we need its path from the user
+		else:
+			SLDL_INDEX_PATHS = [input("Could not find automatically find _index.sldl, please enter its path: ")]
 
 	# if the sldl history dir doesn't already exist, create it
 	if not os.path.exists(SLDL_INDEX_HISTORY_DIR):
 		os.mkdir(SLDL_INDEX_HISTORY_DIR)
 
-	# don't touch the index files if an identical one already exists in the history directory 
-	index_history_files = [os.path.join(SLDL_INDEX_HISTORY_DIR, filename) for filename in os.listdir(SLDL_INDEX_HISTORY_DIR) if os.path.isfile(os.path.join(SLDL_INDEX_HISTORY_DIR, filename))]
-	for history_file in index_history_files:
-		if check_index_file_equality(history_file, SLDL_INDEX_PATH) == True:
-			print("\n_index.sldl already up to date, nothing to do. Exiting...\n")
-			return
+	# sldl_helper.py appends new entries to a journal, so fold them into our _index.sldl before we copy it
+	SldlIndex(SLDL_HELPER_INDEX_PATH).compact()
+
+	history_manifest = load_history_manifest(SLDL_INDEX_HISTORY_DIR)
+	for SLDL_INDEX_PATH in SLDL_INDEX_PATHS:
+		swap_index(SLDL_INDEX_PATH, SLDL_HELPER_INDEX_PATH, SLDL_INDEX_HISTORY_DIR, history_manifest)
+	save_history_manifest(SLDL_INDEX_HISTORY_DIR, history_manifest)
 
-	NUM_INDEX_HISTORY_FILES = len(os.listdir(SLDL_INDEX_HISTORY_DIR))
+# moves sldl's _index.sldl into the history directory and copies ours into its place
+def swap_index(sldl_index_path, sldl_helper_index_path, history_dir, history_manifest):
+	# don't touch the index files if an identical one already exists in the history directory
+	current_index_digest = index_file_digest(sldl_index_path)
+	if current_index_digest in set(history_manifest.values()):
+		print(f"\n{sldl_index_path} already up to date, nothing to do.\n")
+		return
 
-	# move the old auto generated index file to the history folder, and copy ours into its place
-	shutil.move(SLDL_INDEX_PATH, f"{SLDL_INDEX_HISTORY_DIR}\\_index({NUM_INDEX_HISTORY_FILES}).sldl")
-	shutil.copy(SLDL_HELPER_INDEX_PATH, SLDL_INDEX_PATH)
-	print("\nSuccessfully swapped auto generated _index.sldl, with custom _index.sldl.\n")
+	history_filename = next_history_filename(history_dir)
+	shutil.move(sldl_index_path, os.path.join(history_dir, history_filename))
+	shutil.copy(sldl_helper_index_path, sldl_index_path)
+	history_manifest[history_filename] = current_index_digest
+	print(f"\nSuccessfully swapped auto generated {sldl_index_path}, with custom _index.sldl.\n")
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()
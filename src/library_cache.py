@@ -0,0 +1,110 @@
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+from library_scanner import DEFAULT_CHUNK_SIZE, ScanStats, extract_tags, walk_audio_files
+from music_database import DATABASE_FILEPATH
+
+# reading the tags of every file in a music directory takes minutes on a big library, so the tags are cached in the catalog database keyed by path
+# a rescan only stats each file, and only files that are new or whose mtime or size changed are read again. files that disappeared are dropped from the cache,
+# unless their directory couldn't be listed this time (e.g. a drive that isn't mounted), then they're kept until a scan that can see them
+# the walking and the (parallel) tag reading live in library_scanner.py
+
+LIBRARY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS library_files (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    duration REAL,
+    error TEXT
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS library_files_root ON library_files (root);
+'''
+
+# freshly read tags are written to the database in batches of this many files
+STORE_BATCH_SIZE = 1000
+
+LibraryTrack = namedtuple("LibraryTrack", ["path", "title", "artist", "album", "duration"])
+
+class LibraryCache:
+    def __init__(self, db_filepath: str = DATABASE_FILEPATH):
+        self.db_filepath = db_filepath
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_filepath, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.executescript(LIBRARY_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    # brings the cache for the given library roots (a path or a list of them, scanned recursively) up to date
+    # returns an iterator over every file in them that has a title and artist (see iter_tracks), use tracks() for a list
+    def scan(self, roots, workers: int = None, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        roots = [os.path.abspath(root) for root in ([roots] if isinstance(roots, str) else roots)]
+        stats = ScanStats()
+
+        with self._lock:
+            placeholders = ", ".join("?" for _ in roots)
+            cached = {path: (mtime_ns, size) for path, mtime_ns, size in self.conn.execute(f"SELECT path, mtime_ns, size FROM library_files WHERE root IN ({placeholders})", roots)}
+
+        # stat every file, only new or changed ones go to the workers, straight from the walk. whatever is left in cached afterwards wasn't found
+        failed_dirs = []
+        def changed_files():
+            for root, path, mtime_ns, size in walk_audio_files(roots, failed_dirs):
+                stats.files += 1
+                if cached.pop(path, None) != (mtime_ns, size):
+                    yield (path, root, mtime_ns, size)
+
+        # tags are written in batches as the workers return them
+        rows = []
+        for (path, root, mtime_ns, size), tags in extract_tags(changed_files(), workers, chunk_size):
+            stats.tags_read += 1
+            rows.append((path, root, mtime_ns, size, *tags))
+            if len(rows) >= STORE_BATCH_SIZE:
+                self._store(rows, [])
+                rows = []
+
+        # a file under a directory that couldn't be listed may well still be there
+        unlisted_prefixes = tuple(os.path.join(directory, "") for directory in failed_dirs)
+        self._store(rows, [path for path in cached if not path.startswith(unlisted_prefixes)])
+
+        print(stats.report())
+        return self.iter_tracks(roots)
+
+    # writes freshly read tags and drops deleted files in one transaction
+    def _store(self, rows: list, deleted_paths: list) -> None:
+        for path, _, _, _, title, artist, _, _, error in rows:
+            if error is not None:
+                print(f"Error when reading metadata of {os.path.basename(path)}: {error}")
+            elif not (title and artist):
+                # TODO: add metadata with information from spotify
+                print(f"No metadata found for {os.path.basename(path)}")
+
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO library_files (path, root, mtime_ns, size, title, artist, album, duration, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.executemany("DELETE FROM library_files WHERE path = ?", ((path,) for path in deleted_paths))
+
+    # returns the cached files under the given roots that have a title and artist
+    def tracks(self, roots) -> list:
+        return list(self.iter_tracks(roots))
+
+    # yields the cached files under the given roots that have a title and artist, straight from the database
+    def iter_tracks(self, roots):
+        roots = [os.path.abspath(root) for root in ([roots] if isinstance(roots, str) else roots)]
+        placeholders = ", ".join("?" for _ in roots)
+        reader = sqlite3.connect(self.db_filepath, timeout=30)
+        try:
+            for row in reader.execute(f"SELECT path, title, artist, album, duration FROM library_files WHERE root IN ({placeholders}) AND title IS NOT NULL AND title != '' AND artist IS NOT NULL AND artist != '' ORDER BY path", roots):
+                yield LibraryTrack(*row)
+        finally:
+            reader.close()
@@ -0,0 +1,119 @@
+import os
+import time
+import argparse
+from itertools import chain, islice
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from tinytag import TinyTag
+
+# walks any number of library roots recursively and reads the tags of audio files on a process pool
+# work is sent to the pool in chunks, with only a few chunks in flight at once, and results are yielded as they come back, so memory stays flat no matter how big the library is
+
+AUDIO_EXTENSIONS = {".mp3", ".flac", ".m4a", ".mp4", ".aac", ".ogg", ".opus", ".wav", ".aif", ".aiff", ".wma"}
+DEFAULT_CHUNK_SIZE = 64
+
+# below this many files the pool isn't worth starting, the tags are read in this process instead
+MIN_PARALLEL_FILES = 2 * DEFAULT_CHUNK_SIZE
+
+# returns the (title, artist, album, duration, error) of a file, error is None if the tags were read
+def read_tags(filepath: str) -> tuple:
+    try:
+        audio = TinyTag.get(filepath)
+        return (audio.title, audio.artist, audio.album, audio.duration, None)
+    except Exception as e:
+        return (None, None, None, None, str(e))
+
+# yields (root, path, mtime_ns, size) for every audio file under the given roots, including subdirectories
+# directories that can't be listed are printed and skipped, and added to failed_dirs if it's given, so callers can tell a missing file from an unreadable directory
+def walk_audio_files(roots: list, failed_dirs: list = None):
+    for root in roots:
+        pending_dirs = [root]
+        while pending_dirs:
+            directory = pending_dirs.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending_dirs.append(entry.path)
+                        elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS:
+                            stat = entry.stat()
+                            yield root, entry.path, stat.st_mtime_ns, stat.st_size
+            except OSError as e:
+                print(f"Could not scan {directory}: {e}")
+                if failed_dirs is not None:
+                    failed_dirs.append(directory)
+
+# reads the tags of a chunk of files, this runs in the worker processes
+def _read_tags_chunk(paths: list) -> list:
+    return [read_tags(path) for path in paths]
+
+# yields (item, fn's result for item[0]) for each item, where item[0] is a file's path and fn takes a list of paths and returns a list of results
+# fn runs on chunks of paths in a process pool (or in this process for fewer than min_parallel items), so it has to be a module level function
+# results come back in the order chunks finish, not the order they were given
+# items can be a generator (e.g. the walk), it's only read as far as the chunks in flight need, so memory stays flat however many items there are
+def map_chunks(fn, items, workers: int = None, chunk_size: int = DEFAULT_CHUNK_SIZE, min_parallel: int = MIN_PARALLEL_FILES):
+    items = iter(items)
+    # only the first min_parallel items are read up front, to decide whether the pool is worth starting
+    first_items = list(islice(items, min_parallel))
+    if len(first_items) < min_parallel or workers == 1:
+        for item in chain(first_items, items):
+            yield item, fn([item[0]])[0]
+        return
+
+    workers = workers or os.cpu_count() or 1
+    items = chain(first_items, items)
+    chunks = iter(lambda: list(islice(items, chunk_size)), [])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        for chunk in chunks:
+            in_flight[executor.submit(fn, [item[0] for item in chunk])] = chunk
+            # keep a couple of chunks queued per worker, but no more
+            if len(in_flight) >= workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from zip(in_flight.pop(future), future.result())
+
+        for future in list(in_flight):
+            yield from zip(in_flight.pop(future), future.result())
+
+# yields (item, (title, artist, album, duration, error)) for each item, where item[0] is the file's path
+def extract_tags(items, workers: int = None, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    return map_chunks(_read_tags_chunk, items, workers, chunk_size)
+
+# counts files and tag reads during a scan and reports the throughput
+class ScanStats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.files = 0
+        self.tags_read = 0
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self) -> str:
+        return f"Scanned {self.files} files ({self.tags_read} tag reads) in {self.elapsed:.2f}s, {self.files_per_second:.0f} files/s"
+
+def main():
+    # imported here because library_cache imports this module
+    from library_cache import LibraryCache
+
+    parser = argparse.ArgumentParser(description="Scan music library folders into the library cache")
+    parser.add_argument("roots", nargs="+", help="Library folders to scan, including their subfolders")
+    parser.add_argument("--workers", type=int, default=None, help="How many processes read tags (default: one per cpu)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="How many files each worker reads at a time")
+    args = parser.parse_args()
+
+    library_cache = LibraryCache()
+    try:
+        track_count = sum(1 for _ in library_cache.scan(args.roots, workers=args.workers, chunk_size=args.chunk_size))
+    finally:
+        library_cache.close()
+    print(f"{track_count} tracks with a title and artist")
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,272 @@
 import subprocess
 import os
+import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-# this file controls the flow of the program. it first calls sldl.exe using the passed in arguments
-# sldl then automatically runs sldl_helper.py for each song it downloads (or fails to download)
+import playlist_sync
+import postprocess
+import timing
+import ytdlp_pool
+from helper_daemon import DEFAULT_WORKERS, HelperDaemon
+from music_database import MusicCatalog
+
+# this file controls the flow of the program. it first starts the helper daemon and calls sldl.exe using the passed in arguments
+# sldl then automatically runs sldl_helper_client.py for each song it downloads (or fails to download), which hands the song to the daemon (see helper_daemon.py)
 # then we run index_fixer.py which updates _index.sldl to reflect songs that were successfully downloaded from yt so sldl doesn't try to download them again
+# with --sync the playlist is first diffed against the catalog and our _index.sldl, and sldl only gets the tracks we don't have yet (see playlist_sync.py)
+# how long every track and stage took is recorded in <output>/sldl_helper/timings.jsonl, `main.py report <output dir>` summarizes it (see timing.py)
+# `main.py batch` downloads several playlists (or all of yours) into one output directory, with several sldl runs at once (see batch() below)
+# every run gets its own copy of sldl.conf in <output>/sldl_helper/, so runs at the same time never change each other's config
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+# sldl's own default when sldl.conf doesn't set concurrent-downloads
+SLDL_DEFAULT_CONCURRENT_DOWNLOADS = 2
+DEFAULT_CONCURRENT_RUNS = 3
 
 def main():
+	# subcommands are checked before the download arguments are parsed, the first positional argument is otherwise the playlist url
+	if len(sys.argv) > 1 and sys.argv[1] == "report":
+		return report(sys.argv[2:])
+	if len(sys.argv) > 1 and sys.argv[1] == "batch":
+		return batch(sys.argv[2:])
+
 	# initialize the arg parser
 	parser = argparse.ArgumentParser(description="A tool to download Spotify playlists using SoulSeek and SLDL")
 	parser.add_argument("pos_playlist_url", nargs="?", help="The URL of the Spotify playlist to download")
 	parser.add_argument("--playlist-url", dest="playlist_url", help="The URL of the Spotify playlist to download")
 	parser.add_argument("pos_output_path", nargs="?", default=os.getcwd(), help="The output directory in which your files will be downloaded")
 	parser.add_argument("--output-path", dest="output_path", help="The output directory in which your files will be downloaded")
+	add_run_arguments(parser)
+	parser.add_argument("--no-daemon", action="store_true", help="Run sldl_helper.py in a new process for every track instead of using the helper daemon")
+	parser.add_argument("--sync", action="store_true", help="Only hand sldl the tracks of the playlist that aren't already downloaded, the others are written straight to the index")
 
-	# path config is all relative to the path of this file
-	SLDL_EXE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../bin/sldl.exe")
-	SLDL_CONF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../assets/sldl.conf")
-	INDEX_FIXER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index_fixer.py")
-
-	# parse the arguments and update sldl.conf with the output path
+	# parse the arguments, path config is all relative to the path of this file unless overridden
 	args = parser.parse_args()
+	SLDL_EXE_PATH = args.sldl_path or os.path.join(SRC_DIR, "../bin/sldl.exe")
+	SLDL_CONF_PATH = args.sldl_conf or os.path.join(SRC_DIR, "../assets/sldl.conf")
+
+	# write this run's sldl.conf with the output path
 	PLAYLIST_URL = args.playlist_url or args.pos_playlist_url
 	OUTPUT_PATH = os.path.abspath(args.output_path or args.pos_output_path)
-	os.makedirs(OUTPUT_PATH, exist_ok=True)
-	update_sldl_conf(OUTPUT_PATH, SLDL_CONF_PATH)
+	os.makedirs(os.path.join(OUTPUT_PATH, "sldl_helper"), exist_ok=True)
+	RUN_CONF_PATH = os.path.join(OUTPUT_PATH, "sldl_helper", "sldl.conf")
+	write_sldl_conf(SLDL_CONF_PATH, RUN_CONF_PATH, OUTPUT_PATH)
 
 	if not PLAYLIST_URL:
 		parser.error("The playlist URL is required")
 
-	# create and run the commands 
-	sldl_command = [SLDL_EXE_PATH, PLAYLIST_URL, "--path", OUTPUT_PATH, "--profile", "spotify-likes", "--config", SLDL_CONF_PATH]
-	index_fixer_command = ["python", INDEX_FIXER_PATH, OUTPUT_PATH]
-	subprocess.run(sldl_command)
-	subprocess.run(index_fixer_command)
+	trace = start_run(OUTPUT_PATH, args)
+
+	with trace.span("run"):
+		# sldl gets a csv of the missing tracks instead of the playlist url, if nothing is missing there's nothing to download
+		SLDL_INPUT = PLAYLIST_URL
+		if args.sync:
+			with trace.span("sync"):
+				SLDL_INPUT = playlist_sync.prepare_sync(PLAYLIST_URL, OUTPUT_PATH)
+			if SLDL_INPUT is None:
+				print("\nEvery track of the playlist is already downloaded or waiting to be retried later, nothing to do.\n")
+				return
+
+		# create and run the commands
+		sldl_command = sldl_run_command(SLDL_EXE_PATH, SLDL_INPUT, OUTPUT_PATH, RUN_CONF_PATH)
+
+		# the daemon has to finish every track sldl handed it before index_fixer.py swaps the index files
+		if args.no_daemon:
+			with trace.span("sldl"):
+				subprocess.run(sldl_command)
+		else:
+			helper_daemon = start_helper_daemon(OUTPUT_PATH, args)
+			try:
+				with trace.span("sldl"):
+					subprocess.run(sldl_command, env={**os.environ, **helper_daemon.env()})
+			finally:
+				helper_daemon.close()
+
+		with trace.span("index_fixer"):
+			subprocess.run(["python", os.path.join(SRC_DIR, "index_fixer.py"), OUTPUT_PATH])
+
+# downloads several playlists into one output directory: every playlist is planned like --sync, and up to --concurrent-runs sldl runs download at once
+#   - all runs share one helper daemon, so they write to the same catalog, _index.sldl and yt-dlp and post processing pools
+#   - a track missing from several playlists is only handed to the first playlist's run, the others get their index entry once every run has finished
+#   - --download-budget is the number of downloads at once across every run, each run gets an equal share of it as its concurrent-downloads
+#   - index_fixer.py then copies the shared _index.sldl into every playlist folder, so later runs of any playlist skip tracks another playlist already downloaded
+def batch(argv):
+	parser = argparse.ArgumentParser(prog="main.py batch", description="Download several Spotify playlists into one output directory, with several sldl runs at once")
+	parser.add_argument("playlist_urls", nargs="*", help="The URLs of the Spotify playlists to download")
+	parser.add_argument("--playlists-file", help="A file with one playlist URL per line, lines starting with # are skipped")
+	parser.add_argument("--all", action="store_true", help="Download every playlist of your Spotify account")
+	parser.add_argument("--output-path", default=os.getcwd(), help="The output directory in which your files will be downloaded")
+	parser.add_argument("--concurrent-runs", type=int, default=DEFAULT_CONCURRENT_RUNS, help="How many sldl runs download at once")
+	parser.add_argument("--download-budget", type=int, default=None, help="How many downloads may run at once across every sldl run (default: concurrent-downloads from sldl.conf)")
+	add_run_arguments(parser)
+	args = parser.parse_args(argv)
+
+	playlist_urls = batch_playlist_urls(args)
+	if not playlist_urls:
+		parser.error("Pass playlist URLs, --playlists-file or --all")
+
+	SLDL_EXE_PATH = args.sldl_path or os.path.join(SRC_DIR, "../bin/sldl.exe")
+	SLDL_CONF_PATH = args.sldl_conf or os.path.join(SRC_DIR, "../assets/sldl.conf")
+	OUTPUT_PATH = os.path.abspath(args.output_path)
+	os.makedirs(os.path.join(OUTPUT_PATH, "sldl_helper", "configs"), exist_ok=True)
+
+	# the budget is split evenly, and there are never more runs at once than downloads in the budget
+	budget = args.download_budget or read_concurrent_downloads(SLDL_CONF_PATH)
+	concurrent_runs = max(min(args.concurrent_runs, len(playlist_urls), budget), 1)
+	downloads_per_run = max(budget // concurrent_runs, 1)
+	print(f"Downloading {len(playlist_urls)} playlists, {concurrent_runs} sldl runs at once with {downloads_per_run} downloads each\n")
+
+	trace = start_run(OUTPUT_PATH, args)
+	with trace.span("run"):
+		helper_daemon = start_helper_daemon(OUTPUT_PATH, args)
+		sync_batch = playlist_sync.SyncBatch()
+		try:
+			# playlists are planned one after the other (they share the spotify rate limit), and each run starts as soon as its playlist is planned
+			with ThreadPoolExecutor(max_workers=concurrent_runs, thread_name_prefix="sldl-run") as executor:
+				runs = []
+				for number, playlist_url in enumerate(playlist_urls):
+					try:
+						with trace.span("sync", playlist=playlist_url):
+							sldl_input = playlist_sync.prepare_sync(playlist_url, OUTPUT_PATH, batch=sync_batch)
+					except Exception as e:
+						print(f"Could not plan {playlist_url}: {e}")
+						continue
+					if sldl_input is None:
+						continue
+
+					conf_path = os.path.join(OUTPUT_PATH, "sldl_helper", "configs", f"sldl_{number}.conf")
+					write_sldl_conf(SLDL_CONF_PATH, conf_path, OUTPUT_PATH, downloads_per_run)
+					sldl_command = sldl_run_command(SLDL_EXE_PATH, sldl_input, OUTPUT_PATH, conf_path)
+					runs.append(executor.submit(run_sldl, trace, playlist_url, sldl_command, helper_daemon.env()))
+
+				for run in runs:
+					run.result()
+		finally:
+			helper_daemon.close()
 
-# this function updates the on-complete line in sldl.conf to pass in the user specified output path to sldl_helper.py
-def update_sldl_conf(new_output_path, sldl_conf_path):
+		# tracks that were downloaded for another playlist of the batch are present now
+		with trace.span("record_synced"):
+			record_batch(playlist_urls, OUTPUT_PATH)
+
+		index_paths = playlist_index_paths(OUTPUT_PATH)
+		if index_paths:
+			with trace.span("index_fixer"):
+				subprocess.run(["python", os.path.join(SRC_DIR, "index_fixer.py"), OUTPUT_PATH, *index_paths])
+
+# returns the playlist urls of a batch in order, without duplicates
+def batch_playlist_urls(args):
+	playlist_urls = list(args.playlist_urls)
+	if args.playlists_file:
+		with open(args.playlists_file, "r", encoding="utf-8") as playlists_file:
+			playlist_urls += [line.strip() for line in playlists_file if line.strip() and not line.strip().startswith("#")]
+	if args.all:
+		# imported here so the other modes don't need spotify credentials to start
+		import spotify
+		playlist_urls += [f"https://open.spotify.com/playlist/{playlist['id']}" for playlist in spotify.get_all_playlists()]
+	return list(dict.fromkeys(playlist_urls))
+
+def run_sldl(trace, playlist_url, sldl_command, daemon_env):
+	with trace.span("sldl", playlist=playlist_url):
+		subprocess.run(sldl_command, env={**os.environ, **daemon_env})
+
+def record_batch(playlist_urls, output_path):
+	catalog = MusicCatalog()
+	try:
+		for playlist_url in playlist_urls:
+			try:
+				playlist_sync.record_synced(playlist_url, output_path, catalog)
+			except Exception as e:
+				print(f"Could not record the tracks of {playlist_url}: {e}")
+	finally:
+		catalog.close()
+
+# returns the _index.sldl of every playlist folder sldl created in the output directory
+def playlist_index_paths(output_path):
+	index_paths = []
+	for item in sorted(os.listdir(output_path)):
+		index_path = os.path.join(output_path, item, "_index.sldl")
+		if item != "sldl_helper" and os.path.isfile(index_path):
+			index_paths.append(index_path)
+	return index_paths
+
+# the arguments a single run and a batch share
+def add_run_arguments(parser):
+	parser.add_argument("--helper-workers", type=int, default=DEFAULT_WORKERS, help="How many tracks the helper daemon processes at once")
+	parser.add_argument("--ytdlp-workers", type=int, default=ytdlp_pool.DEFAULT_WORKERS, help="How many youtube fallback downloads run at once")
+	parser.add_argument("--ytdlp-timeout", type=float, default=ytdlp_pool.DEFAULT_JOB_TIMEOUT, help="How many seconds a single youtube fallback download may take")
+	parser.add_argument("--postprocess", choices=postprocess.POSTPROCESS_MODES, default=postprocess.POSTPROCESS_MODE, help="How youtube fallback downloads are converted: mp3 on a separate pool (default), keep the downloaded codec, or inline in yt-dlp like before")
+	parser.add_argument("--postprocess-workers", type=int, default=postprocess.DEFAULT_WORKERS, help="How many youtube downloads are converted and tagged at once (default: one per cpu)")
+	parser.add_argument("--sldl-path", help="Use another sldl executable (or a .py script, e.g. bench/stubs/sldl_stub.py) instead of bin/sldl.exe")
+	parser.add_argument("--sldl-conf", help="Use another sldl.conf instead of assets/sldl.conf")
+
+# labels the run and returns the trace writer for its timings
+def start_run(output_path, args):
+	# every span of this run is labelled with the same run id, the helper processes and the daemon get it through the environment
+	os.environ[timing.RUN_ID_ENV] = timing.new_run_id()
+	# the helper processes of --no-daemon read the post processing mode from the environment too
+	os.environ["postprocess_mode"] = args.postprocess
+	os.makedirs(os.path.join(output_path, "sldl_helper"), exist_ok=True)
+	return timing.TraceWriter(os.path.join(output_path, "sldl_helper", timing.TRACE_FILENAME))
+
+def start_helper_daemon(output_path, args):
+	helper_daemon = HelperDaemon(os.path.join(output_path, "sldl_helper"), max_workers=args.helper_workers, ytdlp_workers=args.ytdlp_workers, ytdlp_timeout=args.ytdlp_timeout, postprocess_mode=args.postprocess, postprocess_workers=args.postprocess_workers)
+	helper_daemon.start()
+	return helper_daemon
+
+def sldl_run_command(sldl_exe_path, sldl_input, output_path, sldl_conf_path):
+	return ([sys.executable] if sldl_exe_path.endswith(".py") else []) + [sldl_exe_path, sldl_input, "--path", output_path, "--profile", "spotify-likes", "--config", sldl_conf_path]
+
+# prints the timing summary of a run: percentiles per stage, tracks per minute and the slowest tracks
+def report(argv):
+	parser = argparse.ArgumentParser(prog="main.py report", description="Summarize how long the tracks and stages of a run took")
+	parser.add_argument("path", nargs="?", default=os.getcwd(), help="The output directory of the run, or its timings.jsonl")
+	parser.add_argument("--run", help="The id of the run to summarize (default: the latest run)")
+	parser.add_argument("--top", type=int, default=10, help="How many of the slowest tracks to list")
+	args = parser.parse_args(argv)
+
+	trace_filepath = args.path if os.path.isfile(args.path) else os.path.join(args.path, "sldl_helper", timing.TRACE_FILENAME)
+	if not os.path.exists(trace_filepath):
+		parser.error(f"No timings found at {trace_filepath}")
+	print(timing.report(trace_filepath, args.run, args.top))
+
+# returns concurrent-downloads from sldl.conf
+def read_concurrent_downloads(sldl_conf_path):
+	with open(sldl_conf_path, "r", encoding="utf-8") as conf_file:
+		for line in conf_file:
+			name, _, value = line.partition("=")
+			if name.strip() == "concurrent-downloads" and value.strip().isdigit():
+				return int(value.strip())
+	return SLDL_DEFAULT_CONCURRENT_DOWNLOADS
+
+# writes a copy of sldl.conf for one run, with the output path added to the on-complete line (sldl_helper.py needs it), and concurrent-downloads replaced if given
+# sldl.conf itself is never changed, so several runs can use it at once
+def write_sldl_conf(sldl_conf_path, run_conf_path, output_path, concurrent_downloads=None):
 
 	with open(sldl_conf_path, "r", encoding="utf-8") as conf_file:
 		lines = conf_file.readlines()
 
 	# we want to modify the line in sldl.conf that starts with 'on-complete = s:python'
-	sldl_helper_line = next((line for line in lines if line.startswith('on-complete = s:python')), None).split(" ")
-	if sldl_helper_line is None:
-		raise Exception('Could not find the correct on-complete line in sldl.conf. Please add the following line to your sldl.conf: on-complete = s:python "your-path-to\sldl_helper.py" "{path}" "{title}" "{artist}" "{album}" "{uri}" "{length}" "{failure-reason}" "{state}"')
+	on_complete_index = next((i for i, line in enumerate(lines) if line.startswith('on-complete = s:python')), None)
+	if on_complete_index is None:
+		raise Exception('Could not find the correct on-complete line in sldl.conf. Please add the following line to your sldl.conf: on-complete = s:python "your-path-to\\sldl_helper_client.py" "{path}" "{title}" "{artist}" "{album}" "{uri}" "{length}" "{failure-reason}" "{state}"')
+	sldl_helper_line = lines[on_complete_index].rstrip("\n").split(" ")
 
-	new_lines = lines
-
-	# if the final item on that line is state, we have not modified sldl.conf, so we need to add the output path to the line, otherwise we want to swap the old path for the new one
-	if sldl_helper_line[-1] == '"{state}"\n':
-		sldl_helper_line[-1] = sldl_helper_line[-1].replace('\n', "")
-		new_sldl_helper_line = sldl_helper_line + [f'"{new_output_path}"\n']
-		new_lines[-1] = " ".join(new_sldl_helper_line)
+	# if the final item on that line is state, the output path still needs to be added, otherwise (a sldl.conf changed by an older version of this script) we swap the old path for the new one
+	if sldl_helper_line[-1] == '"{state}"':
+		sldl_helper_line.append(f'"{output_path}"')
 	else:
-		sldl_helper_line[-1] = f'"{new_output_path}"\n'
-		new_lines[-1] = " ".join(sldl_helper_line)
+		sldl_helper_line[-1] = f'"{output_path}"'
+	lines[on_complete_index] = " ".join(sldl_helper_line) + "\n"
+
+	# concurrent-downloads is a global setting, so it goes before the first [profile] section
+	if concurrent_downloads is not None:
+		lines = [line for line in lines if line.partition("=")[0].strip() != "concurrent-downloads"]
+		first_section = next((i for i, line in enumerate(lines) if line.startswith("[")), len(lines))
+		lines.insert(first_section, f"concurrent-downloads = {concurrent_downloads}\n")
 
-	# write back the new lines
-	with open(sldl_conf_path, "w", encoding="utf-8") as conf_file:
-		conf_file.writelines(new_lines)
+	with open(run_conf_path, "w", encoding="utf-8") as conf_file:
+		conf_file.writelines(lines)
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()
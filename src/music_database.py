@@ -1,36 +1,299 @@
 import sqlite3
 import os
+import csv
+import re
+import sys
+import time
+import argparse
+import threading
 
-DATABASE_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../assets/all_music.sqlite")
+from sldl_index import FAILED_STATE, INDEX_HEADER, JOURNAL_SUFFIX, sanitize_index_fields
+from text_normalize import normalize_text
 
-def main():
-    add_song_to_db("D:/penis.flac", "penis", "the balls", "cock chronicles", 69420, "spotifyuri")
-    
-def add_song_to_db(filepath, title, artist, album, length, uri):
-    conn = sqlite3.connect(DATABASE_FILEPATH)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS all_music (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        filepath TEXT NOT NULL UNIQUE,
-        title TEXT,
-        artist TEXT,
-        album TEXT,
-        length INTEGER,
-        uri TEXT
-    )
-    ''')
+# the local catalog of all our music, shared by every output directory
+# all_music holds the files we have (with their spotify uri when we know it), sldl_index mirrors the entries of every _index.sldl we've written
+# one long lived connection in WAL mode is used per process, and writes are buffered and flushed in batches inside a single transaction
+
+# the music_database environment variable points everything at another catalog, e.g. a throwaway one for the benchmarks
+DATABASE_FILEPATH = os.getenv("music_database") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "../assets/all_music.sqlite")
+BATCH_SIZE = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS all_music (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filepath TEXT NOT NULL UNIQUE,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    length INTEGER,
+    uri TEXT
+);
+
+CREATE TABLE IF NOT EXISTS sldl_index (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    artist TEXT NOT NULL,
+    album TEXT NOT NULL,
+    title TEXT NOT NULL,
+    filepath TEXT NOT NULL,
+    length INTEGER,
+    tracktype INTEGER NOT NULL DEFAULT 0,
+    state INTEGER NOT NULL,
+    failure_reason INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    UNIQUE (artist, album, title)
+);
+'''
+
+# columns added to all_music after the first version of the database
+ALL_MUSIC_MIGRATIONS = {
+    "norm_artist": "ALTER TABLE all_music ADD COLUMN norm_artist TEXT",
+    "norm_title": "ALTER TABLE all_music ADD COLUMN norm_title TEXT",
+}
+
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS all_music_uri ON all_music (uri);
+CREATE INDEX IF NOT EXISTS all_music_norm_artist_title ON all_music (norm_artist, norm_title);
+'''
+
+# a new file replaces the metadata of an existing row with the same path, but an unknown uri never erases a known one
+UPSERT_SONG_SQL = '''
+INSERT INTO all_music (filepath, title, artist, album, length, uri, norm_artist, norm_title) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (filepath) DO UPDATE SET
+    title = excluded.title,
+    artist = excluded.artist,
+    album = COALESCE(NULLIF(excluded.album, ''), all_music.album),
+    length = COALESCE(excluded.length, all_music.length),
+    uri = COALESCE(NULLIF(excluded.uri, ''), all_music.uri),
+    norm_artist = excluded.norm_artist,
+    norm_title = excluded.norm_title
+'''
+
+# same supersede rules as sldl_index.py: a failed attempt (state 2) never replaces a successful entry
+UPSERT_INDEX_SQL = f'''
+INSERT INTO sldl_index (artist, album, title, filepath, length, tracktype, state, failure_reason, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (artist, album, title) DO UPDATE SET
+    filepath = excluded.filepath,
+    length = excluded.length,
+    tracktype = excluded.tracktype,
+    state = excluded.state,
+    failure_reason = excluded.failure_reason,
+    updated_at = excluded.updated_at
+WHERE excluded.state != {FAILED_STATE} OR sldl_index.state = {FAILED_STATE}
+'''
+
+LOG_FIELD_PATTERN = re.compile(r"^(Title|Artist|Spotify URI|Filepath): (.*)$")
+
+class MusicCatalog:
+    def __init__(self, db_filepath: str = DATABASE_FILEPATH, batch_size: int = BATCH_SIZE):
+        self.db_filepath = db_filepath
+        self.batch_size = batch_size
+        self._lock = threading.RLock()
+        self._pending_songs = []
+        self._pending_index_entries = []
+
+        self.conn = sqlite3.connect(db_filepath, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self) -> None:
+        with self._lock, self.conn:
+            self.conn.executescript(SCHEMA)
+            existing_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(all_music)")}
+            missing_columns = [column for column in ALL_MUSIC_MIGRATIONS if column not in existing_columns]
+            for column in missing_columns:
+                self.conn.execute(ALL_MUSIC_MIGRATIONS[column])
+
+            # rows from before the normalized columns existed need them filled in once
+            if missing_columns:
+                rows = self.conn.execute("SELECT id, artist, title FROM all_music").fetchall()
+                self.conn.executemany("UPDATE all_music SET norm_artist = ?, norm_title = ? WHERE id = ?", ((normalize_text(artist), normalize_text(title), row_id) for row_id, artist, title in rows))
+
+            self.conn.executescript(INDEXES)
+
+    # queues a downloaded file, it's written with the next batch
+    def add_song(self, filepath, title, artist, album, length, uri) -> None:
+        length = int(length) if isinstance(length, int) or (isinstance(length, str) and length.isdigit()) else None
+        with self._lock:
+            self._pending_songs.append((filepath, title, artist, album, length, uri, normalize_text(artist), normalize_text(title)))
+            if len(self._pending_songs) >= self.batch_size:
+                self.flush()
+
+    # queues an _index.sldl entry, the values are sanitized the same way the index file is
+    def add_index_entry(self, filepath, artist, album, title, length, state=None, failure_reason=None, tracktype=0) -> None:
+        filepath, artist, album, title, length = sanitize_index_fields(filepath, artist, album, title, length)
+        if state is None:
+            state, failure_reason = (2, 3) if filepath == "" else (1, 0)
+
+        with self._lock:
+            self._pending_index_entries.append((artist, album, title, filepath, length, int(tracktype), int(state), int(failure_reason or 0), time.time()))
+            if len(self._pending_index_entries) >= self.batch_size:
+                self.flush()
+
+    # writes every queued row in one transaction
+    def flush(self) -> None:
+        with self._lock:
+            if not self._pending_songs and not self._pending_index_entries:
+                return
+
+            with self.conn:
+                self.conn.executemany(UPSERT_SONG_SQL, self._pending_songs)
+                self.conn.executemany(UPSERT_INDEX_SQL, self._pending_index_entries)
+            self._pending_songs = []
+            self._pending_index_entries = []
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self.conn.close()
+
+    # points the rows of files that were removed at the file that replaced them, moves is {old filepath: new filepath}
+    # if the new file already has a row it's kept, and only takes over the uri of the old one if it didn't know its own
+    def replace_filepaths(self, moves: dict) -> None:
+        with self._lock:
+            self.flush()
+            with self.conn:
+                for old_filepath, new_filepath in moves.items():
+                    if self.conn.execute("SELECT 1 FROM all_music WHERE filepath = ?", (new_filepath,)).fetchone():
+                        self.conn.execute("UPDATE all_music SET uri = COALESCE(NULLIF(uri, ''), (SELECT uri FROM all_music WHERE filepath = ?)) WHERE filepath = ?", (old_filepath, new_filepath))
+                        self.conn.execute("DELETE FROM all_music WHERE filepath = ?", (old_filepath,))
+                    else:
+                        self.conn.execute("UPDATE all_music SET filepath = ? WHERE filepath = ?", (new_filepath, old_filepath))
+                    # index entries are sanitized like the _index.sldl lines
+                    self.conn.execute("UPDATE sldl_index SET filepath = ? WHERE filepath = ?", (sanitize_index_fields(new_filepath, "", "", "", "")[0], sanitize_index_fields(old_filepath, "", "", "", "")[0]))
 
+    # returns the (filepath, title, artist, album, length, uri) rows for a spotify uri
+    def find_by_uri(self, uri: str) -> list:
+        with self._lock:
+            self.flush()
+            return self.conn.execute("SELECT filepath, title, artist, album, length, uri FROM all_music WHERE uri = ?", (uri,)).fetchall()
+
+    # returns the (filepath, title, artist, album, length, uri) rows whose normalized artist and title match
+    def find_by_artist_title(self, artist: str, title: str) -> list:
+        with self._lock:
+            self.flush()
+            return self.conn.execute("SELECT filepath, title, artist, album, length, uri FROM all_music WHERE norm_artist = ? AND norm_title = ?", (normalize_text(artist), normalize_text(title))).fetchall()
+
+    # yields every _index.sldl line (without the trailing newline) straight from a cursor, so the whole index is never held in memory
+    def iter_index_lines(self):
+        with self._lock:
+            self.flush()
+            # a separate cursor on a read snapshot, so writers on other threads aren't blocked while we stream
+            reader = sqlite3.connect(self.db_filepath, timeout=30)
+
+        try:
+            for filepath, artist, album, title, length, tracktype, state, failure_reason in reader.execute("SELECT filepath, artist, album, title, length, tracktype, state, failure_reason FROM sldl_index ORDER BY id"):
+                yield f'"{filepath}","{artist}","{album}","{title}",{length},{tracktype},{state},{failure_reason}'
+        finally:
+            reader.close()
+
+    # writes an _index.sldl file generated from the catalog, replacing the old one atomically
+    def export_sldl_index(self, index_filepath: str) -> int:
+        count = 0
+        with open(index_filepath + ".tmp", "w", encoding="utf-8") as index_file:
+            index_file.write(INDEX_HEADER)
+            for line in self.iter_index_lines():
+                index_file.write(line + "\n")
+                count += 1
+        os.replace(index_filepath + ".tmp", index_filepath)
+        return count
+
+    # imports every entry of an _index.sldl file (and its journal, if there is one) in one pass
+    def import_sldl_index(self, index_filepath: str) -> int:
+        count = 0
+        for filepath in (index_filepath, index_filepath + JOURNAL_SUFFIX):
+            if not os.path.exists(filepath):
+                continue
+
+            with open(filepath, "r", encoding="utf-8", newline="") as index_file:
+                for row in csv.reader(index_file):
+                    # skip the header and anything that isn't a full entry
+                    if len(row) < 8 or not row[6].isdigit():
+                        continue
+
+                    song_filepath, artist, album, title, length, tracktype, state, failure_reason = row[:8]
+                    self.add_index_entry(song_filepath, artist, album, title, length, state, failure_reason if failure_reason.isdigit() else 0, tracktype if tracktype.isdigit() else 0)
+                    if song_filepath != "" and state != FAILED_STATE:
+                        self.add_song(song_filepath, title, artist, album, length, "")
+                    count += 1
+
+        return count
+
+    # imports the spotify uri of every successful download in an sldl_helper.log
+    def import_helper_log(self, log_filepath: str) -> int:
+        count = 0
+        with open(log_filepath, "r", encoding="utf-8", errors="replace") as log_file:
+            fields = {}
+            for line in log_file:
+                match = LOG_FIELD_PATTERN.match(line.rstrip("\n"))
+                if match:
+                    fields[match.group(1)] = match.group(2)
+                # every block ends with the separator line
+                elif line.startswith("=" * 150):
+                    filepath = fields.get("Filepath", "").strip("'")
+                    if filepath:
+                        self.add_song(filepath, fields.get("Title", ""), fields.get("Artist", ""), "", None, fields.get("Spotify URI", ""))
+                        count += 1
+                    fields = {}
+
+        return count
+
+    # walks the given files and directories and imports every index file and helper log it finds
+    # logs are imported after the index files so their uris are added to rows that already have an album and length
+    def bulk_import(self, paths: list) -> tuple:
+        index_filepaths = []
+        log_filepaths = []
+        for path in paths:
+            candidates = [path] if os.path.isfile(path) else [os.path.join(root, filename) for root, _, filenames in os.walk(path) for filename in filenames]
+            for candidate in candidates:
+                filename = os.path.basename(candidate)
+                if filename.endswith(".sldl"):
+                    index_filepaths.append(candidate)
+                elif filename.startswith("sldl_helper.log") and not filename.endswith((".sqlite", ".lock", "-wal", "-shm")):
+                    log_filepaths.append(candidate)
+
+        # one transaction for the whole import
+        with self._lock:
+            batch_size = self.batch_size
+            self.batch_size = sys.maxsize
+            try:
+                index_count = sum(self.import_sldl_index(filepath) for filepath in index_filepaths)
+                log_count = sum(self.import_helper_log(filepath) for filepath in log_filepaths)
+                self.flush()
+            finally:
+                self.batch_size = batch_size
+
+        return index_count, log_count
+
+def add_song_to_db(filepath, title, artist, album, length, uri):
+    catalog = MusicCatalog()
     try:
-        song_data = (filepath, title, artist, album, length, uri)
-        cursor.execute("INSERT INTO all_music (filepath, title, artist, album, length, uri) VALUES (?, ?, ?, ?, ?, ?)", song_data)
-        conn.commit()
-    except sqlite3.IntegrityError:
-        print("Error: a song with this filepath already exists in the database.")
+        catalog.add_song(filepath, title, artist, album, length, uri)
     finally:
-        conn.close()
+        catalog.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the local music catalog")
+    parser.add_argument("--database", default=DATABASE_FILEPATH, help="Path of the catalog database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Backfill the catalog from existing _index.sldl files and sldl_helper logs")
+    import_parser.add_argument("paths", nargs="+", help="Index files, log files, or directories to search for them")
+
+    export_parser = subparsers.add_parser("export", help="Generate an _index.sldl file from the catalog")
+    export_parser.add_argument("index_filepath", help="Where to write the _index.sldl file")
 
+    args = parser.parse_args()
+    catalog = MusicCatalog(args.database)
+    try:
+        if args.command == "import":
+            index_count, log_count = catalog.bulk_import(args.paths)
+            print(f"Imported {index_count} index entries and {log_count} log entries")
+        elif args.command == "export":
+            count = catalog.export_sldl_index(args.index_filepath)
+            print(f"Wrote {count} entries to {args.index_filepath}")
+    finally:
+        catalog.close()
 
 if __name__ == "__main__":
-    add_song_to_db("D:/penis.flac", "penis", "the balls", "cock chronicles", 69420, "spotifyuri")
+    main()
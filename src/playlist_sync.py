@@ -0,0 +1,168 @@
+import os
+import re
+import csv
+from collections import namedtuple
+
+import spotify
+from failure_ledger import FailureLedger
+from music_database import MusicCatalog
+from sldl_index import FAILED_STATE, SldlIndex, format_index_entry
+from text_normalize import normalize_text
+
+# main.py --sync: instead of handing sldl the playlist url (which makes it search soulseek for every track), the playlist is fetched and diffed against what we already have
+# a track is already present if its file still exists and it's found in the catalog (by spotify uri, then by normalized artist and title) or has a successful entry in the custom _index.sldl
+# present tracks are written straight to the custom _index.sldl (and the catalog), and only the missing ones are written to a csv file that sldl gets as its input instead of the url
+# missing tracks that keep failing are left out until their backoff in the failure ledger expires, and retries that failed the fewest times go first (see failure_ledger.py)
+#
+# sldl names the folder it downloads into after its input, so the csv is named after the playlist and the downloads end up in the same folder a full run would use
+# the artist used for both is the first spotify artist, which is what soulseek filenames usually contain
+# main.py batch plans every playlist of the batch through one SyncBatch, so a track that is missing from several playlists is only handed to the first playlist's sldl run,
+# and once every run has finished record_synced writes it to the index for the other playlists too
+
+PLAYLIST_URL_PATTERN = re.compile(r"(?:open\.spotify\.com/(?:[\w-]+/)?playlist/|spotify:playlist:)([A-Za-z0-9]+)")
+SYNC_DIRNAME = "sync"
+CSV_HEADER = ["Artist", "Album", "Title", "Length"]
+
+# artists holds every artist of the track, artist is the one used in the index and the sldl input
+SyncTrack = namedtuple("SyncTrack", ["uri", "artist", "album", "title", "length", "artists"])
+# present is a list of (SyncTrack, filepath), missing a list of SyncTrack
+SyncPlan = namedtuple("SyncPlan", ["present", "missing"])
+
+# the tracks and csv filenames already handed out to the runs of a batch
+class SyncBatch:
+    def __init__(self):
+        self.claimed = set()
+        self.csv_filenames = set()
+
+    # returns the tracks no earlier playlist of the batch downloads and claims them, the same song from another album counts as the same track
+    def claim(self, tracks: list) -> list:
+        unclaimed = []
+        for track in tracks:
+            key = (normalize_text(track.artist), normalize_text(track.title))
+            if key not in self.claimed:
+                self.claimed.add(key)
+                unclaimed.append(track)
+        return unclaimed
+
+    # playlists with the same name would write (and sldl would download into) the same folder, so later ones get their id appended
+    def csv_filename(self, playlist_name: str, playlist_id: str) -> str:
+        filename = spotify.safe_playlist_filename(playlist_name)
+        if filename.lower() in self.csv_filenames:
+            filename = spotify.safe_playlist_filename(f"{playlist_name} {playlist_id}")
+        self.csv_filenames.add(filename.lower())
+        return filename
+
+# returns the playlist id of a spotify playlist url or uri, or None if it isn't one
+def playlist_id_from_url(playlist_url: str):
+    match = PLAYLIST_URL_PATTERN.search(playlist_url)
+    return match.group(1) if match else None
+
+def sync_track(item: dict) -> SyncTrack:
+    track = item["track"]
+    artists = [artist["name"] for artist in track.get("artists") or [] if artist.get("name")]
+    length = str(round((track.get("duration_ms") or 0) / 1000)) if track.get("duration_ms") else ""
+    return SyncTrack(track.get("uri") or "", artists[0] if artists else "", (track.get("album") or {}).get("name") or "", track.get("name") or "", length, artists)
+
+# returns the filepath of a successful index entry, or None
+def _index_filepath(index: SldlIndex, artist: str, album: str, title: str):
+    line = index.get(artist, album, title)
+    if line is None:
+        return None
+    row = next(csv.reader([line]))
+    return row[0] if row[6] != FAILED_STATE and row[0] else None
+
+# returns the path of the local file for a track, or None if we don't have it
+def find_local_file(track: SyncTrack, catalog: MusicCatalog, index: SldlIndex):
+    candidates = [row[0] for row in catalog.find_by_uri(track.uri)] if track.uri else []
+    for artist in track.artists:
+        candidates += [row[0] for row in catalog.find_by_artist_title(artist, track.title)]
+    candidates.append(_index_filepath(index, track.artist, track.album, track.title))
+
+    # the catalog and index remember files that may have been moved or deleted since
+    return next((filepath for filepath in candidates if filepath and os.path.isfile(filepath)), None)
+
+def plan_sync(items, catalog: MusicCatalog, index: SldlIndex) -> SyncPlan:
+    plan = SyncPlan([], [])
+    for item in items:
+        track = sync_track(item)
+        filepath = find_local_file(track, catalog, index)
+        if filepath is not None:
+            plan.present.append((track, filepath))
+        else:
+            plan.missing.append(track)
+    return plan
+
+# writes the present tracks to the index and catalog, entries that are already up to date aren't written again, returns how many were written
+def record_present(plan: SyncPlan, catalog: MusicCatalog, index: SldlIndex) -> int:
+    written = 0
+    for track, filepath in plan.present:
+        if index.get(track.artist, track.album, track.title) != format_index_entry(filepath, track.artist, track.album, track.title, track.length):
+            index.upsert(filepath, track.artist, track.album, track.title, track.length)
+            written += 1
+        catalog.add_index_entry(filepath, track.artist, track.album, track.title, track.length)
+        # remembering the uri makes the next sync find this file with a single lookup
+        catalog.add_song(filepath, track.title, track.artist, track.album, track.length, track.uri)
+    return written
+
+# writes the tracks in the csv format sldl reads as an input
+def write_sldl_csv(tracks: list, csv_filepath: str) -> None:
+    os.makedirs(os.path.dirname(csv_filepath), exist_ok=True)
+    with open(csv_filepath, "w", encoding="utf-8", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(CSV_HEADER)
+        for track in tracks:
+            writer.writerow([track.artist, track.album, track.title, track.length])
+
+# fetches the playlist and records the tracks that are already present, returns the SyncPlan and how many index entries were written
+def _plan_and_record(playlist_id: str, index: SldlIndex, catalog: MusicCatalog) -> tuple:
+    plan = plan_sync(spotify.iter_playlist_tracks(playlist_id), catalog, index)
+    return plan, record_present(plan, catalog, index)
+
+def _playlist_id(playlist_url: str) -> str:
+    playlist_id = playlist_id_from_url(playlist_url)
+    if playlist_id is None:
+        raise ValueError(f"--sync needs a spotify playlist url, got {playlist_url}")
+    return playlist_id
+
+# fetches the playlist, records the tracks that are already present and writes the missing ones that are due for an attempt for sldl
+# in a batch, tracks another playlist of the batch already downloads are left out too
+# returns the path of the csv file to give sldl, or None if there's nothing to download
+def prepare_sync(playlist_url: str, output_path: str, catalog: MusicCatalog = None, batch: SyncBatch = None):
+    playlist_id = _playlist_id(playlist_url)
+    helper_dir = os.path.join(output_path, "sldl_helper")
+    os.makedirs(helper_dir, exist_ok=True)
+    index = SldlIndex(os.path.join(helper_dir, "_index.sldl"))
+    own_catalog = catalog is None
+    catalog = catalog or MusicCatalog()
+    ledger = FailureLedger(catalog.db_filepath)
+    try:
+        plan, written = _plan_and_record(playlist_id, index, catalog)
+        to_download, backing_off = ledger.schedule(plan.missing, key=lambda track: (track.artist, track.title))
+    finally:
+        ledger.close()
+        if own_catalog:
+            catalog.close()
+
+    claimed_elsewhere = 0
+    if batch is not None:
+        unclaimed = batch.claim(to_download)
+        claimed_elsewhere = len(to_download) - len(unclaimed)
+        to_download = unclaimed
+
+    print(f"{len(plan.present)} tracks already present ({written} new index entries), {len(plan.missing)} missing, {len(backing_off)} of them failed too recently to try again" + (f", {claimed_elsewhere} downloaded for another playlist of the batch" if batch is not None else ""))
+    if not to_download:
+        index.compact()
+        return None
+
+    playlist_name = spotify.get_playlist_name(playlist_id)
+    filename = batch.csv_filename(playlist_name, playlist_id) if batch is not None else spotify.safe_playlist_filename(playlist_name)
+    csv_filepath = os.path.join(helper_dir, SYNC_DIRNAME, filename + ".csv")
+    write_sldl_csv(to_download, csv_filepath)
+    return csv_filepath
+
+# records the tracks of a playlist that are present now, e.g. after a batch downloaded some of them for another playlist, returns how many index entries were written
+def record_synced(playlist_url: str, output_path: str, catalog: MusicCatalog) -> int:
+    index = SldlIndex(os.path.join(output_path, "sldl_helper", "_index.sldl"))
+    _, written = _plan_and_record(_playlist_id(playlist_url), index, catalog)
+    index.compact()
+    return written
@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import subprocess
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# the post processing of youtube fallback downloads: converting the audio, embedding the thumbnail as cover art and tagging the file with the spotify metadata sldl gave the helper
+# yt-dlp used to do all of this itself (-x --audio-format mp3 --embed-thumbnail --add-metadata), so every yt-dlp job downloaded, then sat on the cpu transcoding, one after the other
+# now the yt-dlp pool only downloads the raw audio and its thumbnail, and the files are handed to this pool, so downloads and transcodes overlap
+# the cpu work happens in ffmpeg processes, so the pool is a thread pool sized to the number of cpus, each thread waiting on one ffmpeg at a time
+# the modes (main.py --postprocess, or the postprocess_mode environment variable) are:
+#   mp3      transcode to mp3 on this pool (the default)
+#   keep     keep the downloaded codec and only remux it into a container that can be tagged (.webm -> .opus, .m4a stays .m4a), no re-encoding
+#   inline   let yt-dlp do everything in the download job like before
+
+POSTPROCESS_MODES = ("mp3", "keep", "inline")
+POSTPROCESS_MODE = os.getenv("postprocess_mode") or "mp3"
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_JOB_TIMEOUT = 600
+
+# an explicit ffmpeg executable (or .py script) to run, e.g. the stub from bench/stubs
+FFMPEG_PATH = os.getenv("ffmpeg_path")
+
+# the container the audio of a raw download is remuxed into in keep mode, anything else keeps its extension
+KEEP_CODEC_EXTENSIONS = {".webm": ".opus", ".weba": ".opus", ".mka": ".mka", ".m4a": ".m4a", ".mp4": ".m4a"}
+# ogg can't hold cover art through ffmpeg, so opus and vorbis files are only tagged
+NO_COVER_EXTENSIONS = {".opus", ".ogg"}
+MP3_QUALITY = "0"
+
+# raw_filepath is the downloaded audio, thumbnail_filepath the image yt-dlp wrote next to it (or None), mode is "mp3" or "keep"
+PostprocessJob = namedtuple("PostprocessJob", ["raw_filepath", "thumbnail_filepath", "title", "artist", "album", "uri", "mode"])
+# filepath is the finished file, or empty if ffmpeg failed (the raw download is left in place then), output is the log text of the job
+PostprocessResult = namedtuple("PostprocessResult", ["filepath", "output", "started_at", "seconds"])
+
+# the command that starts ffmpeg
+def _ffmpeg_command() -> list:
+    if FFMPEG_PATH and FFMPEG_PATH.endswith(".py"):
+        return [sys.executable, FFMPEG_PATH]
+    return [FFMPEG_PATH or "ffmpeg"]
+
+# returns the image yt-dlp wrote next to a download with --write-thumbnail, or None
+def find_thumbnail(raw_filepath: str):
+    stem = os.path.splitext(raw_filepath)[0]
+    for extension in (".webp", ".jpg", ".jpeg", ".png"):
+        if os.path.isfile(stem + extension):
+            return stem + extension
+    return None
+
+# returns the path the finished file gets
+def output_filepath(job: PostprocessJob) -> str:
+    stem, extension = os.path.splitext(job.raw_filepath)
+    if job.mode == "mp3":
+        return stem + ".mp3"
+    return stem + KEEP_CODEC_EXTENSIONS.get(extension.lower(), extension)
+
+# the ffmpeg arguments that convert (or remux) the raw download into temp_filepath, with the cover and tags
+def ffmpeg_arguments(job: PostprocessJob, temp_filepath: str, output_extension: str) -> list:
+    arguments = ["-nostdin", "-v", "error", "-y", "-i", job.raw_filepath]
+    with_cover = job.thumbnail_filepath is not None and output_extension not in NO_COVER_EXTENSIONS
+    if with_cover:
+        arguments += ["-i", job.thumbnail_filepath]
+
+    arguments += ["-map", "0:a:0"]
+    if with_cover:
+        # thumbnails are usually webp, which mp3 and m4a can't hold as cover art
+        arguments += ["-map", "1:0", "-c:v", "mjpeg", "-disposition:v", "attached_pic", "-metadata:s:v", "title=Album cover", "-metadata:s:v", "comment=Cover (front)"]
+    if job.mode == "mp3":
+        arguments += ["-c:a", "libmp3lame", "-q:a", MP3_QUALITY]
+    else:
+        arguments += ["-c:a", "copy"]
+    if output_extension == ".mp3":
+        arguments += ["-id3v2_version", "3"]
+
+    # the source's own tags (youtube title, uploader...) are dropped in favour of spotify's
+    arguments += ["-map_metadata", "-1", "-metadata", f"title={job.title}", "-metadata", f"artist={job.artist}", "-metadata", f"album={job.album}"]
+    if job.uri:
+        arguments += ["-metadata", f"comment={job.uri}"]
+    return arguments + [temp_filepath]
+
+# converts, tags and adds cover art to a raw download, removing the raw file and thumbnail once the finished file is in place
+def postprocess_file(job: PostprocessJob, timeout: float = DEFAULT_JOB_TIMEOUT) -> PostprocessResult:
+    started_at = time.time()
+    started_monotonic = time.monotonic()
+    filepath = output_filepath(job)
+    extension = os.path.splitext(filepath)[1].lower()
+    # ffmpeg picks the format from the extension, so the temporary file keeps it
+    temp_filepath = os.path.splitext(filepath)[0] + ".postprocess" + extension
+    command = [*_ffmpeg_command(), *ffmpeg_arguments(job, temp_filepath, extension)]
+
+    output = f"[postprocess] {job.mode}: {os.path.basename(job.raw_filepath)} -> {os.path.basename(filepath)}\n"
+    if job.thumbnail_filepath is not None and extension in NO_COVER_EXTENSIONS:
+        output += f"[postprocess] {extension} files can't hold cover art, the thumbnail is left out\n"
+
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, encoding="utf-8", errors="replace", timeout=timeout)
+        error = f"ffmpeg exited with {result.returncode}" if result.returncode != 0 else None
+        output += result.stderr
+    except subprocess.TimeoutExpired:
+        error = f"ffmpeg timed out after {timeout} seconds"
+    except OSError as e:
+        error = f"could not run ffmpeg: {e}"
+
+    if error is not None:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        return PostprocessResult("", output + f"ERROR: postprocessing failed: {error}\n", started_at, time.monotonic() - started_monotonic)
+
+    os.replace(temp_filepath, filepath)
+    for leftover in (job.raw_filepath, job.thumbnail_filepath):
+        if leftover is not None and leftover != filepath and os.path.exists(leftover):
+            os.remove(leftover)
+    return PostprocessResult(filepath, output, started_at, time.monotonic() - started_monotonic)
+
+# a pool of post processing jobs with one ffmpeg per cpu
+class PostprocessPool:
+    def __init__(self, max_workers: int = DEFAULT_WORKERS, job_timeout: float = DEFAULT_JOB_TIMEOUT):
+        self.max_workers = max_workers
+        self.job_timeout = job_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="postprocess")
+
+    def submit(self, job: PostprocessJob) -> Future:
+        return self._executor.submit(postprocess_file, job, self.job_timeout)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
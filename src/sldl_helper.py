@@ -1,126 +1,332 @@
 import sys
-import subprocess
 from datetime import datetime
-import re
 import os
-import csv
 import traceback
-import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from functools import partial
+
+import postprocess
+import ytdlp_pool
+import ytdlp_ranking
+from failure_ledger import FailureLedger
+from helper_log import HelperLog
+from music_database import MusicCatalog
+from sldl_index import SldlIndex, format_index_entry
+from timing import TRACE_FILENAME, TraceWriter, TrackTimer
 
 # https://github.com/fiso64/slsk-batchdl
 
 # this script is automatically ran by sldl after attempting to download a song (whether the download was successfull or not)
 # if the download was successfull, this script will update a log file and custom _index.sldl file with the relevant information
-# if the download was unsuccessfull, it will try to download the song from youtube using yt-dlp, and update the log file and custom _index.sldl file accordingly
+# if the download was unsuccessfull, it will try to download the song from youtube using yt-dlp (see ytdlp_pool.py), and update the log file and custom _index.sldl file accordingly
+# when main.py is used, sldl runs sldl_helper_client.py instead, which forwards the track to a long lived helper_daemon.py that calls into this file
 
-# IMPORTANT NOTES: 
+# IMPORTANT NOTES:
 #   - you need to add this line to your sldl.conf file:
-#       on-complete = s:python "your-path-to\sldl_helper.py" "{path}" "{title}" "{artist}" "{album}" "{uri}" "{length}" "{failure-reason}" "{state}"
+#       on-complete = s:python "your-path-to\sldl_helper_client.py" "{path}" "{title}" "{artist}" "{album}" "{uri}" "{length}" "{failure-reason}" "{state}"
 #   - yt-dlp and python also need to be globally accessible from the terminal
 #   - if using playlists from spotify, you will need to add authentication information to sldl.conf as well, see the slsk-batchdl github above
 
 # path configuration, the script creates a new sldl_helper directory in the same directory sldl was ran in
 # sldl_helper/ contains the log file, the custom _index.sldl, and an _index_history directory thats used to track the sldl generated _index files (though this directory is created by index_fixer.py)
 
-# TODO: create our own sql database and use this to create the _index file.
-# TODO: restructure this whole file 
-
-# info fed to the script by sldl
-filepath = sys.argv[1]
-title = sys.argv[2]
-artist = sys.argv[3]
-album = sys.argv[4]
-uri = sys.argv[5]
-length = sys.argv[6]
-failure_reason = sys.argv[7]
-sldl_state = sys.argv[8]
-OUTPUT_PATH = sys.argv[9]
-
-SLDL_HELPER_DIR = OUTPUT_PATH + "/sldl_helper/"
-os.makedirs(SLDL_HELPER_DIR, exist_ok=True)
-LOG_FILEPATH = SLDL_HELPER_DIR + "sldl_helper.log"
-CUSTOM_INDEX_FILEPATH = SLDL_HELPER_DIR + "_index.sldl"
-DATABASE_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../assets/all_music.sqlite")
-
-def main():
-    # if our custom _index.sldl file doesn't already exist, create it with the header
-    if not os.path.exists(CUSTOM_INDEX_FILEPATH):
-        with open(CUSTOM_INDEX_FILEPATH, "w", encoding="utf-8") as file:
-            file.write("filepath,artist,album,title,length,tracktype,state,failurereason\n")
+# every result is also written to the shared music catalog (see music_database.py)
+# tracks that fail on both soulseek and youtube are recorded in the failure ledger, and a track that is still backing off isn't tried on youtube again (see failure_ledger.py)
+# and how long each stage of every track took is written to sldl_helper/timings.jsonl (see timing.py)
+# youtube downloads are converted and tagged on a separate post processing pool once yt-dlp has downloaded the raw audio (see postprocess.py)
+
+# info fed to the script by sldl, in the order of the on-complete line, followed by the output path main.py adds to it
+SldlEvent = namedtuple("SldlEvent", ["filepath", "title", "artist", "album", "uri", "length", "failure_reason", "sldl_state", "output_path"])
+
+# the result of handling an event: the fields of its _index.sldl entry and the block to append to the log
+# handling and persisting are kept separate so the daemon can download concurrently but still write results in order
+# rejected_candidates is set when every youtube candidate scored below the match threshold
+# failure_reason is set when the track failed and the failure should go in the failure ledger
+# postprocess_job is set when a raw youtube download still has to be converted and tagged, the outcome isn't final until it has been (see finish_postprocess)
+HelperOutcome = namedtuple("HelperOutcome", ["index_fields", "log_contents", "rejected_candidates", "failure_reason", "postprocess_job"], defaults=(None, None, None))
+
+# the open index, log and youtube rejections for one output directory
+class HelperContext:
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        self.helper_dir = os.path.join(output_path, "sldl_helper")
+        os.makedirs(self.helper_dir, exist_ok=True)
+        self.log_filepath = os.path.join(self.helper_dir, "sldl_helper.log")
+        self.index_filepath = os.path.join(self.helper_dir, "_index.sldl")
+        self.index = SldlIndex(self.index_filepath)
+        self.log = HelperLog(self.log_filepath)
+        self.rejections = ytdlp_ranking.YtdlpRejections(os.path.join(self.helper_dir, "ytdlp_rejections.sqlite"))
+        self.trace = TraceWriter(os.path.join(self.helper_dir, TRACE_FILENAME))
+
+    def close(self) -> None:
+        self.log.close()
+        self.rejections.close()
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+# returns the (cached) context for an output directory, so a long running process only opens its files once
+def get_context(output_path: str) -> HelperContext:
+    with _contexts_lock:
+        if output_path not in _contexts:
+            _contexts[output_path] = HelperContext(output_path)
+        return _contexts[output_path]
+
+_catalog = None
+_failure_ledger = None
+
+# returns the shared catalog, its connection stays open (and writes are batched) for as long as this process runs
+def get_catalog() -> MusicCatalog:
+    global _catalog
+    with _contexts_lock:
+        if _catalog is None:
+            _catalog = MusicCatalog()
+        return _catalog
+
+def get_failure_ledger() -> FailureLedger:
+    global _failure_ledger
+    with _contexts_lock:
+        if _failure_ledger is None:
+            _failure_ledger = FailureLedger()
+        return _failure_ledger
+
+# closes every open index, log, the catalog and the failure ledger, flushing anything still buffered
+def close_contexts() -> None:
+    global _catalog, _failure_ledger
+    with _contexts_lock:
+        for context in _contexts.values():
+            context.close()
+        _contexts.clear()
+        if _catalog is not None:
+            _catalog.close()
+            _catalog = None
+        if _failure_ledger is not None:
+            _failure_ledger.close()
+            _failure_ledger = None
+
+_ytdlp_pool = None
+_ytdlp_pool_config = (ytdlp_pool.DEFAULT_WORKERS, ytdlp_pool.DEFAULT_JOB_TIMEOUT)
+_ytdlp_pool_lock = threading.Lock()
+
+# sets how many youtube fallback downloads run at once and how long each one may take, must be called before the first download
+def configure_ytdlp_pool(max_workers: int, job_timeout: float) -> None:
+    global _ytdlp_pool_config
+    _ytdlp_pool_config = (max_workers, job_timeout)
+
+def get_ytdlp_pool() -> ytdlp_pool.YtdlpPool:
+    global _ytdlp_pool
+    with _ytdlp_pool_lock:
+        if _ytdlp_pool is None:
+            _ytdlp_pool = ytdlp_pool.YtdlpPool(*_ytdlp_pool_config)
+        return _ytdlp_pool
+
+# waits for queued youtube downloads and stops the pool
+def close_ytdlp_pool() -> None:
+    global _ytdlp_pool
+    with _ytdlp_pool_lock:
+        if _ytdlp_pool is not None:
+            _ytdlp_pool.close()
+            _ytdlp_pool = None
+
+# the post processing pool is created the same way, mode is one of postprocess.POSTPROCESS_MODES
+_postprocess_pool = None
+_postprocess_config = (postprocess.POSTPROCESS_MODE, postprocess.DEFAULT_WORKERS)
+_postprocess_pool_lock = threading.Lock()
+
+def configure_postprocess(mode: str, max_workers: int) -> None:
+    global _postprocess_config
+    _postprocess_config = (mode, max_workers)
+
+def get_postprocess_pool() -> postprocess.PostprocessPool:
+    global _postprocess_pool
+    with _postprocess_pool_lock:
+        if _postprocess_pool is None:
+            _postprocess_pool = postprocess.PostprocessPool(_postprocess_config[1])
+        return _postprocess_pool
+
+# the yt-dlp pool has to be closed first, its jobs hand their downloads to this pool
+def close_postprocess_pool() -> None:
+    global _postprocess_pool
+    with _postprocess_pool_lock:
+        if _postprocess_pool is not None:
+            _postprocess_pool.close()
+            _postprocess_pool = None
+
+# handles a single on-complete call from sldl, args are everything after the script path
+def run(args: list) -> None:
+    event = SldlEvent(*args[:len(SldlEvent._fields)])
+    timer = TrackTimer()
+    outcome = handle_event(event, timer)
+    if isinstance(outcome, Future):
+        outcome = outcome.result()
+    commit_outcome(event, outcome, timer)
+    close_contexts()
+
+# works out what needs to happen for a track, without writing the index or log
+# returns a HelperOutcome, or a Future of one for failed soulseek downloads that were queued on the yt-dlp pool
+# the youtube fallback's stages are timed on timer
+def handle_event(event: SldlEvent, timer: TrackTimer = None):
+    seperator = "=" * 150
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     # if sldl was able to find and download the song on SoulSeek, create the appropriate index entry
-    if sldl_state == "Downloaded" or filepath != "":
-        log_contents = ""
-        seperator = "=" * 150
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        sldl_index_entry = create_sldl_index_entry(filepath, artist, album, title, length)
-        log_contents += (
+    if event.sldl_state == "Downloaded" or event.filepath != "":
+        index_fields = (event.filepath, event.artist, event.album, event.title, event.length)
+        log_contents = (
             f"Downloading from SoulSeek...\n"
-            f"Title: {title}\n"
-            f"Artist: {artist}\n"
-            f"Spotify URI: {uri}\n"
+            f"Title: {event.title}\n"
+            f"Artist: {event.artist}\n"
+            f"Spotify URI: {event.uri}\n"
             f"Time: {timestamp}\n"
-            f"Filepath: '{filepath}'\n"
-            f"SLDL Index Entry: {sldl_index_entry}\n\n"
+            f"Filepath: '{event.filepath}'\n"
+            f"SLDL Index Entry: {format_index_entry(*index_fields)}\n\n"
             f"{seperator}\n\n"
         )
-        append_log_contents(log_contents)
-
-    # if sldl did not find the song, download it from youtube
-    elif sldl_state == "Failed":
-        download_path = download_song_ytdlp(title, artist, uri, album, length)
-        sldl_index_entry = create_sldl_index_entry(download_path, artist, album, title, length)
+        return HelperOutcome(index_fields, log_contents)
+
+    # if sldl did not find the song and it failed too recently to try again, don't spend a youtube search on it either
+    if event.sldl_state == "Failed":
+        ledger_entry = get_failure_ledger().get(event.artist, event.title)
+        if ledger_entry is not None and ledger_entry.next_attempt_at > time.time():
+            index_fields = ("", event.artist, event.album, event.title, event.length)
+            log_contents = (
+                f"Tried to download from SoulSeek...\n"
+                f"Title: {event.title}\n"
+                f"Artist: {event.artist}\n"
+                f"Spotify URI: {event.uri}\n"
+                f"Time: {timestamp}\n\n"
+                f"DOWNLOAD SKIPPED - failed {ledger_entry.attempts} times, the next youtube attempt is after {datetime.fromtimestamp(ledger_entry.next_attempt_at).strftime('%Y-%m-%d %H:%M')}\n"
+                f"SLDL Index Entry: {format_index_entry(*index_fields)}\n\n"
+                f"{seperator}\n\n"
+            )
+            return HelperOutcome(index_fields, log_contents)
+
+        # otherwise queue a download from youtube, the outcome is ready once the pool (and the post processing pool after it) has finished it
+        download_future = get_ytdlp_pool().submit(partial(download_song_ytdlp, timer=timer), event.title, event.artist, event.uri, event.album, event.length, event.output_path)
+        return chain_postprocess(download_future, timer)
 
     # if there was a different state, the download likely failed
-    else:
-        sldl_index_entry = create_sldl_index_entry("", artist, album, title, length)
-        log_contents = ""
-        seperator = "=" * 150
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_contents = (
-            f"Tried to download from SoulSeek and yt-dlp...\n"
-            f"Title: {title}\n"
-            f"Artist: {artist}\n"
-            f"Spotify URI: {uri}\n"
-            f"Time: {timestamp}\n\n"
-            f"DOWNLOAD FAILED - unexpected state: {sldl_state}\n\n"
-            f"{seperator}\n\n"
-        )
-        append_log_contents(log_contents)
-
-def add_song_to_db(filepath, title, artist, album, length, uri):
-    conn = sqlite3.connect(DATABASE_FILEPATH)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS all_music (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        filepath TEXT NOT NULL UNIQUE,
-        title TEXT,
-        artist TEXT,
-        album TEXT,
-        length INTEGER,
-        uri TEXT
+    index_fields = ("", event.artist, event.album, event.title, event.length)
+    log_contents = (
+        f"Tried to download from SoulSeek and yt-dlp...\n"
+        f"Title: {event.title}\n"
+        f"Artist: {event.artist}\n"
+        f"Spotify URI: {event.uri}\n"
+        f"Time: {timestamp}\n\n"
+        f"DOWNLOAD FAILED - unexpected state: {event.sldl_state}\n\n"
+        f"{seperator}\n\n"
     )
-    ''')
+    return HelperOutcome(index_fields, log_contents, failure_reason=f"unexpected sldl state {event.sldl_state}")
 
-    try:
-        song_data = (filepath, title, artist, album, length, uri)
-        cursor.execute("INSERT INTO all_music (filepath, title, artist, album, length, uri) VALUES (?, ?, ?, ?, ?, ?)", song_data)
-        conn.commit()
-    except sqlite3.IntegrityError:
-        print("Error: a song with this filepath already exists in the database.")
-    finally:
-        conn.close()
-
-
-# downloads the song with title and artist from youtube using yt-dlp, writes logging information to a log file
-def download_song_ytdlp(title: str, artist: str, uri: str, album: str, length: str) -> str :
-    search_query = f"ytsearch:{title} {artist}".encode("utf-8").decode()
-    log_content = ""
-    ytdlp_output = ""
+# the outcome the daemon commits for an event whose handling or commit raised, so the track still gets an index entry and a log block
+# a soulseek download keeps its file, anything else is a failed entry. it has no failure_reason, the helper breaking isn't the track's fault
+def error_outcome(event: SldlEvent, error: str) -> HelperOutcome:
+    seperator = "=" * 150
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    index_fields = (event.filepath, event.artist, event.album, event.title, event.length)
+    log_contents = (
+        f"Handling the track failed...\n"
+        f"Title: {event.title}\n"
+        f"Artist: {event.artist}\n"
+        f"Spotify URI: {event.uri}\n"
+        f"Time: {timestamp}\n\n"
+        f"HELPER ERROR - {error}\n"
+        f"SLDL Index Entry: {format_index_entry(*index_fields)}\n\n"
+        f"{seperator}\n\n"
+    )
+    return HelperOutcome(index_fields, log_contents)
+
+# returns a future of the final outcome of a youtube download: downloads that left a postprocess_job are converted and tagged on the post processing pool first
+# the yt-dlp worker is free for the next download as soon as the raw audio is on disk
+def chain_postprocess(download_future: Future, timer: TrackTimer = None) -> Future:
+    outcome_future = Future()
+
+    def on_postprocessed(outcome: HelperOutcome, future: Future) -> None:
+        try:
+            outcome_future.set_result(finish_postprocess(outcome, future.result(), timer))
+        except Exception as e:
+            outcome_future.set_exception(e)
+
+    def on_downloaded(future: Future) -> None:
+        try:
+            outcome = future.result()
+            if outcome.postprocess_job is None:
+                outcome_future.set_result(outcome)
+            else:
+                get_postprocess_pool().submit(outcome.postprocess_job).add_done_callback(partial(on_postprocessed, outcome))
+        except Exception as e:
+            outcome_future.set_exception(e)
+
+    download_future.add_done_callback(on_downloaded)
+    return outcome_future
+
+# returns the final outcome of a raw download once it was post processed, if post processing failed the raw download is kept as it is
+def finish_postprocess(outcome: HelperOutcome, result: postprocess.PostprocessResult, timer: TrackTimer = None) -> HelperOutcome:
+    if timer is not None:
+        timer.add("postprocess", result.started_at, result.seconds)
+
+    raw_filepath, artist, album, title, length = outcome.index_fields
+    log_content = outcome.log_contents + result.output
+    if result.filepath == "":
+        log_content += "\nPOSTPROCESSING FAILED - keeping the raw download\n"
+    index_fields = (result.filepath or raw_filepath, artist, album, title, length)
+    return HelperOutcome(index_fields, log_content + ytdlp_log_tail(index_fields))
+
+# the end of the log block of a youtube download
+def ytdlp_log_tail(index_fields: tuple) -> str:
+    seperator = "=" * 150
+    failed_string = "\nDOWNLOAD FAILED - path empty\n"
+    return (
+        f"\nFilepath: '{index_fields[0]}'\n"
+        f"SLDL Index Entry: {format_index_entry(*index_fields)}\n"
+        f"{failed_string if index_fields[0] == '' else ''}"
+        f"\n{seperator}\n\n"
+    )
 
-    # TODO: fix empty queries with non english characters ctrl f '大掃除' in sldl_helper.log 
+# writes the index entry and log block for a handled event, then the timings of every stage of the track
+def commit_outcome(event: SldlEvent, outcome: HelperOutcome, timer: TrackTimer = None) -> None:
+    timer = timer or TrackTimer()
+    context = get_context(event.output_path)
+    with timer.span("index_update"):
+        create_sldl_index_entry(context, *outcome.index_fields)
+    with timer.span("log_append"):
+        append_log_contents(context, outcome.log_contents)
+
+    filepath, artist, album, title, length = outcome.index_fields
+    with timer.span("catalog"):
+        catalog = get_catalog()
+        catalog.add_index_entry(filepath, artist, album, title, length)
+        if filepath != "":
+            catalog.add_song(filepath, title, artist, album, length, event.uri)
+
+    if outcome.rejected_candidates is not None:
+        context.rejections.record(artist, album, title, outcome.rejected_candidates)
+    elif filepath != "":
+        context.rejections.clear(artist, album, title)
+
+    # skipped tracks (still backing off) have no failure_reason, so skipping doesn't count as another failure
+    if filepath != "":
+        get_failure_ledger().record_success(artist, title)
+    elif outcome.failure_reason is not None:
+        get_failure_ledger().record_failure(artist, album, title, f"soulseek: {event.failure_reason or event.sldl_state}, {outcome.failure_reason}", event.uri)
+
+    timer.finish()
+    context.trace.write_track(timer, track=event.uri or f"{artist} - {title}", title=title, artist=artist, state=event.sldl_state, downloaded=filepath != "")
+
+# downloads the song with title and artist from youtube using yt-dlp, returns the index fields and log contents for the attempt
+# the top few search results are ranked by their metadata first (see ytdlp_ranking.py) and only the best one is downloaded
+# this runs on the yt-dlp pool (see handle_event), so it must not write the index or log itself
+# unless the post processing mode is inline, only the raw audio is downloaded and the outcome carries a postprocess_job for chain_postprocess
+def download_song_ytdlp(title: str, artist: str, uri: str, album: str, length: str, output_path: str, timeout: float = ytdlp_pool.DEFAULT_JOB_TIMEOUT, timer: TrackTimer = None) -> HelperOutcome :
+    timer = timer or TrackTimer()
+    deadline = time.monotonic() + timeout
+    search_query = f"{title} {artist}"
+    log_content = ""
+    seperator = "=" * 150
+    failed_index_fields = ("", artist, album, title, length)
 
     # append the logfile with a timestamp, track info, and yt-dlp output and print it
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -130,162 +336,84 @@ def download_song_ytdlp(title: str, artist: str, uri: str, album: str, length: s
         f"Artist: {artist}\n"
         f"Spotify URI: {uri}\n"
         f"Time: {timestamp}\n"
-        f"Query: {search_query}\n\n"
+        f"Query: ytsearch{ytdlp_ranking.CANDIDATE_COUNT}:{search_query}\n\n"
     )
 
-    # download the file using yt-dlp and necessary flags
-    process = subprocess.Popen([
-        "yt-dlp",
-        search_query,
-        "--cookies-from-browser", "firefox",
-        "-x", "--audio-format", "mp3",
-        "--embed-thumbnail", "--add-metadata",
-        "--paths", OUTPUT_PATH,
-        "-o", f"{title} - {artist}.%(ext)s"
-    ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-
-    # print and append the output of yt-dlp to the log file
-    for line in iter(process.stdout.readline, ''):
-        print(line, end='')
-        log_content += line
-        ytdlp_output += line
-
-    process.stdout.close()
-    process.wait()
-
-    # this extracts the filepath of the new file from the yt-dlp output
-    file_path_pattern = r'\[EmbedThumbnail\] ffmpeg: Adding thumbnail to "([^"]+)"'
-    match = re.search(file_path_pattern, ytdlp_output)
-    download_path = match.group(1) if match else ""
-
-    # this extracts the title and artist from the yt-dlp output
-    title_artist_pattern = r'\[download\] Finished downloading playlist: (.+)'
-    match = re.search(title_artist_pattern, ytdlp_output)
-    extracted_text = match.group(1).lower()
-
-    # if our expected title or artist was not found in that text, the file is likely wrong and we want to log this
-    if not title.lower() in extracted_text.lower():
+    # don't search again for a track whose candidates were all rejected recently, the results are very likely the same
+    if get_context(output_path).rejections.is_recently_rejected(artist, album, title):
+        log_content += (
+            f"DOWNLOAD SKIPPED - all youtube candidates were rejected in a recent run\n"
+            f"SLDL Index Entry: {format_index_entry(*failed_index_fields)}\n"
+            f"\n{seperator}\n\n"
+        )
+        return HelperOutcome(failed_index_fields, log_content, failure_reason="youtube: every candidate was rejected in a recent run")
+
+    with timer.span("ytdlp_search"):
+        ranked = ytdlp_ranking.rank_candidates(ytdlp_pool.search_candidates(search_query, ytdlp_ranking.CANDIDATE_COUNT, timeout), title, artist, length)
+    log_content += ytdlp_ranking.format_candidates(ranked) + "\n"
+
+    # search_candidates returns nothing when the search itself failed (network errors, timeouts, cookies), which says nothing about the track,
+    # so it isn't remembered as a rejection or counted as a failure in the ledger, the next run just tries again
+    if not ranked:
+        log_content += (
+            f"DOWNLOAD FAILED - the youtube search returned no candidates\n"
+            f"SLDL Index Entry: {format_index_entry(*failed_index_fields)}\n"
+            f"\n{seperator}\n\n"
+        )
+        return HelperOutcome(failed_index_fields, log_content)
+
+    # nothing looked like the right song, so don't waste a download and transcode on it
+    if ranked[0].score < ytdlp_ranking.MATCH_THRESHOLD:
+        log_content += (
+            f"DOWNLOAD FAILED - no candidate scored above {ytdlp_ranking.MATCH_THRESHOLD}\n"
+            f"SLDL Index Entry: {format_index_entry(*failed_index_fields)}\n"
+            f"\n{seperator}\n\n"
+        )
+        return HelperOutcome(failed_index_fields, log_content, ranked, f"youtube: no candidate scored above {ytdlp_ranking.MATCH_THRESHOLD}")
+
+    # download the best candidate using yt-dlp, % starts a field in yt-dlp's output template so it needs escaping
+    filename_template = f"{title} - {artist}".replace("%", "%%") + ".%(ext)s"
+    postprocess_mode = _postprocess_config[0]
+    with timer.span("ytdlp_download"):
+        download = ytdlp_pool.download_audio(ranked[0].url, output_path, filename_template, max(deadline - time.monotonic(), 1), postprocess=postprocess_mode == "inline")
+    # only the length of the transcode is known, it finished shortly before the download returned
+    if download.transcode_seconds is not None:
+        timer.add("transcode", time.time() - download.transcode_seconds, download.transcode_seconds)
+    log_content += download.output
+    download_path = download.filepath
+
+    # if our expected title or artist was not found in what yt-dlp actually downloaded, the file is likely wrong and we want to log this
+    extracted_text = f"{download.video_title} {download.uploader}".lower()
+    if download_path != "" and not title.lower() in extracted_text:
         log_content += f"\n\nTitle ({title}) not found in output: {extracted_text}\n\n"
-    if not artist.lower() in extracted_text.lower():
-        log_content += f"\n\nArtist ({artist}) not found in output: {extracted_text}\n\n"         
-
-    sldl_index_entry = create_sldl_index_entry(download_path, artist, album, title, length)
-
-    seperator = "=" * 150
-    failed_string = "\nDOWNLOAD FAILED - path empty\n"
-    log_content += (
-        f"\nFilepath: '{download_path}'\n"
-        f"SLDL Index Entry: {sldl_index_entry}\n"
-        f"{failed_string if download_path == '' else ''}"
-        f"\n{seperator}\n\n"
-    )
-    append_log_contents(log_content)
-
-    return download_path
-
-# this creates an entry for the _index.sldl file for a given song
-def create_sldl_index_entry(filepath, artist, album, title, length):
-    sldl_index_entry_dict = {
-        filepath: filepath,
-        artist: artist,
-        album: album,
-        title: title,
-        length: length,
-    }
-
-    # since we are using double quotes to enclose strings, we cant have them in the string itself
-    sldl_index_entry_dict = {
-        key: (value.replace('"', "'") if isinstance(value, str) else value)
-        for key, value in sldl_index_entry_dict.items()
-    }
-
-    # if our values are not the correct type, sldl will throw an error. we need to check everything because the metadata provided by soulseek users may be incorrect
-    if not isinstance(filepath, str):
-        sldl_index_entry_dict[filepath] = ""
-
-    if not isinstance(artist, str):
-        sldl_index_entry_dict[artist] = ""
-
-    if not isinstance(album, str):
-        sldl_index_entry_dict[album] = ""
-
-    if not isinstance(title, str):
-        sldl_index_entry_dict[title] = ""
-
-    if not length.isdigit():
-        sldl_index_entry_dict[length] = -1
-
-    # filepath,artist,album,title,length,tracktype,state,failurereason
-    if filepath == "":
-        sldl_index_entry = f'"","{sldl_index_entry_dict[artist]}","{sldl_index_entry_dict[album]}","{sldl_index_entry_dict[title]}",{sldl_index_entry_dict[length]},0,2,3'
-    else:
-        sldl_index_entry = f'"{sldl_index_entry_dict[filepath]}","{sldl_index_entry_dict[artist]}","{sldl_index_entry_dict[album]}","{sldl_index_entry_dict[title]}",{sldl_index_entry_dict[length]},0,1,0'
-
-    # get the contents of the previous index file
-    with open(CUSTOM_INDEX_FILEPATH, "r", encoding="utf-8") as index_file:
-        old_index_lines = index_file.readlines()
-
-    new_index_entries = []
-    # if the index file is empty, we need to initialize it with the header and our new entry
-    if len(old_index_lines) == 0:
-        new_index_entries.append("filepath,artist,album,title,length,tracktype,state,failurereason\n")
-        new_index_entries.append(sldl_index_entry + "\n")
-    else:
-        # for each line in the previous index file, append it to the new lines if its not an identical failed download, and it's not already present
-        for i, old_entry in enumerate(old_index_lines):
-            # always want the header
-            if i == 0:
-                new_index_entries.append(old_entry)
-            else:
-                # csv.DictReader reads the plaintext line into a dictionary mapping each item in the header to its corresponding value. we index by -1 because it does not include the header
-                entry_dicts = list(csv.DictReader(old_index_lines))
-                old_entry_dict = entry_dicts[i - 1]
-                # if the current download succeeded (non-empty filepath) and the previous attempts at downloading the track failed, we don't want to include the old failed entry since sldl will try to redownload it everytime
-                remove_identical_failed_download = old_entry_dict["title"] == title and old_entry_dict["artist"] == artist and old_entry_dict["album"] == album and int(old_entry_dict["state"]) == 2 and filepath != ""
-
-                # we also don't want to include duplicate entries
-                if not remove_identical_failed_download:
-                    new_index_entries.append(old_entry)
+    if download_path != "" and not artist.lower() in extracted_text:
+        log_content += f"\n\nArtist ({artist}) not found in output: {extracted_text}\n\n"
 
-        # after adding all the previous entries, we can append the new one if it's not a duplicate
-        if not sldl_index_entry in "\n".join(new_index_entries):
-            new_index_entries.append(sldl_index_entry + "\n")
+    index_fields = (download_path, artist, album, title, length)
+    if download_path != "" and postprocess_mode != "inline":
+        job = postprocess.PostprocessJob(download_path, download.thumbnail_filepath, title, artist, album, uri, postprocess_mode)
+        return HelperOutcome(index_fields, log_content, postprocess_job=job)
 
-    # now we can finally rewrite the old file with our new entries
-    with open(CUSTOM_INDEX_FILEPATH, "w", encoding="utf-8") as file:
-        file.writelines(new_index_entries)
+    log_content += ytdlp_log_tail(index_fields)
+    return HelperOutcome(index_fields, log_content, failure_reason=None if download_path != "" else "youtube: download failed")
 
-    return sldl_index_entry
+# this creates an entry for the _index.sldl file for a given song, see sldl_index.py for how duplicates and old failed entries are handled
+def create_sldl_index_entry(context: HelperContext, filepath, artist, album, title, length):
+    return context.index.upsert(filepath, artist, album, title, length)
 
 # returns true if the new log contents are already in the log file
-def check_duplicate_log_content(new_log_contents: str) -> bool :
-    if os.path.exists(LOG_FILEPATH):
-        with open(LOG_FILEPATH, "r", encoding="utf-8") as log_file:
-            file_contents = log_file.read()
-
-            # we need to remove the timestamps to check for equality
-            timestamp_pattern = r"Time: \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}"
-            file_contents_no_timestamp = re.sub(timestamp_pattern, "", file_contents)
-            log_contents_no_timestamp = re.sub(timestamp_pattern, "", new_log_contents)
-
-            if log_contents_no_timestamp in file_contents_no_timestamp:
-                return True
-            
-            return False
-    else:
-        raise FileNotFoundError(f"File doesn't exist: {LOG_FILEPATH}")
+def check_duplicate_log_content(context: HelperContext, new_log_contents: str) -> bool :
+    return context.log.contains(new_log_contents)
 
 # appends the new log contents to the log file
-def append_log_contents(new_log_contents: str) -> None :
+def append_log_contents(context: HelperContext, new_log_contents: str) -> None :
     # if the log_content is already in the file, we don't want to add it again because it would be harder to search for failed downloads since theyd be appended to the file multiple times
-    with open(LOG_FILEPATH, "a", encoding="utf-8") as log_file:
-        if check_duplicate_log_content(new_log_contents) == False:
-            log_file.write(new_log_contents)
+    context.log.append(new_log_contents)
 
 
 if __name__ == "__main__":
     try:
-        main()
+        run(sys.argv[1:])
     except Exception as e:
         error_message = traceback.format_exc()
-        input(f"error moment: {error_message}")
\ No newline at end of file
+        input(f"error moment: {error_message}")
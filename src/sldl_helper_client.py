@@ -0,0 +1,45 @@
+import os
+import sys
+from multiprocessing.connection import AuthenticationError, Client
+
+# this is what sldl's on-complete line runs for every track. it deliberately imports almost nothing so it starts fast,
+# and just forwards its arguments to the helper_daemon.py that main.py started. if no daemon is reachable (e.g. sldl was ran by hand), the track is handled in this process instead
+
+# keep these in sync with helper_daemon.py, importing it here would pull in the whole helper
+ADDRESS_ENV = "SLDL_HELPER_ADDRESS"
+AUTHKEY_ENV = "SLDL_HELPER_AUTHKEY"
+
+# returns true if the daemon accepted the event
+def forward_to_daemon(args: list) -> bool:
+    address = os.environ.get(ADDRESS_ENV)
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not address or not authkey:
+        return False
+
+    host, port = address.rsplit(":", 1)
+    try:
+        with Client((host, int(port)), authkey=bytes.fromhex(authkey)) as conn:
+            conn.send(args)
+            reply = conn.recv()
+    except (OSError, EOFError, ValueError, AuthenticationError):
+        return False
+
+    # the daemon rejected the arguments themselves, handling them here would fail the same way
+    if isinstance(reply, dict) and "error" in reply:
+        sys.exit(f"ERROR: the helper daemon rejected the track: {reply['error']}")
+    return True
+
+def main():
+    args = sys.argv[1:]
+    if forward_to_daemon(args):
+        return
+
+    import sldl_helper
+    try:
+        sldl_helper.run(args)
+    except Exception:
+        import traceback
+        input(f"error moment: {traceback.format_exc()}")
+
+if __name__ == "__main__":
+    main()
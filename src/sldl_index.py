@@ -0,0 +1,189 @@
+import csv
+import os
+import threading
+
+from file_lock import file_lock
+
+# the custom _index.sldl is stored as a compacted csv snapshot (the exact file sldl reads) plus an append-only journal of newer entries
+# adding an entry only appends one line to the journal, so the helper no longer reads and rewrites the whole index for every track
+# the journal is periodically folded back into the snapshot (compaction), and index_fixer.py compacts before it swaps the index files
+# entries are keyed by (artist, album, title), a successful download supersedes a failed entry for the same key, but a failed attempt never replaces a successful one
+
+INDEX_HEADER = "filepath,artist,album,title,length,tracktype,state,failurereason\n"
+JOURNAL_SUFFIX = ".journal"
+LOCK_SUFFIX = ".lock"
+
+# the journal is compacted into the snapshot once it grows past this size
+COMPACT_THRESHOLD_BYTES = 256 * 1024
+
+# sldl's state column, 2 means the download failed
+FAILED_STATE = "2"
+
+# returns the sanitized (filepath, artist, album, title, length) values for an index entry
+def sanitize_index_fields(filepath, artist, album, title, length) -> tuple:
+    # if our values are not the correct type, sldl will throw an error. we need to check everything because the metadata provided by soulseek users may be incorrect
+    # since we are using double quotes to enclose strings, we cant have them in the string itself
+    fields = [value.replace('"', "'") if isinstance(value, str) else "" for value in (filepath, artist, album, title)]
+    length = length if isinstance(length, str) and length.isdigit() else -1
+    return (*fields, length)
+
+# creates a line for the _index.sldl file (without the trailing newline) for a given song
+def format_index_entry(filepath, artist, album, title, length) -> str:
+    filepath, artist, album, title, length = sanitize_index_fields(filepath, artist, album, title, length)
+
+    # filepath,artist,album,title,length,tracktype,state,failurereason
+    if filepath == "":
+        return f'"","{artist}","{album}","{title}",{length},0,2,3'
+    return f'"{filepath}","{artist}","{album}","{title}",{length},0,1,0'
+
+# parses a raw index line into its (artist, album, title) key and state, returns None for lines that aren't entries
+def parse_index_line(line: str):
+    row = next(csv.reader([line]), None)
+    if row is None or len(row) < 7:
+        return None
+    return (row[1], row[2], row[3]), row[6]
+
+class SldlIndex:
+    def __init__(self, index_filepath: str, compact_threshold_bytes: int = COMPACT_THRESHOLD_BYTES):
+        self.index_filepath = index_filepath
+        self.journal_filepath = index_filepath + JOURNAL_SUFFIX
+        self.lock_filepath = index_filepath + LOCK_SUFFIX
+        self.compact_threshold_bytes = compact_threshold_bytes
+
+        # the in memory view is only built when something needs to read the index (lookups or compaction)
+        self._entries = None
+        self._snapshot_stamp = None
+        self._journal_offset = 0
+        self._thread_lock = threading.Lock()
+
+    # adds or updates the entry for a song and returns the line that was written, this is O(1) since it only appends to the journal
+    def upsert(self, filepath, artist, album, title, length) -> str:
+        entry = format_index_entry(filepath, artist, album, title, length)
+
+        with self._thread_lock, file_lock(self.lock_filepath):
+            self._ensure_snapshot()
+            with open(self.journal_filepath, "a", encoding="utf-8") as journal_file:
+                # terminate a line left torn by a crashed writer so it can't swallow our entry
+                journal_file.write(self._torn_line_prefix() + entry + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+            if os.path.getsize(self.journal_filepath) >= self.compact_threshold_bytes:
+                self._compact_locked()
+
+        return entry
+
+    # returns the current index line for a song, or None if it isn't in the index
+    def get(self, artist, album, title):
+        _, artist, album, title, _ = sanitize_index_fields("", artist, album, title, "")
+        with self._thread_lock, file_lock(self.lock_filepath):
+            self._refresh_locked()
+            entry = self._entries.get((artist, album, title))
+        return entry[0] if entry is not None else None
+
+    # returns true if the song has a successful (non failed) entry in the index
+    def has_download(self, artist, album, title) -> bool:
+        line = self.get(artist, album, title)
+        return line is not None and parse_index_line(line)[1] != FAILED_STATE
+
+    # points entries at another file, moves is {old filepath: new filepath}, returns how many entries changed
+    # the changed entries are written by compacting, an index file that doesn't exist is left alone
+    def replace_filepaths(self, moves: dict) -> int:
+        moves = {sanitize_index_fields(old, "", "", "", "")[0]: sanitize_index_fields(new, "", "", "", "")[0] for old, new in moves.items()}
+        if not os.path.exists(self.index_filepath):
+            return 0
+
+        with self._thread_lock, file_lock(self.lock_filepath):
+            self._refresh_locked()
+            changed = 0
+            for key, (line, state) in self._entries.items():
+                row = next(csv.reader([line]), None)
+                if row and row[0] in moves:
+                    # only the first column changes, the rest of the line (which sldl may have written) is kept as it is
+                    first_column_end = line.index('"', 1) + 1 if line.startswith('"') else line.index(",")
+                    self._entries[key] = (f'"{moves[row[0]]}"' + line[first_column_end:], state)
+                    changed += 1
+            if changed:
+                self._compact_locked()
+        return changed
+
+    # folds the journal into the snapshot so _index.sldl reflects every entry
+    def compact(self) -> None:
+        with self._thread_lock, file_lock(self.lock_filepath):
+            self._ensure_snapshot()
+            self._compact_locked()
+
+    # if our custom _index.sldl file doesn't already exist, create it with the header
+    def _ensure_snapshot(self) -> None:
+        if not os.path.exists(self.index_filepath) or os.path.getsize(self.index_filepath) == 0:
+            with open(self.index_filepath, "w", encoding="utf-8") as index_file:
+                index_file.write(INDEX_HEADER)
+
+    # returns a newline if the journal currently ends in the middle of a line
+    def _torn_line_prefix(self) -> str:
+        if not os.path.exists(self.journal_filepath) or os.path.getsize(self.journal_filepath) == 0:
+            return ""
+        with open(self.journal_filepath, "rb") as journal_file:
+            journal_file.seek(-1, os.SEEK_END)
+            return "" if journal_file.read(1) == b"\n" else "\n"
+
+    # applies one entry to the in memory view using the supersede rules
+    def _apply(self, line: str) -> None:
+        parsed = parse_index_line(line)
+        if parsed is None:
+            return
+
+        key, state = parsed
+        existing = self._entries.get(key)
+        # a failed attempt never replaces a successful download, anything else replaces the old entry
+        if existing is not None and state == FAILED_STATE and existing[1] != FAILED_STATE:
+            return
+        self._entries[key] = (line, state)
+
+    # brings the in memory view up to date with the files on disk, must be called while holding the lock
+    def _refresh_locked(self) -> None:
+        self._ensure_snapshot()
+        snapshot_stat = os.stat(self.index_filepath)
+        snapshot_stamp = (snapshot_stat.st_mtime_ns, snapshot_stat.st_size)
+        journal_size = os.path.getsize(self.journal_filepath) if os.path.exists(self.journal_filepath) else 0
+
+        # another process compacted the index since we last loaded it, so start over from the new snapshot
+        if self._entries is None or snapshot_stamp != self._snapshot_stamp or journal_size < self._journal_offset:
+            self._entries = {}
+            self._journal_offset = 0
+            with open(self.index_filepath, "r", encoding="utf-8", newline="") as index_file:
+                next(index_file, None)
+                for line in index_file:
+                    self._apply(line.rstrip("\r\n"))
+            self._snapshot_stamp = snapshot_stamp
+
+        # replay whatever was appended to the journal since we last read it
+        if journal_size > self._journal_offset:
+            with open(self.journal_filepath, "rb") as journal_file:
+                journal_file.seek(self._journal_offset)
+                for raw_line in journal_file:
+                    # a partially written last line (e.g. the process crashed mid write) is skipped until it's complete
+                    if not raw_line.endswith(b"\n"):
+                        break
+                    self._journal_offset += len(raw_line)
+                    self._apply(raw_line.decode("utf-8").rstrip("\r\n"))
+
+    # atomically rewrites the snapshot from the in memory view and truncates the journal, must be called while holding the lock
+    def _compact_locked(self) -> None:
+        self._refresh_locked()
+
+        temp_filepath = self.index_filepath + ".tmp"
+        with open(temp_filepath, "w", encoding="utf-8") as temp_file:
+            temp_file.write(INDEX_HEADER)
+            for line, _ in self._entries.values():
+                temp_file.write(line + "\n")
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_filepath, self.index_filepath)
+
+        # if we crash before this truncate the journal is just replayed again, which gives the same result since the supersede rules are idempotent
+        open(self.journal_filepath, "w", encoding="utf-8").close()
+
+        snapshot_stat = os.stat(self.index_filepath)
+        self._snapshot_stamp = (snapshot_stat.st_mtime_ns, snapshot_stat.st_size)
+        self._journal_offset = 0
@@ -1,16 +1,23 @@
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-import json
 import os
 from dotenv import load_dotenv
-import xml.etree.ElementTree as ET
-from pathlib import Path
-from xml.dom import minidom
-from tinytag import TinyTag
+import re
+import atexit
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from library_cache import LibraryCache
+from spotify_cache import SpotifyCache
+from spotify_paging import dump_jsonl, iter_playlist_items, iter_user_playlists, tee_jsonl
+from spotify_search import RateLimiter, TrackQuery, add_tracks_in_batches, call_spotify, resolve_track_uris
+from track_matcher import TrackMatcher
+from vdjfolder import VdjfolderWriter, iter_vdjfolder_songs
 
 load_dotenv()
 
-# ALTERNATIVES TO FEATURES ENDPOINT
+# the features endpoint is gone, bpm and key for the vdjfolder exports come from analyzing the files themselves (see audio_analysis.py)
+# other options if more than tempo, key and loudness is ever needed:
 #   - https://essentia.upf.edu/models.html
 #   - https://mtg.github.io/essentia.js/examples/demos/mood-classifiers/
 
@@ -18,141 +25,238 @@ CLIENT_ID = os.getenv("client_id")
 CLIENT_SECRET = os.getenv("client_secret")
 REDIRECT_URI = os.getenv("redirect_uri")
 SPOTIFY_SCOPE = "user-library-read playlist-modify-public"
-spotipy_client = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=SPOTIFY_SCOPE, client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI))
-USER_ID = spotipy_client.current_user()["id"]
-MUSIC_DIR = "D:\DJ\Music\Spotify Liked"
+# point the client at another implementation of the web api, e.g. fake_spotify_server.py (http://127.0.0.1:<port>/v1/), which accepts any token
+SPOTIFY_API_URL = os.getenv("spotify_api_url")
+SPOTIFY_API_TOKEN = os.getenv("spotify_api_token", "offline")
+# every request that goes through spotify_search.call_spotify shares this rate limit, including the ones from concurrent exports
+rate_limiter = RateLimiter()
+MUSIC_DIR = r"D:\DJ\Music\Spotify Liked"
+# every library folder to match against (scanned recursively), separated by os.pathsep (';' on windows), and how many processes read tags (empty means one per cpu)
+MUSIC_DIRS = os.getenv("music_dirs", MUSIC_DIR).split(os.pathsep)
+SCAN_WORKERS = int(os.getenv("scan_workers") or 0) or None
+# how many playlists export_all_playlists fetches at once
+EXPORT_WORKERS = 4
+
+# the spotify client, USER_ID and the cache are only created when something first needs them, so importing this module doesn't go through oauth or the network
+_lazy_lock = threading.Lock()
+_spotipy_client = None
+_user_id = None
+_spotify_cache = None
+
+def get_spotify_client():
+    global _spotipy_client
+    with _lazy_lock:
+        if _spotipy_client is None:
+            import spotipy
+
+            import requests
+
+            # spotipy's own session retries 429s with urllib3, sleeping out the Retry-After inside each thread (and dropping the header once its retries run out),
+            # so the client gets a plain session and every 429 reaches spotify_search.call_spotify, which pauses the shared rate limiter for all threads instead
+            if SPOTIFY_API_URL:
+                _spotipy_client = spotipy.Spotify(auth=SPOTIFY_API_TOKEN, requests_session=requests.Session())
+                _spotipy_client.prefix = SPOTIFY_API_URL.rstrip("/") + "/"
+            else:
+                from spotipy.oauth2 import SpotifyOAuth
+                _spotipy_client = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=SPOTIFY_SCOPE, client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI), requests_session=requests.Session())
+        return _spotipy_client
+
+def get_user_id():
+    global _user_id
+    if _user_id is None:
+        _user_id = call_spotify(rate_limiter, get_spotify_client().current_user)["id"]
+    return _user_id
+
+# playlist listings, playlist items and searches are cached in the catalog database, see spotify_cache.py
+# with SPOTIFY_API_URL set the responses aren't spotify's, so they're cached in a temporary database that's deleted on exit instead,
+# otherwise fake playlists and search results would end up in the catalog and be served to later runs against the real api
+def get_spotify_cache():
+    global _spotify_cache
+    with _lazy_lock:
+        if _spotify_cache is None:
+            if SPOTIFY_API_URL:
+                cache_dir = tempfile.mkdtemp(prefix="vdj-spotify-link-cache-")
+                atexit.register(shutil.rmtree, cache_dir, True)
+                _spotify_cache = SpotifyCache(os.path.join(cache_dir, "spotify_cache.sqlite"))
+                # atexit runs the last registered function first, so the cache is closed before its directory is removed
+                atexit.register(_spotify_cache.close)
+            else:
+                _spotify_cache = SpotifyCache()
+        return _spotify_cache
+
+# keeps spotify.spotipy_client and spotify.USER_ID working for code that used the old module level globals
+def __getattr__(name):
+    if name == "spotipy_client":
+        return get_spotify_client()
+    if name == "USER_ID":
+        return get_user_id()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def main():
-    create_spotify_playlist_from_music_dir("D:\DJ\Music\DJ Music\NeoSoul")
+    create_spotify_playlist_from_music_dir(r"D:\DJ\Music\DJ Music\NeoSoul")
 
 def create_spotify_playlist_from_music_dir(music_dir):
     pass
 
+# creates a spotify playlist from the songs in a .vdjfolder file, returns the (artist, title) of the songs spotify found nothing for
 def create_spotify_playlist_from_vdjfolder(vdjfolder_filepath, playlist_name):
-    tree = ET.parse(vdjfolder_filepath)
-
-    track_ids = []
-    for child in tree.getroot():
-        if "title" in child.attrib and "artist" in child.attrib:
-            title = child.attrib["title"]
-            artist = child.attrib["artist"]
-            track_id = spotipy_client.search(q=f"artist: {artist} track: {title}", type="track")
-            track_ids.append(track_id["tracks"]["items"][0]["id"])
-    
-    track_uris = ["spotify:track:" + track_id for track_id in track_ids]
-    spotipy_client.user_playlist_create(USER_ID, playlist_name)
-    playlist_id = get_playlist_id(playlist_name)
-    spotipy_client.user_playlist_add_tracks(USER_ID, playlist_id, track_uris)
+    queries = []
+    for song in iter_vdjfolder_songs(vdjfolder_filepath):
+        if "title" in song and "artist" in song:
+            queries.append(TrackQuery(song["artist"], song["title"]))
+
+    # the searches run concurrently, sharing one rate limiter with the playlist requests
+    spotipy_client = get_spotify_client()
+    track_uris, unresolved = resolve_track_uris(spotipy_client, queries, rate_limiter=rate_limiter, cache=get_spotify_cache())
+
+    playlist = call_spotify(rate_limiter, spotipy_client.user_playlist_create, get_user_id(), playlist_name)
+    add_tracks_in_batches(spotipy_client, playlist["id"], track_uris, rate_limiter=rate_limiter)
 
+    print(f"Added {len(track_uris)} of {len(queries)} tracks to {playlist_name}")
+    for query in unresolved:
+        print(f"No spotify results for {query.artist} - {query.title}")
+
+    return unresolved
+
+# looks the playlist up in the cached listing first, the listing is only refetched when the name isn't in it or the listing expired
 def get_playlist_id(playlist_name):
-    for playlist in get_all_playlists():
-        if playlist["name"] == playlist_name:
-            return playlist["id"]
+    spotify_cache = get_spotify_cache()
+    playlist_id = spotify_cache.get_playlist_id(playlist_name)
+    if playlist_id is None:
+        get_all_playlists(refresh=True)
+        playlist_id = spotify_cache.get_playlist_id(playlist_name)
 
-    return -1
+    return playlist_id if playlist_id is not None else -1
 
-def get_all_playlists(json_filepath=None):
-    playlists_info = spotipy_client.user_playlists(USER_ID, limit=1)
-    num_playlists = playlists_info["total"]
+def get_playlist_name(playlist_id):
+    return call_spotify(rate_limiter, get_spotify_client().playlist, playlist_id, fields="name")["name"]
 
-    all_playlists = []
-    offset = 0
+def get_all_playlists(jsonl_filepath=None, refresh=False):
+    spotify_cache = get_spotify_cache()
+    all_playlists = None if refresh else spotify_cache.get_playlists()
 
-    while offset < num_playlists:
-        new_playlists = spotipy_client.user_playlists(USER_ID, limit=50, offset=offset)
-        all_playlists.extend(new_playlists["items"])
-        offset += 50
+    if all_playlists is None:
+        all_playlists = list(iter_user_playlists(get_spotify_client(), get_user_id(), rate_limiter=rate_limiter))
+        spotify_cache.store_playlists(all_playlists)
 
-    if json_filepath is not None:
-        dump_json(all_playlists, json_filepath)
+    if jsonl_filepath is not None:
+        dump_jsonl(all_playlists, jsonl_filepath)
 
     return all_playlists
 
-def get_all_playlist_tracks(playlist_id, json_filepath=None):
-    all_tracks = []
-    offset = 0
+# yields the slim items of a playlist, optionally writing them to a .jsonl file as they go
+# the items are cached by the playlist's snapshot_id, so an unchanged playlist costs one small request for its snapshot_id
+def iter_playlist_tracks(playlist_id, jsonl_filepath=None):
+    spotipy_client = get_spotify_client()
+    spotify_cache = get_spotify_cache()
+    snapshot_id = call_spotify(rate_limiter, spotipy_client.playlist, playlist_id, fields="snapshot_id")["snapshot_id"]
 
-    while True:
-        response = spotipy_client.playlist_items(playlist_id=playlist_id, offset=offset)
-        all_tracks.extend(response["items"])
-        offset += 100
+    if spotify_cache.has_playlist_items(playlist_id, snapshot_id):
+        tracks = spotify_cache.iter_playlist_items(playlist_id)
+    else:
+        tracks = spotify_cache.tee_playlist_items(playlist_id, snapshot_id, iter_playlist_items(spotipy_client, playlist_id, rate_limiter=rate_limiter))
 
-        if len(response["items"]) < 100:
-            break
-        
-    if json_filepath is not None:
-        dump_json(all_tracks, json_filepath)
+    if jsonl_filepath is not None:
+        tracks = tee_jsonl(tracks, jsonl_filepath)
 
-    return all_tracks
+    yield from tracks
 
-def dump_json(contents, json_filepath):
-    with open(json_filepath, "w", encoding="utf-8") as file:
-        json.dump(contents, file)
+def get_all_playlist_tracks(playlist_id, jsonl_filepath=None):
+    return list(iter_playlist_tracks(playlist_id, jsonl_filepath))
 
 # creates a .vdjfolder file from a playlist_id
-def create_vdjfolder_from_playlist(playlist_id, vdjfolder_filepath):
-    # create the root and song entries
-    root = ET.Element("VirtualFolder", noDuplicates="no")
-    playlist_tracks = get_all_playlist_tracks(playlist_id, "output/sldl.json")
-    processed_songs = process_music_dir()
-
-    # for each track in the playlist, find its filepath and create an xml sub element with the info vdj needs
-    for i, track in enumerate(playlist_tracks):
-        spotify_title = track["track"]["name"]
-        spotify_artists = ", ".join([artist["name"] for artist in track["track"]["artists"]])
-
-        # if the song was found in the MUSIC_DIR dict, create an xml subelement with the info vdj needs, if it wasnt found, use spotify info and a palceholder filepath
-        if spotify_title.lower() in processed_songs:
-            metadata_title, metadata_artist, song_path = processed_songs[spotify_title.lower()]
-            ET.SubElement(root, "song", path=song_path, title=metadata_title, artist=metadata_artist, idx=str(i))
-        else:
-            # TODO: need a better way of indexing the dictionary, there are files that exist that are not being found because of non-identical titles
-            ET.SubElement(root, "song", path="Not Found", title=spotify_title, artist=spotify_artists, idx=str(i))
-            
-    # create the output_dir if it doesnt already exist
-    output_dir = os.path.dirname(vdjfolder_filepath)
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
-    
-    # reparse the string with minidom to get formatting
-    rough_string = ET.tostring(root, encoding="utf-8")
-    reparsed = minidom.parseString(rough_string)
-    pretty_xml = reparsed.toprettyxml(indent="    ")
-
-    # write the header and formatted xml
-    with open(vdjfolder_filepath, "w", encoding="utf-8") as file:
-        file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        file.write(pretty_xml.split('\n', 1)[1])
-
-def process_music_dir():
-    processed_songs = {}
+# pass a TrackMatcher to reuse one library index across playlists, otherwise MUSIC_DIRS is scanned for this playlist
+# pass {filepath: AnalysisResult} (see load_audio_analysis) to write the bpm and key of the matched files
+def create_vdjfolder_from_playlist(playlist_id, vdjfolder_filepath, matcher=None, jsonl_filepath="output/sldl.jsonl", analysis=None):
+    matcher = matcher or TrackMatcher(load_library_tracks())
+
+    # songs are written as they stream in from spotify, see vdjfolder.py
+    with VdjfolderWriter(vdjfolder_filepath) as writer:
+        # for each track in the playlist, find its file in the library index and write a song element with the info vdj needs
+        for track in iter_playlist_tracks(playlist_id, jsonl_filepath):
+            spotify_title = track["track"]["name"]
+            spotify_artist_names = [artist["name"] for artist in track["track"]["artists"]]
+            # duration_ms helps pick between files with the same title
+            match = matcher.match(spotify_title, spotify_artist_names, (track["track"].get("duration_ms") or 0) / 1000)
 
-    # for each file in the MUSIC_DIR, extract its metadata and add it to the dict
-    for filename in os.listdir(MUSIC_DIR):
-        filepath = os.path.join(MUSIC_DIR, filename)
-
-        if not os.path.isfile(filepath):
-            continue
-
-        try:
-            audio = TinyTag.get(filepath)
-
-            if audio.title and audio.artist:
-                processed_songs[audio.title.lower()] = (audio.title, audio.artist, filepath)
-                # print("Title:" + audio.title) 
-                # print("Artist: " + audio.artist)
-                # print("Genre:" + audio.genre) 
-                # print("Year Released: " + audio.year) 
-                # print("Bitrate:" + str(audio.bitrate) + " kBits/s") 
-                # print("Composer: " + audio.composer) 
-                # print("Filesize: " + str(audio.filesize) + " bytes") 
-                # print("AlbumArtist: " + audio.albumartist) 
-                # print("Duration: " + str(audio.duration) + " seconds") 
-                # print("TrackTotal: " + str(audio.track_total))  
+            # if the song was found in MUSIC_DIRS use its file and metadata, if it wasnt found, use spotify info and a placeholder filepath
+            if match is not None:
+                writer.add_song(match.track.path, match.track.title, match.track.artist, **analysis_attributes((analysis or {}).get(os.path.abspath(match.track.path))))
             else:
-                # TODO: add metadata with information from spotify 
-                print(f"No metadata found for {filename}")
-        except Exception as e:
-            print(f"Error when reading metadata of {filename}: {e}")
+                writer.add_song("Not Found", spotify_title, ", ".join(spotify_artist_names))
+
+# returns the playlist name with the characters windows doesn't allow in filenames replaced
+def safe_playlist_filename(playlist_name):
+    name = re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", playlist_name).strip().rstrip(".")
+    return name or "playlist"
+
+# returns a filename for the playlist that is valid on windows
+def vdjfolder_filename(playlist_name):
+    return f"{safe_playlist_filename(playlist_name)}.vdjfolder"
+
+# returns the song attributes vdj reads the bpm and key from, empty if the file wasn't (or couldn't be) analyzed
+# like Scan/@Bpm in the database (see vdj_ingest.parse_bpm), the bpm attribute holds the length of a beat in seconds, not beats per minute
+def analysis_attributes(result):
+    if result is None or result.error is not None:
+        return {}
+    return {"bpm": f"{60 / result.bpm:.6f}" if result.bpm else None, "key": result.key}
+
+# creates a .vdjfolder file in output_dir for every playlist from get_all_playlists
+# the library is scanned and indexed once for all of them, and EXPORT_WORKERS playlists are fetched at once
+# with analyze=True every library file that isn't in the analysis cache yet is analyzed first, otherwise only cached results are written
+# returns {playlist id: vdjfolder filepath}
+def export_all_playlists(output_dir, music_dirs=None, max_workers=EXPORT_WORKERS, analyze=False):
+    matcher = TrackMatcher(load_library_tracks(music_dirs))
+    analysis = load_audio_analysis([track.path for track in matcher.tracks], analyze)
+
+    # playlists with the same name (after removing characters windows doesn't allow) get their id appended
+    filepaths = {}
+    used_filenames = set()
+    for playlist in get_all_playlists():
+        filename = vdjfolder_filename(playlist["name"])
+        if filename.lower() in used_filenames:
+            filename = vdjfolder_filename(f"{playlist['name']} {playlist['id']}")
+        used_filenames.add(filename.lower())
+        filepaths[playlist["id"]] = os.path.join(output_dir, filename)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(create_vdjfolder_from_playlist, playlist_id, filepath, matcher, None, analysis): filepath
+            for playlist_id, filepath in filepaths.items()
+        }
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Could not export {os.path.basename(futures[future])}: {e}")
+
+    return filepaths
+
+# returns an iterator over a LibraryTrack for every song in MUSIC_DIRS that has a title and artist, read from the cache as it's iterated
+# tags are read through the library cache, so only files that are new or changed since the last scan are actually opened
+def load_library_tracks(music_dirs=None, workers=SCAN_WORKERS):
+    library_cache = LibraryCache()
+    try:
+        return library_cache.scan(music_dirs or MUSIC_DIRS, workers=workers)
+    finally:
+        library_cache.close()
+
+# returns {absolute filepath: AnalysisResult} for the files, analyzing the ones that aren't cached if analyze is true
+def load_audio_analysis(paths, analyze=False, workers=SCAN_WORKERS):
+    # imported here because audio_analysis imports numpy, which would slow down importing this module for everything that never analyzes audio
+    from audio_analysis import AudioAnalysisCache
+
+    analysis_cache = AudioAnalysisCache()
+    try:
+        return analysis_cache.analyze(paths, workers=workers) if analyze else analysis_cache.lookup(paths)
+    finally:
+        analysis_cache.close()
+
+# returns {lowercase title: (title, artist, filepath)} for every song in MUSIC_DIRS
+def process_music_dir(music_dirs=None, workers=SCAN_WORKERS):
+    processed_songs = {}
+    for track in load_library_tracks(music_dirs, workers):
+        processed_songs[track.title.lower()] = (track.title, track.artist, track.path)
 
     return processed_songs
 
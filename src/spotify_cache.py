@@ -0,0 +1,174 @@
+import json
+import sqlite3
+import threading
+import time
+
+from music_database import DATABASE_FILEPATH
+
+# caches spotify api responses in the catalog database so repeated exports don't refetch everything
+#   - playlist items are stored one row per item with the snapshot_id they were fetched at, one cheap request for the current snapshot_id tells us whether they are still valid
+#     they are written while they stream in from the api, and the snapshot_id is only recorded once every item is stored
+#   - the playlist listing is kept for LISTING_TTL seconds and indexed by name, so looking a playlist up by name doesn't page through every playlist
+#   - search results expire after SEARCH_TTL seconds, and the least recently used ones are evicted past SEARCH_MAX_ENTRIES
+
+SPOTIFY_CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS spotify_playlists (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    snapshot_id TEXT,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS spotify_playlists_name ON spotify_playlists (name);
+
+CREATE TABLE IF NOT EXISTS spotify_playlist_snapshots (
+    playlist_id TEXT PRIMARY KEY,
+    snapshot_id TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS spotify_playlist_items (
+    playlist_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (playlist_id, position)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS spotify_searches (
+    query TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    used_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS spotify_searches_used_at ON spotify_searches (used_at);
+
+CREATE TABLE IF NOT EXISTS spotify_cache_state (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+) WITHOUT ROWID;
+'''
+
+LISTING_TTL = 60 * 60
+SEARCH_TTL = 30 * 24 * 60 * 60
+SEARCH_MAX_ENTRIES = 20000
+# searches are evicted once every this many stored searches rather than on every one
+SEARCH_EVICT_INTERVAL = 100
+# playlist items are written in batches of this many
+ITEMS_BATCH_SIZE = 500
+
+class SpotifyCache:
+    def __init__(self, db_filepath: str = DATABASE_FILEPATH, listing_ttl: float = LISTING_TTL, search_ttl: float = SEARCH_TTL, search_max_entries: int = SEARCH_MAX_ENTRIES):
+        self.db_filepath = db_filepath
+        self.listing_ttl = listing_ttl
+        self.search_ttl = search_ttl
+        self.search_max_entries = search_max_entries
+        self._lock = threading.Lock()
+        self._searches_since_eviction = 0
+        self.conn = sqlite3.connect(db_filepath, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.executescript(SPOTIFY_CACHE_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock, self.conn:
+            self._evict_searches()
+        self.conn.close()
+
+    # returns whether the playlist listing was stored less than listing_ttl ago, must be called while holding the lock
+    def _listing_is_fresh(self) -> bool:
+        row = self.conn.execute("SELECT value FROM spotify_cache_state WHERE key = 'playlists_fetched_at'").fetchone()
+        return row is not None and time.time() - row[0] <= self.listing_ttl
+
+    # returns the cached playlist listing, or None if it was never stored or is older than listing_ttl
+    def get_playlists(self):
+        with self._lock:
+            if not self._listing_is_fresh():
+                return None
+            return [json.loads(data) for data, in self.conn.execute("SELECT data FROM spotify_playlists ORDER BY position")]
+
+    # replaces the cached playlist listing
+    def store_playlists(self, playlists: list) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM spotify_playlists")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO spotify_playlists (id, name, snapshot_id, position, data) VALUES (?, ?, ?, ?, ?)",
+                ((playlist["id"], playlist["name"], playlist.get("snapshot_id"), position, json.dumps(playlist)) for position, playlist in enumerate(playlists)),
+            )
+            self.conn.execute("INSERT OR REPLACE INTO spotify_cache_state (key, value) VALUES ('playlists_fetched_at', ?)", (time.time(),))
+
+    # returns the id of the first cached playlist with this name, or None if there's none or the listing is older than listing_ttl
+    # (a playlist that was renamed or deleted since would otherwise keep resolving to its old id)
+    def get_playlist_id(self, playlist_name: str):
+        with self._lock:
+            if not self._listing_is_fresh():
+                return None
+            row = self.conn.execute("SELECT id FROM spotify_playlists WHERE name = ? ORDER BY position LIMIT 1", (playlist_name,)).fetchone()
+        return row[0] if row else None
+
+    # returns whether every item of the playlist at this snapshot_id is cached
+    def has_playlist_items(self, playlist_id: str, snapshot_id: str) -> bool:
+        with self._lock:
+            row = self.conn.execute("SELECT 1 FROM spotify_playlist_snapshots WHERE playlist_id = ? AND snapshot_id = ?", (playlist_id, snapshot_id)).fetchone()
+        return row is not None
+
+    # yields the cached items of a playlist in order, straight from the database
+    def iter_playlist_items(self, playlist_id: str):
+        reader = sqlite3.connect(self.db_filepath, timeout=30)
+        try:
+            for data, in reader.execute("SELECT data FROM spotify_playlist_items WHERE playlist_id = ? ORDER BY position", (playlist_id,)):
+                yield json.loads(data)
+        finally:
+            reader.close()
+
+    # stores the items of a playlist while passing them through, the snapshot_id is recorded once the last item was stored
+    # if the generator isn't exhausted the playlist stays uncached
+    def tee_playlist_items(self, playlist_id: str, snapshot_id: str, items):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM spotify_playlist_snapshots WHERE playlist_id = ?", (playlist_id,))
+            self.conn.execute("DELETE FROM spotify_playlist_items WHERE playlist_id = ?", (playlist_id,))
+
+        batch = []
+        for position, item in enumerate(items):
+            batch.append((playlist_id, position, json.dumps(item)))
+            if len(batch) >= ITEMS_BATCH_SIZE:
+                self._store_playlist_items(batch)
+                batch = []
+            yield item
+        self._store_playlist_items(batch)
+
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO spotify_playlist_snapshots (playlist_id, snapshot_id, fetched_at) VALUES (?, ?, ?)", (playlist_id, snapshot_id, time.time()))
+
+    def _store_playlist_items(self, rows: list) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO spotify_playlist_items (playlist_id, position, data) VALUES (?, ?, ?)", rows)
+
+    # returns (True, result) for a search cached within search_ttl, otherwise (False, None). result can itself be None when spotify found nothing
+    def get_search(self, query: str) -> tuple:
+        now = time.time()
+        with self._lock, self.conn:
+            row = self.conn.execute("SELECT result FROM spotify_searches WHERE query = ? AND fetched_at > ?", (query, now - self.search_ttl)).fetchone()
+            if row is None:
+                return False, None
+            self.conn.execute("UPDATE spotify_searches SET used_at = ? WHERE query = ?", (now, query))
+        return True, json.loads(row[0])
+
+    # stores a search result, every SEARCH_EVICT_INTERVAL searches the expired ones and the least recently used ones past search_max_entries are evicted
+    def store_search(self, query: str, result) -> None:
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO spotify_searches (query, result, fetched_at, used_at) VALUES (?, ?, ?, ?)", (query, json.dumps(result), now, now))
+            self._searches_since_eviction += 1
+            if self._searches_since_eviction >= SEARCH_EVICT_INTERVAL:
+                self._evict_searches()
+
+    # expects self._lock to be held
+    def _evict_searches(self) -> None:
+        self._searches_since_eviction = 0
+        self.conn.execute("DELETE FROM spotify_searches WHERE fetched_at <= ?", (time.time() - self.search_ttl,))
+        self.conn.execute(
+            "DELETE FROM spotify_searches WHERE query IN (SELECT query FROM spotify_searches ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.search_max_entries,),
+        )
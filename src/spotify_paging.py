@@ -0,0 +1,83 @@
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from spotify_search import RateLimiter, call_spotify
+
+# pages through spotify listings without waiting on each page before asking for the next
+# the first page tells us the total, the remaining offsets are then fetched concurrently (a few pages ahead at most) and yielded in order
+# playlist items only ask for the fields we use (the fields parameter), and everything is yielded as slim records from generators, so memory stays flat on 10k+ track playlists
+
+DEFAULT_WORKERS = 4
+# how many pages may be fetched ahead of the one being yielded, per worker
+PAGES_AHEAD_PER_WORKER = 2
+PLAYLIST_ITEMS_PAGE_SIZE = 100
+PLAYLISTS_PAGE_SIZE = 50
+
+# the same shape as a full playlist item ({"track": {"name": ..., "artists": [{"name": ...}], ...}}), just without album images, markets etc.
+PLAYLIST_ITEM_FIELDS = "total,items(track(id,uri,name,duration_ms,is_local,artists(name),album(name)))"
+
+# yields every item of a paginated listing in order. fetch_page(offset, limit) returns a response with "items" and "total"
+def iter_pages(fetch_page, page_size: int, max_workers: int = DEFAULT_WORKERS):
+    first_page = fetch_page(0, page_size)
+    yield from first_page["items"]
+
+    offsets = iter(range(page_size, first_page["total"], page_size))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for offset in offsets:
+            pending.append(executor.submit(fetch_page, offset, page_size))
+            if len(pending) >= max_workers * PAGES_AHEAD_PER_WORKER:
+                break
+
+        while pending:
+            page = pending.popleft().result()
+            next_offset = next(offsets, None)
+            if next_offset is not None:
+                pending.append(executor.submit(fetch_page, next_offset, page_size))
+            yield from page["items"]
+
+# keeps the fields of a playlist listing entry that we use
+def slim_playlist(playlist: dict) -> dict:
+    return {
+        "id": playlist["id"],
+        "name": playlist["name"],
+        "snapshot_id": playlist.get("snapshot_id"),
+        "owner": {"id": (playlist.get("owner") or {}).get("id")},
+        "tracks": {"total": (playlist.get("tracks") or {}).get("total")},
+    }
+
+# yields the slim items of a playlist in order, items whose track was removed from spotify come back as null and are skipped
+def iter_playlist_items(client, playlist_id: str, rate_limiter: RateLimiter = None, max_workers: int = DEFAULT_WORKERS):
+    rate_limiter = rate_limiter or RateLimiter()
+
+    def fetch_page(offset: int, limit: int) -> dict:
+        return call_spotify(rate_limiter, client.playlist_items, playlist_id, fields=PLAYLIST_ITEM_FIELDS, limit=limit, offset=offset)
+
+    for item in iter_pages(fetch_page, PLAYLIST_ITEMS_PAGE_SIZE, max_workers):
+        if item.get("track"):
+            yield item
+
+# yields the slim playlists of a user in order
+def iter_user_playlists(client, user_id: str, rate_limiter: RateLimiter = None, max_workers: int = DEFAULT_WORKERS):
+    rate_limiter = rate_limiter or RateLimiter()
+
+    def fetch_page(offset: int, limit: int) -> dict:
+        return call_spotify(rate_limiter, client.user_playlists, user_id, limit=limit, offset=offset)
+
+    for playlist in iter_pages(fetch_page, PLAYLISTS_PAGE_SIZE, max_workers):
+        yield slim_playlist(playlist)
+
+# passes the records through while writing each one as a line of json, the file is complete once the generator is exhausted
+def tee_jsonl(records, jsonl_filepath: str):
+    with open(jsonl_filepath, "w", encoding="utf-8") as file:
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            yield record
+
+# writes the records as json lines and returns how many there were
+def dump_jsonl(records, jsonl_filepath: str) -> int:
+    count = 0
+    for _ in tee_jsonl(records, jsonl_filepath):
+        count += 1
+    return count
@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from spotipy import SpotifyException
+
+# resolves (artist, title) pairs to spotify track uris and adds them to playlists
+# searches run on a bounded thread pool and all of them draw from one shared token bucket, so the pool can't outrun spotify's rate limit
+# when spotify answers 429 anyway, the whole bucket pauses for the Retry-After it sent instead of every thread hammering it again
+# identical (artist, title) pairs are only searched once, and with a SpotifyCache, not again until the cached result expires
+
+DEFAULT_WORKERS = 8
+# requests per second, and how many can go out at once after an idle period
+DEFAULT_RATE = 40
+DEFAULT_BURST = 10
+MAX_RETRIES = 5
+# spotify rejects adding more than this many tracks per request
+ADD_BATCH_SIZE = 100
+
+TrackQuery = namedtuple("TrackQuery", ["artist", "title"])
+
+# a token bucket shared by every thread talking to spotify
+class RateLimiter:
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # blocks until a request is allowed
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                    self._updated_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+    # stops every thread from sending requests for the next seconds, and empties the bucket so they don't all fire at once afterwards
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._updated_at = self._paused_until
+
+# calls a spotipy method through the rate limiter, retrying on 429 and 5xx responses
+def call_spotify(rate_limiter: RateLimiter, method, *args, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        try:
+            return method(*args, **kwargs)
+        except SpotifyException as e:
+            if attempt == MAX_RETRIES or not (e.http_status == 429 or e.http_status >= 500):
+                raise
+            retry_after = (e.headers or {}).get("Retry-After")
+            rate_limiter.pause(float(retry_after) if retry_after else 2 ** attempt)
+
+# returns the uri of the first search result for the track, or None if spotify found nothing
+def search_track_uri(client, rate_limiter: RateLimiter, query: TrackQuery, cache=None):
+    search_query = f"artist: {query.artist} track: {query.title}"
+    if cache is not None:
+        found, uri = cache.get_search(search_query)
+        if found:
+            return uri
+
+    results = call_spotify(rate_limiter, client.search, q=search_query, type="track", limit=1)
+    items = results["tracks"]["items"]
+    uri = items[0]["uri"] if items else None
+
+    if cache is not None:
+        cache.store_search(search_query, uri)
+    return uri
+
+# like search_track_uri, but a query spotify rejects (e.g. a 400 for an odd title) is logged and returns None instead of raising,
+# so one bad query doesn't abort the whole playlist. rate limits and server errors that outlasted the retries still raise
+def _search_track_uri_or_none(client, rate_limiter: RateLimiter, query: TrackQuery, cache=None):
+    try:
+        return search_track_uri(client, rate_limiter, query, cache)
+    except SpotifyException as e:
+        if e.http_status == 429 or e.http_status >= 500:
+            raise
+        print(f"ERROR: spotify search for {query.artist} - {query.title} failed: {e}")
+        return None
+
+# resolves every query concurrently, returns (uris, unresolved): the uris of the found tracks in the order of the queries, and the queries spotify found nothing for (or rejected)
+def resolve_track_uris(client, queries, max_workers: int = DEFAULT_WORKERS, rate_limiter: RateLimiter = None, cache=None) -> tuple:
+    queries = [TrackQuery(*query) for query in queries]
+    rate_limiter = rate_limiter or RateLimiter()
+    unique_queries = list(dict.fromkeys(queries))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        uris_by_query = dict(zip(unique_queries, executor.map(lambda query: _search_track_uri_or_none(client, rate_limiter, query, cache), unique_queries)))
+
+    uris = [uris_by_query[query] for query in queries if uris_by_query[query] is not None]
+    unresolved = [query for query in unique_queries if uris_by_query[query] is None]
+    return uris, unresolved
+
+# adds tracks to a playlist ADD_BATCH_SIZE at a time, in order
+def add_tracks_in_batches(client, playlist_id: str, track_uris: list, rate_limiter: RateLimiter = None) -> None:
+    rate_limiter = rate_limiter or RateLimiter()
+    for i in range(0, len(track_uris), ADD_BATCH_SIZE):
+        call_spotify(rate_limiter, client.playlist_add_items, playlist_id, track_uris[i:i + ADD_BATCH_SIZE])
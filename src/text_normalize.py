@@ -0,0 +1,34 @@
+import re
+import unicodedata
+
+# shared text normalization for comparing titles and artists from spotify, youtube, soulseek and file tags
+# everything here keeps non latin scripts intact (str.isalnum is true for e.g. '大掃除'), so japanese or korean titles still normalize to something non empty
+
+_NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+# latin letters that unicode doesn't decompose into a base letter plus an accent
+_LATIN_FOLDS = str.maketrans({"ø": "o", "Ø": "O", "æ": "ae", "Æ": "AE", "œ": "oe", "Œ": "OE", "ł": "l", "Ł": "L", "đ": "d", "Đ": "D", "ð": "d", "þ": "th", "Þ": "TH", "ı": "i"})
+
+# folds case, compatibility forms (full width characters etc.) and accents, then replaces punctuation with single spaces
+def normalize_text(text: str) -> str:
+    if not text:
+        return ""
+
+    decomposed = unicodedata.normalize("NFKD", text.translate(_LATIN_FOLDS))
+    without_marks = "".join(char for char in decomposed if not unicodedata.combining(char))
+    folded = unicodedata.normalize("NFKC", without_marks).casefold()
+    return _NON_WORD_PATTERN.sub(" ", folded).strip()
+
+# returns the set of character n-grams of the normalized text (spaces removed), which works for scripts that don't separate words with spaces
+def char_ngrams(text: str, n: int = 2) -> set:
+    compact = normalize_text(text).replace(" ", "")
+    if len(compact) <= n:
+        return {compact} if compact else set()
+    return {compact[i:i + n] for i in range(len(compact) - n + 1)}
+
+# returns how much of needle appears in haystack, from 0 (nothing) to 1 (all of it)
+def containment(needle: str, haystack: str) -> float:
+    needle_grams = char_ngrams(needle)
+    if not needle_grams:
+        return 0.0
+    return len(needle_grams & char_ngrams(haystack)) / len(needle_grams)
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+from file_lock import file_lock
+
+# structured timings for every track the helper handles, so a slow run can be broken down into where the time actually went
+# each track gets a TrackTimer, and once its index and log writes are committed all of its spans are appended to sldl_helper/timings.jsonl as one line per span:
+#   {"run": "...", "track": "<spotify uri>", "title": "...", "artist": "...", "state": "Downloaded", "stage": "index_update", "start": <unix time>, "seconds": 0.0012}
+# the stages of a track are:
+#   helper          everything from the helper receiving the track until its index and log entries were written
+#   ytdlp_search    finding and ranking youtube candidates for a track sldl couldn't download
+#   ytdlp_download  the youtube download, including yt-dlp's postprocessing
+#   transcode       the conversion to mp3 inside ytdlp_download (only measured when yt-dlp runs through its python api, with main.py --postprocess inline)
+#   postprocess     converting and tagging the raw youtube download on the post processing pool (see postprocess.py)
+#   index_update    writing the _index.sldl entry
+#   log_append      writing the log block
+#   catalog         writing the track to the music catalog
+# main.py adds spans without a track for the whole run (run), sldl itself (sldl) and index_fixer.py (index_fixer)
+# `python main.py report <output dir>` summarizes a run, see report() below
+
+TRACE_FILENAME = "timings.jsonl"
+
+# main.py puts the id of the run in the environment, so every helper process and the daemon label their spans with the same run
+RUN_ID_ENV = "SLDL_HELPER_RUN_ID"
+_process_run_id = None
+
+PERCENTILES = (50, 90, 99)
+
+def new_run_id() -> str:
+    return datetime.now().strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+
+# returns the id of the current run, a process that wasn't started by main.py is its own run
+def current_run_id() -> str:
+    global _process_run_id
+    if os.environ.get(RUN_ID_ENV):
+        return os.environ[RUN_ID_ENV]
+    if _process_run_id is None:
+        _process_run_id = new_run_id()
+    return _process_run_id
+
+# collects the spans of one track, stages can be timed from several threads (e.g. the yt-dlp pool)
+class TrackTimer:
+    def __init__(self):
+        self.started_at = time.time()
+        self._started_monotonic = time.monotonic()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, start: float, seconds: float) -> None:
+        with self._lock:
+            self.spans.append((stage, start, seconds))
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.time()
+        started_monotonic = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, start, time.monotonic() - started_monotonic)
+
+    # adds the helper span, which runs from when the timer was created until now
+    def finish(self) -> None:
+        self.add("helper", self.started_at, time.monotonic() - self._started_monotonic)
+
+# appends spans to a trace file, several helper processes can write to the same file at once
+class TraceWriter:
+    def __init__(self, trace_filepath: str):
+        self.trace_filepath = trace_filepath
+        self.lock_filepath = trace_filepath + ".lock"
+        self._thread_lock = threading.Lock()
+
+    # writes every span of a track in one go, fields (track, title, artist...) are added to each span
+    def write_track(self, timer: TrackTimer, **fields) -> None:
+        self._write([span_record(stage, start, seconds, **fields) for stage, start, seconds in timer.spans])
+
+    def write_span(self, stage: str, start: float, seconds: float, **fields) -> None:
+        self._write([span_record(stage, start, seconds, **fields)])
+
+    # times a block and writes it as a span straight away, for the stages of a whole run
+    @contextmanager
+    def span(self, stage: str, **fields):
+        start = time.time()
+        started_monotonic = time.monotonic()
+        try:
+            yield
+        finally:
+            self.write_span(stage, start, time.monotonic() - started_monotonic, **fields)
+
+    def _write(self, records: list) -> None:
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self._thread_lock, file_lock(self.lock_filepath):
+            with open(self.trace_filepath, "a", encoding="utf-8") as trace_file:
+                trace_file.write(lines)
+
+def span_record(stage: str, start: float, seconds: float, **fields) -> dict:
+    return {"run": current_run_id(), **fields, "stage": stage, "start": round(start, 6), "seconds": round(seconds, 6)}
+
+# returns every span in a trace file, skipping lines that were cut off by a crash
+def read_trace(trace_filepath: str) -> list:
+    spans = []
+    with open(trace_filepath, "r", encoding="utf-8") as trace_file:
+        for line in trace_file:
+            try:
+                spans.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return spans
+
+# the pth percentile of values, interpolating between the closest ranks
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = (len(values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+# returns the text report for one run of a trace file, the latest run if run_id is None
+def report(trace_filepath: str, run_id: str = None, top: int = 10) -> str:
+    spans = read_trace(trace_filepath)
+    if not spans:
+        return f"No timings in {trace_filepath}"
+
+    run_ids = list(dict.fromkeys(span["run"] for span in spans))
+    run_id = run_id or run_ids[-1]
+    spans = [span for span in spans if span["run"] == run_id]
+    if not spans:
+        return f"No timings for run {run_id}, runs in {trace_filepath}: {', '.join(run_ids)}"
+
+    stage_seconds = defaultdict(list)
+    tracks = {}
+    for span in spans:
+        stage_seconds[span["stage"]].append(span["seconds"])
+        if span.get("track") is not None:
+            track = tracks.setdefault(span["track"], {"title": span.get("title"), "artist": span.get("artist"), "stages": defaultdict(float)})
+            track["stages"][span["stage"]] += span["seconds"]
+
+    # the run span from main.py is the most accurate wall time, otherwise use the first and last span
+    run_span = next((span for span in spans if span["stage"] == "run"), None)
+    wall_seconds = run_span["seconds"] if run_span else max(span["start"] + span["seconds"] for span in spans) - min(span["start"] for span in spans)
+    tracks_per_minute = len(tracks) / wall_seconds * 60 if wall_seconds > 0 else 0.0
+
+    lines = [
+        f"Run {run_id}: {len(tracks)} tracks in {wall_seconds:.1f}s, {tracks_per_minute:.1f} tracks/min",
+        "",
+        f"{'stage':<16}{'count':>7}{'total':>11}" + "".join(f"{f'p{p}':>10}" for p in PERCENTILES) + f"{'max':>10}",
+    ]
+    # slowest stages first, by the total time spent in them
+    for stage, seconds in sorted(stage_seconds.items(), key=lambda item: sum(item[1]), reverse=True):
+        lines.append(f"{stage:<16}{len(seconds):>7}{sum(seconds):>10.2f}s" + "".join(f"{percentile(seconds, p):>9.3f}s" for p in PERCENTILES) + f"{max(seconds):>9.3f}s")
+
+    slowest = sorted(tracks.values(), key=lambda track: track["stages"].get("helper", 0.0), reverse=True)[:top]
+    if slowest:
+        lines += ["", f"Slowest {len(slowest)} tracks:"]
+        for track in slowest:
+            # the helper span contains the others, so the slowest stage is picked from the rest
+            # plus the time the track spent waiting (for a worker, or for earlier tracks to be committed first)
+            stages = {stage: seconds for stage, seconds in track["stages"].items() if stage not in ("helper", "transcode")}
+            stages["waiting"] = max(track["stages"].get("helper", 0.0) - sum(stages.values()), 0.0)
+            track["stages"]["waiting"] = stages["waiting"]
+            slowest_stage = max(stages, key=stages.get)
+            lines.append(f"  {track['stages'].get('helper', 0.0):>8.3f}s  {track['artist']} - {track['title']} (mostly {slowest_stage}, {track['stages'][slowest_stage]:.3f}s)")
+
+    return "\n".join(lines)
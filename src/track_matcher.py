@@ -0,0 +1,167 @@
+import re
+from collections import Counter, defaultdict, namedtuple
+
+from text_normalize import normalize_text
+
+# matches spotify tracks to files in the local library
+# titles and artists are normalized first (feat. credits, remix/remaster tags and punctuation removed, unicode folded, multiple artists split up),
+# then an inverted index from title tokens to library tracks gives a short list of candidates for each track, which are scored on title, artist and duration
+# building the index is linear in the library size, after that each lookup only touches the candidates that share a token with the title
+
+# (feat. someone), [ft. someone], or a trailing "feat. someone"
+FEATURE_PATTERN = re.compile(r"\s*[\(\[](?:feat|ft|featuring|with)\b\.?[^\)\]]*[\)\]]|\s+(?:feat|ft|featuring)\b\.?\s.*$", re.IGNORECASE)
+# (xyz remix), [radio edit], (2011 remaster)...
+VERSION_PATTERN = re.compile(r"\s*[\(\[][^\)\]]*\b(?:remix|mix|edit|version|remaster(?:ed)?|live|mono|stereo|radio|extended|original|demo|acoustic)\b[^\)\]]*[\)\]]", re.IGNORECASE)
+# " - 2011 Remaster", " - Radio Edit", " - Live at ..."
+VERSION_SUFFIX_PATTERN = re.compile(r"\s+-\s+[^-]*\b(?:remix|mix|edit|version|remaster(?:ed)?|live|mono|stereo|radio|extended|original|demo|acoustic)\b.*$", re.IGNORECASE)
+ARTIST_SEPARATOR_PATTERN = re.compile(r"\s*(?:,|;|/|&|\+|\bx\b|\band\b|\bfeat\b\.?|\bft\b\.?|\bfeaturing\b|\bwith\b|\bvs\b\.?)\s*", re.IGNORECASE)
+
+MATCH_THRESHOLD = 0.6
+# the title alone has to be at least this similar (jaccard of the tokens), whatever the artist and duration score,
+# so a title that only shares a prefix with another one ("hold on" and "hold on tight", 2 of 3 tokens) isn't matched to it
+MIN_TITLE_SCORE = 0.75
+TITLE_WEIGHT = 0.6
+ARTIST_WEIGHT = 0.3
+DURATION_WEIGHT = 0.1
+# a duration off by this many seconds or more scores 0
+DURATION_TOLERANCE = 10
+
+# how many of the tracks sharing the most tokens with a title are fully scored
+MAX_CANDIDATES = 50
+
+TrackMatch = namedtuple("TrackMatch", ["track", "score"])
+
+# returns the title without feat. credits and version tags, normalized
+def normalize_title(title: str) -> str:
+    title = title or ""
+    stripped = VERSION_SUFFIX_PATTERN.sub("", VERSION_PATTERN.sub("", FEATURE_PATTERN.sub("", title)))
+    # if the whole title was a version tag, keep it rather than matching on nothing
+    return normalize_text(stripped) or normalize_text(title)
+
+# returns the set of normalized artist names in an artist string (or list of artist strings)
+def split_artists(artists) -> frozenset:
+    if isinstance(artists, str):
+        artists = [artists]
+    names = set()
+    for artist in artists:
+        for name in ARTIST_SEPARATOR_PATTERN.split(artist or ""):
+            normalized = normalize_text(name)
+            if normalized:
+                names.add(normalized)
+    return frozenset(names)
+
+# returns the tokens used for the inverted index: words, plus character bigrams for words in scripts that don't use spaces
+def title_tokens(normalized_title: str) -> set:
+    tokens = set()
+    for word in normalized_title.split():
+        tokens.add(word)
+        if not word.isascii() and len(word) > 2:
+            tokens.update(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class TrackMatcher:
+    # tracks are LibraryTrack like tuples with path, title, artist and duration
+    def __init__(self, tracks):
+        self.tracks = []
+        self._titles = []
+        self._title_tokens = []
+        self._artists = []
+        self._postings = defaultdict(list)
+        self._by_title = defaultdict(list)
+
+        for track in tracks:
+            index = len(self.tracks)
+            normalized_title = normalize_title(track.title)
+            tokens = title_tokens(normalized_title)
+            self.tracks.append(track)
+            self._titles.append(normalized_title)
+            self._title_tokens.append(tokens)
+            self._artists.append(split_artists(track.artist))
+            self._by_title[normalized_title].append(index)
+            for token in tokens:
+                self._postings[token].append(index)
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    # returns the indexes of the library tracks sharing the most title tokens with the query
+    def _candidates(self, tokens: set) -> list:
+        hits = Counter()
+        # rare tokens first, and very common ones (e.g. "the", "love") are skipped once rarer tokens already gave us candidates
+        common_limit = max(MAX_CANDIDATES * 20, len(self.tracks) // 20)
+        for token in sorted(tokens, key=lambda token: len(self._postings.get(token, ()))):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            if len(postings) > common_limit and hits:
+                break
+            hits.update(postings)
+        return [index for index, _ in hits.most_common(MAX_CANDIDATES)]
+
+    def _score(self, index: int, normalized_title: str, tokens: set, artists: frozenset, duration) -> float:
+        title_score = 1.0 if self._titles[index] == normalized_title else _jaccard(tokens, self._title_tokens[index])
+        if title_score < MIN_TITLE_SCORE:
+            return 0.0
+
+        track_artists = self._artists[index]
+        if artists and track_artists:
+            artist_score = len(artists & track_artists) / len(artists)
+            # e.g. "the weeknd" vs "weeknd", fall back to substring containment
+            if artist_score == 0 and any(a in b or b in a for a in artists for b in track_artists):
+                artist_score = 0.8
+            # the same title by someone else is another song ("home" by x isn't "home" by y), even though title and duration alone would clear the threshold
+            if artist_score == 0:
+                return 0.0
+        else:
+            artist_score = 0.0
+
+        weighted_scores = [(title_score, TITLE_WEIGHT), (artist_score, ARTIST_WEIGHT)]
+        track_duration = self.tracks[index].duration
+        if duration and track_duration:
+            weighted_scores.append((max(0.0, 1 - abs(track_duration - duration) / DURATION_TOLERANCE), DURATION_WEIGHT))
+        return sum(score * weight for score, weight in weighted_scores) / sum(weight for _, weight in weighted_scores)
+
+    # returns the best TrackMatch for a spotify title, artists (a string or a list) and duration in seconds, or None if nothing scored above the threshold
+    def match(self, title: str, artists, duration=None):
+        normalized_title = normalize_title(title)
+        tokens = title_tokens(normalized_title)
+        artist_names = split_artists(artists)
+
+        # most tracks have a file with exactly the same normalized title, in which case the token index isn't needed
+        candidates = self._by_title.get(normalized_title)
+        if not candidates or not any(artist_names & self._artists[index] for index in candidates):
+            candidates = self._candidates(tokens)
+
+        best_index, best_score = None, MATCH_THRESHOLD
+        for index in candidates:
+            score = self._score(index, normalized_title, tokens, artist_names, duration)
+            # ties (e.g. the same song in two folders) are broken by whichever duration is closest
+            if score > best_score or (best_index is not None and score == best_score and self._closer_duration(index, best_index, duration)):
+                best_index, best_score = index, score
+
+        return TrackMatch(self.tracks[best_index], best_score) if best_index is not None else None
+
+    def _closer_duration(self, index: int, other_index: int, duration) -> bool:
+        if not duration:
+            return False
+        track_duration = self.tracks[index].duration
+        other_duration = self.tracks[other_index].duration
+        if not track_duration:
+            return False
+        return not other_duration or abs(track_duration - duration) < abs(other_duration - duration)
+
+    # matches a whole batch of (title, artists, duration) queries, identical queries are only scored once
+    def match_many(self, queries) -> list:
+        results = {}
+        matches = []
+        for title, artists, duration in queries:
+            key = (title, tuple(artists) if isinstance(artists, list) else artists, duration)
+            if key not in results:
+                results[key] = self.match(title, artists, duration)
+            matches.append(results[key])
+        return matches
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from collections import namedtuple
+
+from music_database import DATABASE_FILEPATH
+from vdjfolder import iter_elements
+
+# imports the metadata virtualdj keeps in its database.xml (bpm, key, cues, play counts...) into the catalog database
+# database.xml is hundreds of MB, so it's read with iterparse: every <Song> is processed as soon as it ends and then cleared, and rows are written in batches,
+# so memory stays flat no matter how big the file is
+#
+# virtualdj keeps a database.xml on every drive, each one is tracked as its own source
+# re-ingesting is incremental:
+#   - if database.xml's size and mtime didn't change since the last ingest, nothing is read at all
+#   - otherwise each <Song> is hashed and only songs whose hash changed are written, songs that disappeared from database.xml are dropped afterwards
+
+VDJ_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS vdj_songs (
+    filepath TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    stamp TEXT NOT NULL,
+    file_size INTEGER,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    genre TEXT,
+    length REAL,
+    bpm REAL,
+    key TEXT,
+    play_count INTEGER,
+    cues TEXT,
+    seen_run INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS vdj_songs_source ON vdj_songs (source, seen_run);
+
+CREATE TABLE IF NOT EXISTS vdj_ingest_state (
+    source TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    run INTEGER NOT NULL
+) WITHOUT ROWID;
+'''
+
+BATCH_SIZE = 500
+
+VdjSong = namedtuple("VdjSong", ["filepath", "file_size", "title", "artist", "album", "genre", "length", "bpm", "key", "play_count", "cues"])
+
+def _float(value):
+    try:
+        return float(value) if value not in (None, "") else None
+    except ValueError:
+        return None
+
+def _int(value):
+    number = _float(value)
+    return int(number) if number is not None else None
+
+# virtualdj 8 stores the length of a beat in seconds in Scan/@Bpm (0.5 is 120 bpm), older versions store the bpm itself, so values below 10 are converted with 60 / value
+# the vdjfolder exports write their bpm attribute in seconds per beat too (see spotify.analysis_attributes)
+def parse_bpm(value):
+    number = _float(value)
+    if not number:
+        return None
+    return round(60 / number, 3) if number < 10 else number
+
+# returns (stamp, VdjSong) for a <Song> element, the stamp changes whenever anything in the element does
+def parse_song(element) -> tuple:
+    digest = hashlib.blake2b(digest_size=16)
+    for child in element.iter():
+        digest.update(child.tag.encode())
+        digest.update(repr(sorted(child.attrib.items())).encode())
+        digest.update((child.text or "").strip().encode())
+
+    tags = element.find("Tags")
+    infos = element.find("Infos")
+    scan = element.find("Scan")
+    tags = tags.attrib if tags is not None else {}
+    infos = infos.attrib if infos is not None else {}
+    scan = scan.attrib if scan is not None else {}
+
+    # only named cue points, the beatgrid and automix markers are also <Poi> elements
+    cues = [
+        {"name": poi.get("Name"), "pos": _float(poi.get("Pos")), "num": _int(poi.get("Num"))}
+        for poi in element.iter("Poi") if poi.get("Type") == "cue"
+    ]
+
+    song = VdjSong(
+        element.get("FilePath"),
+        _int(element.get("FileSize")),
+        tags.get("Title"),
+        tags.get("Author"),
+        tags.get("Album"),
+        tags.get("Genre"),
+        _float(infos.get("SongLength")),
+        parse_bpm(scan.get("Bpm")),
+        scan.get("Key"),
+        _int(infos.get("PlayCount")),
+        cues,
+    )
+    return digest.hexdigest(), song
+
+# counts what an ingest did and reports it
+class IngestStats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.songs = 0
+        self.changed = 0
+        self.removed = 0
+        self.skipped_file = False
+
+    def report(self) -> str:
+        if self.skipped_file:
+            return "database.xml is unchanged since the last ingest, nothing to do"
+        elapsed = time.perf_counter() - self.started_at
+        return f"Ingested {self.songs} songs ({self.changed} changed, {self.removed} removed) in {elapsed:.2f}s"
+
+class VdjIngest:
+    def __init__(self, db_filepath: str = DATABASE_FILEPATH, batch_size: int = BATCH_SIZE):
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_filepath, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.executescript(VDJ_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    # ingests a database.xml, force reads it even if its size and mtime didn't change
+    def ingest(self, xml_filepath: str, force: bool = False) -> IngestStats:
+        stats = IngestStats()
+        source = os.path.abspath(xml_filepath)
+        stat = os.stat(source)
+
+        with self._lock:
+            state = self.conn.execute("SELECT mtime_ns, size, run FROM vdj_ingest_state WHERE source = ?", (source,)).fetchone()
+        if state is not None and not force and (state[0], state[1]) == (stat.st_mtime_ns, stat.st_size):
+            stats.skipped_file = True
+            return stats
+        # every song seen in this run is marked with the run number, the ones left with an older number were removed from database.xml
+        run = (state[2] if state is not None else 0) + 1
+
+        batch = []
+        for element in iter_elements(source, "Song"):
+            if not element.get("FilePath"):
+                continue
+            batch.append(parse_song(element))
+            stats.songs += 1
+            if len(batch) >= self.batch_size:
+                stats.changed += self._store(batch, source, run)
+                batch = []
+        stats.changed += self._store(batch, source, run)
+
+        with self._lock, self.conn:
+            stats.removed = self.conn.execute("DELETE FROM vdj_songs WHERE source = ? AND seen_run != ?", (source, run)).rowcount
+            self.conn.execute("INSERT OR REPLACE INTO vdj_ingest_state (source, mtime_ns, size, run) VALUES (?, ?, ?, ?)", (source, stat.st_mtime_ns, stat.st_size, run))
+        return stats
+
+    # writes the songs whose stamp changed and marks the others as seen, returns how many changed
+    def _store(self, batch: list, source: str, run: int) -> int:
+        if not batch:
+            return 0
+
+        with self._lock, self.conn:
+            placeholders = ", ".join("?" for _ in batch)
+            stored = dict(self.conn.execute(f"SELECT filepath, stamp FROM vdj_songs WHERE filepath IN ({placeholders})", [song.filepath for _, song in batch]))
+            changed = [(stamp, song) for stamp, song in batch if stored.get(song.filepath) != stamp]
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO vdj_songs (filepath, source, stamp, file_size, title, artist, album, genre, length, bpm, key, play_count, cues, seen_run) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((song.filepath, source, stamp, song.file_size, song.title, song.artist, song.album, song.genre, song.length, song.bpm, song.key, song.play_count, json.dumps(song.cues), run) for stamp, song in changed),
+            )
+            self.conn.executemany("UPDATE vdj_songs SET source = ?, seen_run = ? WHERE filepath = ?", ((source, run, song.filepath) for stamp, song in batch if stored.get(song.filepath) == stamp))
+        return len(changed)
+
+    # returns the VdjSong for a file, or None if virtualdj doesn't know it
+    def get_song(self, filepath: str):
+        with self._lock:
+            row = self.conn.execute("SELECT filepath, file_size, title, artist, album, genre, length, bpm, key, play_count, cues FROM vdj_songs WHERE filepath = ?", (filepath,)).fetchone()
+        if row is None:
+            return None
+        return VdjSong(*row[:-1], json.loads(row[-1]) if row[-1] else [])
+
+def main():
+    parser = argparse.ArgumentParser(description="Import the song metadata from a VirtualDJ database.xml into the music catalog")
+    parser.add_argument("database_xml", help="Path to VirtualDJ's database.xml")
+    parser.add_argument("--database", default=DATABASE_FILEPATH, help="Path to the catalog database")
+    parser.add_argument("--force", action="store_true", help="Read database.xml even if it didn't change since the last ingest")
+    args = parser.parse_args()
+
+    vdj_ingest = VdjIngest(args.database)
+    try:
+        print(vdj_ingest.ingest(args.database_xml, force=args.force).report())
+    finally:
+        vdj_ingest.close()
+
+if __name__ == "__main__":
+    main()
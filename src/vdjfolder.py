@@ -0,0 +1,94 @@
+import os
+import re
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+# reads and writes virtualdj xml files (.vdjfolder files and database.xml) without holding the whole document in memory
+# reading uses iterparse and clears every element once it has been handled
+# .vdjfolder files are written one song at a time instead of building an ElementTree and pretty printing it through minidom
+# the output is byte for byte what the old ElementTree + minidom.toprettyxml(indent="    ") code wrote:
+#
+#   <?xml version="1.0" encoding="UTF-8"?>
+#   <VirtualFolder noDuplicates="no">
+#       <song path="..." title="..." artist="..." idx="0"/>
+#   </VirtualFolder>
+#
+# (an empty folder is written as <VirtualFolder noDuplicates="no"/>)
+# the file is written next to its destination and moved into place when it's complete, so virtualdj never sees half a folder
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+INDENT = "    "
+
+# characters that can't appear in xml 1.0 at all, the old code crashed on them in minidom.parseString
+_INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+# the same escaping minidom uses when writing attribute values
+def escape_attribute(value: str) -> str:
+    value = _INVALID_XML_CHARS.sub("", str(value))
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+class VdjfolderWriter:
+    def __init__(self, vdjfolder_filepath: str, no_duplicates: bool = False):
+        self.vdjfolder_filepath = vdjfolder_filepath
+        self.songs_written = 0
+        self._root_tag = f'VirtualFolder noDuplicates="{"yes" if no_duplicates else "no"}"'
+
+        # create the output_dir if it doesnt already exist
+        output_dir = os.path.dirname(vdjfolder_filepath)
+        if output_dir:
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+        self._temp_filepath = f"{vdjfolder_filepath}.{os.getpid()}.tmp"
+        self._file = open(self._temp_filepath, "w", encoding="utf-8")
+        self._file.write(XML_HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    # writes a song element, any extra attributes go after idx
+    def add_song(self, path: str, title: str, artist: str, **attributes) -> None:
+        # the root element is only opened with the first song, an empty folder is a single self closing tag
+        if self.songs_written == 0:
+            self._file.write(f"<{self._root_tag}>\n")
+
+        attributes = {"path": path, "title": title, "artist": artist, "idx": str(self.songs_written), **attributes}
+        formatted = " ".join(f'{name}="{escape_attribute(value)}"' for name, value in attributes.items() if value is not None)
+        self._file.write(f"{INDENT}<song {formatted}/>\n")
+        self.songs_written += 1
+
+    # finishes the file and moves it into place
+    def close(self) -> None:
+        if self.songs_written == 0:
+            self._file.write(f"<{self._root_tag}/>\n")
+        else:
+            self._file.write("</VirtualFolder>\n")
+        self._file.close()
+        os.replace(self._temp_filepath, self.vdjfolder_filepath)
+
+    # throws away a partially written file, leaving any previous version in place
+    def abort(self) -> None:
+        self._file.close()
+        os.remove(self._temp_filepath)
+
+# yields the elements with this tag as soon as they have been parsed, and clears each one once the caller is done with it
+def iter_elements(xml_filepath: str, tag: str):
+    root = None
+    for event, element in ET.iterparse(xml_filepath, events=("start", "end")):
+        if root is None and event == "start":
+            root = element
+        elif event == "end" and element.tag == tag:
+            yield element
+            element.clear()
+            # the root still references every cleared element, drop them too
+            root.clear()
+
+# yields the attributes (path, title, artist, idx...) of every song in a .vdjfolder file
+def iter_vdjfolder_songs(vdjfolder_filepath: str):
+    for element in iter_elements(vdjfolder_filepath, "song"):
+        yield dict(element.attrib)
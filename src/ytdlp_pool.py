@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from postprocess import find_thumbnail
+
+# youtube fallback downloads for tracks sldl couldn't find on soulseek
+# jobs are queued on a bounded pool so a slow download doesn't hold up the tracks behind it, and each job has a timeout
+# when the yt_dlp package is installed downloads run in process through its python api (no new interpreter per track), otherwise the yt-dlp executable is used
+# either way the final filepath comes from yt-dlp's metadata rather than from scraping its console output
+# with postprocess=False only the raw audio and its thumbnail are downloaded, converting and tagging them is left to postprocess.py
+
+try:
+    import yt_dlp
+except ImportError:
+    yt_dlp = None
+
+# an explicit yt-dlp executable (or .py script) to run, setting it also skips the python api, e.g. to use the stub from bench/stubs
+YTDLP_PATH = os.getenv("ytdlp_path")
+
+DEFAULT_WORKERS = 3
+DEFAULT_JOB_TIMEOUT = 600
+SOCKET_TIMEOUT = 30
+
+# filepath is empty if nothing was downloaded, video_title and uploader describe what was actually downloaded, output is the log text of the download
+# transcode_seconds is how long the conversion to mp3 took, None when it couldn't be measured (the yt-dlp executable only reports the total) or wasn't done
+# thumbnail_filepath is the thumbnail written next to a raw download (postprocess=False), or None
+YtdlpDownload = namedtuple("YtdlpDownload", ["filepath", "video_title", "uploader", "output", "transcode_seconds", "thumbnail_filepath"], defaults=(None, None))
+
+class YtdlpJobTimeout(Exception):
+    pass
+
+# the options equivalent to: -x --audio-format mp3 --embed-thumbnail --add-metadata --cookies-from-browser firefox
+# or without postprocess to: -f bestaudio/best --write-thumbnail --cookies-from-browser firefox
+def _ydl_options(output_path: str, filename_template: str, postprocess: bool = True) -> dict:
+    options = {
+        "format": "bestaudio/best",
+        "paths": {"home": output_path},
+        "outtmpl": {"default": filename_template},
+        "cookiesfrombrowser": ("firefox",),
+        "writethumbnail": True,
+        "postprocessors": [
+            {"key": "FFmpegExtractAudio", "preferredcodec": "mp3"},
+            {"key": "FFmpegMetadata", "add_metadata": True},
+            {"key": "EmbedThumbnail", "already_have_thumbnail": False},
+        ],
+        "socket_timeout": SOCKET_TIMEOUT,
+        "noprogress": True,
+    }
+    if not postprocess:
+        options["postprocessors"] = []
+    return options
+
+def _use_api() -> bool:
+    return yt_dlp is not None and not YTDLP_PATH
+
+# the command that starts yt-dlp
+def _ytdlp_command() -> list:
+    if YTDLP_PATH and YTDLP_PATH.endswith(".py"):
+        return [sys.executable, YTDLP_PATH]
+    return [YTDLP_PATH or "yt-dlp"]
+
+# passes yt-dlp's messages through to the console and keeps them for the log file
+class _CollectingLogger:
+    def __init__(self):
+        self.lines = []
+        self._lock = threading.Lock()
+
+    def _emit(self, message: str) -> None:
+        print(message)
+        with self._lock:
+            self.lines.append(message + "\n")
+
+    def debug(self, message: str) -> None:
+        # yt-dlp sends regular info messages through debug() with a [debug] prefix for actual debug output
+        if not message.startswith("[debug] "):
+            self._emit(message)
+
+    def info(self, message: str) -> None:
+        self._emit(message)
+
+    def warning(self, message: str) -> None:
+        self._emit(f"WARNING: {message}")
+
+    def error(self, message: str) -> None:
+        self._emit(message)
+
+# returns the first entry of a search result (or the info itself for a single video)
+def _first_entry(info):
+    if info is None:
+        return None
+    if "entries" in info:
+        entries = [entry for entry in info["entries"] if entry]
+        return entries[0] if entries else None
+    return info
+
+# returns the metadata of the top count youtube results for query without downloading any media
+def search_candidates(query: str, count: int, timeout: float = DEFAULT_JOB_TIMEOUT) -> list:
+    search = f"ytsearch{count}:{query}"
+    if _use_api():
+        options = {"extract_flat": "in_playlist", "skip_download": True, "quiet": True, "no_warnings": True, "socket_timeout": min(SOCKET_TIMEOUT, timeout), "cookiesfrombrowser": ("firefox",)}
+        try:
+            with yt_dlp.YoutubeDL(options) as ydl:
+                info = ydl.extract_info(search, download=False)
+        except yt_dlp.utils.YoutubeDLError as e:
+            print(f"ERROR: {e}")
+            return []
+    else:
+        try:
+            result = subprocess.run([*_ytdlp_command(), search, "--flat-playlist", "-J", "--cookies-from-browser", "firefox"], capture_output=True, text=True, encoding="utf-8", errors="replace", timeout=timeout)
+            info = json.loads(result.stdout) if result.stdout.strip() else None
+        except (subprocess.TimeoutExpired, json.JSONDecodeError) as e:
+            print(f"ERROR: {e}")
+            return []
+
+    if info is None:
+        return []
+    return [entry for entry in info.get("entries") or [] if entry]
+
+# downloads and converts a single youtube search or url to mp3 in output_path (or only downloads its raw audio and thumbnail without postprocess), giving up after timeout seconds
+def download_audio(query: str, output_path: str, filename_template: str, timeout: float = DEFAULT_JOB_TIMEOUT, postprocess: bool = True) -> YtdlpDownload:
+    if _use_api():
+        download = _download_audio_api(query, output_path, filename_template, timeout, postprocess)
+    else:
+        download = _download_audio_subprocess(query, output_path, filename_template, timeout, postprocess)
+    if not postprocess and download.filepath:
+        download = download._replace(thumbnail_filepath=find_thumbnail(download.filepath))
+    return download
+
+def _download_audio_api(query: str, output_path: str, filename_template: str, timeout: float, postprocess: bool) -> YtdlpDownload:
+    deadline = time.monotonic() + timeout
+    logger = _CollectingLogger()
+
+    # yt-dlp calls these hooks throughout the download and the ffmpeg postprocessing, raising from them aborts the job
+    def check_deadline(_status):
+        if time.monotonic() > deadline:
+            raise YtdlpJobTimeout(f"yt-dlp job timed out after {timeout} seconds")
+
+    # the ExtractAudio postprocessor is the transcode, its started and finished hooks time it
+    transcode = {"started_at": None, "seconds": None}
+    def time_transcode(status):
+        check_deadline(status)
+        if status.get("postprocessor") != "ExtractAudio":
+            return
+        if status.get("status") == "started":
+            transcode["started_at"] = time.monotonic()
+        elif status.get("status") == "finished" and transcode["started_at"] is not None:
+            transcode["seconds"] = time.monotonic() - transcode["started_at"]
+
+    options = _ydl_options(output_path, filename_template, postprocess)
+    options.update({"logger": logger, "progress_hooks": [check_deadline], "postprocessor_hooks": [time_transcode]})
+
+    try:
+        with yt_dlp.YoutubeDL(options) as ydl:
+            entry = _first_entry(ydl.extract_info(query, download=True))
+    except (YtdlpJobTimeout, yt_dlp.utils.YoutubeDLError) as e:
+        logger.error(f"ERROR: {e}")
+        return YtdlpDownload("", "", "", "".join(logger.lines))
+
+    if entry is None:
+        return YtdlpDownload("", "", "", "".join(logger.lines))
+
+    # requested_downloads holds the final path after every postprocessor (e.g. the .mp3 after extracting the audio)
+    downloads = entry.get("requested_downloads") or []
+    filepath = downloads[0].get("filepath", "") if downloads else ""
+    uploader = entry.get("artist") or entry.get("uploader") or entry.get("channel") or ""
+    return YtdlpDownload(filepath or "", entry.get("title") or "", uploader, "".join(logger.lines), transcode["seconds"])
+
+def _download_audio_subprocess(query: str, output_path: str, filename_template: str, timeout: float, postprocess: bool) -> YtdlpDownload:
+    # --print after_move prints the final filepath once every postprocessor has finished, as json so we don't have to scrape the output
+    command = [
+        *_ytdlp_command(),
+        query,
+        "--cookies-from-browser", "firefox",
+        *(["-x", "--audio-format", "mp3", "--embed-thumbnail", "--add-metadata"] if postprocess else ["-f", "bestaudio/best", "--write-thumbnail"]),
+        "--socket-timeout", str(SOCKET_TIMEOUT),
+        "--paths", output_path,
+        "-o", filename_template,
+        "--print", "after_move:%(.{filepath,title,uploader,artist})j",
+    ]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding="utf-8", errors="replace")
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        stdout, stderr = process.communicate()
+        stderr += f"ERROR: yt-dlp job timed out after {timeout} seconds\n"
+
+    print(stderr, end="")
+    metadata = {}
+    for line in reversed(stdout.splitlines()):
+        if line.startswith("{"):
+            metadata = json.loads(line)
+            break
+
+    uploader = metadata.get("artist") or metadata.get("uploader") or ""
+    return YtdlpDownload(metadata.get("filepath") or "", metadata.get("title") or "", uploader, stdout + stderr)
+
+# a bounded pool of yt-dlp jobs, fn is called with the job arguments plus a timeout keyword argument
+class YtdlpPool:
+    def __init__(self, max_workers: int = DEFAULT_WORKERS, job_timeout: float = DEFAULT_JOB_TIMEOUT):
+        self.max_workers = max_workers
+        self.job_timeout = job_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ytdlp")
+
+    def submit(self, fn, *args) -> Future:
+        return self._executor.submit(fn, *args, timeout=self.job_timeout)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
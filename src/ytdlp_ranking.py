@@ -0,0 +1,127 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from text_normalize import containment, normalize_text
+
+# instead of downloading whatever the first youtube search result is, we first fetch the metadata of the top few results (no media),
+# score each one against the spotify title, artist and length, and only download the best one if it scores above MATCH_THRESHOLD
+# tracks where nothing matched are recorded in a small sqlite table so they aren't searched again on every run
+
+CANDIDATE_COUNT = 5
+MATCH_THRESHOLD = 0.6
+
+# a rejected track isn't searched again until this many seconds have passed
+REJECTION_TTL = 7 * 24 * 60 * 60
+
+# a duration off by this many seconds or more scores 0
+DURATION_TOLERANCE = 30
+
+# versions of a song that are usually not what we want, unless the spotify title asks for them
+UNWANTED_VERSION_WORDS = {"live", "cover", "remix", "karaoke", "instrumental", "nightcore", "sped", "slowed", "reverb", "8d", "acoustic"}
+UNWANTED_VERSION_PENALTY = 0.7
+
+RankedCandidate = namedtuple("RankedCandidate", ["score", "url", "video_id", "title", "uploader", "duration"])
+
+# scores how well a youtube candidate matches the spotify track, from 0 to 1
+def score_candidate(candidate: dict, title: str, artist: str, length_seconds) -> float:
+    candidate_title = candidate.get("title") or ""
+    candidate_uploader = candidate.get("uploader") or candidate.get("channel") or ""
+
+    title_score = containment(title, candidate_title)
+    artist_score = max(containment(artist, candidate_title), containment(artist, candidate_uploader))
+
+    weighted_scores = [(title_score, 0.5), (artist_score, 0.25)]
+    candidate_duration = candidate.get("duration")
+    if length_seconds and candidate_duration:
+        duration_score = max(0.0, 1 - abs(float(candidate_duration) - length_seconds) / DURATION_TOLERANCE)
+        weighted_scores.append((duration_score, 0.25))
+
+    score = sum(score * weight for score, weight in weighted_scores) / sum(weight for _, weight in weighted_scores)
+
+    # e.g. a live version or a nightcore edit when the spotify title doesn't mention one
+    spotify_words = set(normalize_text(title).split())
+    candidate_words = set(normalize_text(candidate_title).split())
+    if (candidate_words & UNWANTED_VERSION_WORDS) - spotify_words:
+        score *= UNWANTED_VERSION_PENALTY
+
+    return score
+
+# returns the candidates sorted from best to worst match
+def rank_candidates(candidates: list, title: str, artist: str, length: str) -> list:
+    length_seconds = int(length) if isinstance(length, str) and length.isdigit() else None
+
+    ranked = []
+    for candidate in candidates:
+        url = candidate.get("webpage_url") or candidate.get("url") or ""
+        if not url:
+            continue
+        ranked.append(RankedCandidate(
+            score_candidate(candidate, title, artist, length_seconds),
+            url,
+            candidate.get("id") or "",
+            candidate.get("title") or "",
+            candidate.get("uploader") or candidate.get("channel") or "",
+            candidate.get("duration"),
+        ))
+
+    ranked.sort(key=lambda candidate: candidate.score, reverse=True)
+    return ranked
+
+# returns a human readable table of the ranked candidates for the log
+def format_candidates(ranked: list) -> str:
+    lines = [f"Candidates (threshold {MATCH_THRESHOLD}):\n"]
+    for candidate in ranked:
+        lines.append(f"  {candidate.score:.2f}  {candidate.title} | {candidate.uploader} | {candidate.duration}s | {candidate.url}\n")
+    return "".join(lines)
+
+# tracks whose youtube candidates were all rejected, keyed the same way as _index.sldl (artist, album, title)
+class YtdlpRejections:
+    def __init__(self, db_filepath: str):
+        self.db_filepath = db_filepath
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_filepath, timeout=30, check_same_thread=False)
+            with self._conn:
+                self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS rejections (
+                    artist TEXT NOT NULL,
+                    album TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    rejected_at REAL NOT NULL,
+                    best_score REAL,
+                    candidate_ids TEXT,
+                    PRIMARY KEY (artist, album, title)
+                )
+                ''')
+        return self._conn
+
+    # returns true if the track was rejected recently enough that it shouldn't be searched again yet
+    def is_recently_rejected(self, artist: str, album: str, title: str) -> bool:
+        with self._lock:
+            row = self._connect().execute("SELECT rejected_at FROM rejections WHERE artist = ? AND album = ? AND title = ?", (artist, album, title)).fetchone()
+        return row is not None and time.time() - row[0] < REJECTION_TTL
+
+    def record(self, artist: str, album: str, title: str, ranked: list) -> None:
+        best_score = ranked[0].score if ranked else None
+        candidate_ids = json.dumps([candidate.video_id for candidate in ranked])
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO rejections (artist, album, title, rejected_at, best_score, candidate_ids) VALUES (?, ?, ?, ?, ?, ?)",
+                (artist, album, title, time.time(), best_score, candidate_ids),
+            )
+
+    def clear(self, artist: str, album: str, title: str) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM rejections WHERE artist = ? AND album = ? AND title = ?", (artist, album, title))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# the tests import the modules in src/ directly, like the scripts there import each other
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_DIR)
+
+# the catalog database has to be redirected before any module from src/ is imported, so the tests never touch assets/all_music.sqlite
+os.environ["music_database"] = os.path.join(tempfile.mkdtemp(prefix="vdj-spotify-link-tests-"), "all_music.sqlite")
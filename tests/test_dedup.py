@@ -0,0 +1,127 @@
+import os
+import sys
+
+import pytest
+
+import dedup
+
+# a syncsafe id3v2 size of 0x0fffffff, far more than any of these files have
+TRUNCATED_ID3_HEADER = b"ID3\x04\x00\x00\x7f\x7f\x7f\x7f"
+
+def id3_tag(payload: bytes) -> bytes:
+    size = len(payload)
+    return b"ID3\x04\x00\x00" + bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f]) + payload
+
+def ape_footer(size: int) -> bytes:
+    return b"APETAGEX" + (2000).to_bytes(4, "little") + size.to_bytes(4, "little") + (0).to_bytes(4, "little") + (0).to_bytes(4, "little") + b"\0" * 8
+
+def write(path, data: bytes) -> str:
+    with open(path, "wb") as file:
+        file.write(data)
+    return str(path)
+
+def dedup_file(path, duration):
+    return dedup.DedupFile(str(path), "root", 0, 0, duration, True)
+
+def test_payload_skips_tags(tmp_path):
+    audio = os.urandom(4096)
+    plain = write(tmp_path / "plain.mp3", audio)
+    tagged = write(tmp_path / "tagged.mp3", id3_tag(b"\0" * 300) + audio + b"TAG" + b"\0" * 125)
+
+    assert dedup.payload_size(plain) == dedup.payload_size(tagged) == len(audio)
+    assert dedup.payload_hash(plain) == dedup.payload_hash(tagged)
+
+def test_truncated_id3_tag_has_no_payload(tmp_path):
+    path = write(tmp_path / "truncated.mp3", TRUNCATED_ID3_HEADER + os.urandom(4096))
+
+    with pytest.raises(ValueError):
+        dedup.payload_size(path)
+    assert dedup._payload_size_chunk([path]) == [None]
+    assert dedup._payload_hash_chunk([path]) == [None]
+
+def test_overrunning_ape_footer_has_no_payload(tmp_path):
+    path = write(tmp_path / "bad_ape.mp3", os.urandom(4096) + ape_footer(10 ** 6))
+
+    assert dedup._payload_size_chunk([path]) == [None]
+    assert dedup._payload_hash_chunk([path]) == [None]
+
+def test_empty_file_has_no_payload(tmp_path):
+    path = write(tmp_path / "empty.mp3", b"")
+
+    assert dedup._payload_size_chunk([path]) == [None]
+
+def test_truncated_files_are_not_duplicates(tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    write(library / "a.mp3", TRUNCATED_ID3_HEADER + os.urandom(4096))
+    write(library / "b.mp3", TRUNCATED_ID3_HEADER + os.urandom(4096))
+
+    finder = dedup.DuplicateFinder(str(tmp_path / "catalog.sqlite"))
+    try:
+        assert finder.find([str(library)], workers=1) == []
+    finally:
+        finder.close()
+
+def test_neighbouring_duration_windows_share_a_group(tmp_path):
+    # 10.9 and 11.2 are in different windows, but within the tolerance of each other
+    close_a, close_b = dedup_file(tmp_path / "a", 10.9), dedup_file(tmp_path / "b", 11.2)
+    far = dedup_file(tmp_path / "c", 13.5)
+
+    groups = dedup.duration_groups([close_a, close_b, far])
+
+    assert any(close_a in group and close_b in group for group in groups)
+    assert not any(far in group and len(group) > 1 for group in groups)
+
+def test_duration_groups_stay_small_on_a_continuous_library(tmp_path):
+    # durations 0.3s apart chain into one group if each file is only compared with the previous one
+    files = [dedup_file(tmp_path / str(i), i * 0.3) for i in range(10000)]
+
+    groups = dedup.duration_groups(files)
+
+    assert max(len(group) for group in groups) <= 2 * dedup.DURATION_TOLERANCE / 0.3 + 1
+
+def make_duplicates(root):
+    audio = os.urandom(8192)
+    keep = write(root / "keep.mp3", id3_tag(b"\0" * 300) + audio)
+    duplicate = write(root / "duplicate.mp3", audio)
+    other = write(root / "other.mp3", os.urandom(8192))
+    return keep, duplicate, other
+
+def run_dedup(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["dedup.py", *args])
+    dedup.main()
+
+def test_prune_dry_run_removes_nothing(tmp_path, monkeypatch):
+    library = tmp_path / "library"
+    library.mkdir()
+    keep, duplicate, other = make_duplicates(library)
+
+    run_dedup(monkeypatch, "--database", str(tmp_path / "catalog.sqlite"), "--workers", "1", "prune", str(library), "--dry-run")
+
+    assert all(os.path.exists(path) for path in (keep, duplicate, other))
+
+def test_prune_removes_only_the_duplicate(tmp_path, monkeypatch):
+    library = tmp_path / "library"
+    library.mkdir()
+    keep, duplicate, other = make_duplicates(library)
+
+    run_dedup(monkeypatch, "--database", str(tmp_path / "catalog.sqlite"), "--workers", "1", "prune", str(library))
+
+    # the bigger file (more complete tags) is the one that's kept
+    assert os.path.exists(keep)
+    assert not os.path.exists(duplicate)
+    assert os.path.exists(other)
+
+def test_prune_moves_duplicates_and_repoints_the_index(tmp_path, monkeypatch):
+    from sldl_index import SldlIndex
+
+    library = tmp_path / "library"
+    (library / "sldl_helper").mkdir(parents=True)
+    keep, duplicate, _ = make_duplicates(library)
+    index = SldlIndex(str(library / "sldl_helper" / "_index.sldl"))
+    index.upsert(duplicate, "Artist", "Album", "Title", "200")
+
+    run_dedup(monkeypatch, "--database", str(tmp_path / "catalog.sqlite"), "--workers", "1", "prune", str(library), "--move-to", str(tmp_path / "moved"))
+
+    assert os.path.exists(tmp_path / "moved" / "duplicate.mp3")
+    assert SldlIndex(index.index_filepath).get("Artist", "Album", "Title").startswith(f'"{keep}"')
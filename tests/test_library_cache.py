@@ -0,0 +1,71 @@
+import os
+
+import library_scanner
+from library_cache import LibraryCache
+
+def make_library(root, count: int) -> list:
+    os.makedirs(root, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(root, f"{i}.mp3")
+        with open(path, "wb") as file:
+            file.write(b"\0" * 128)
+        paths.append(path)
+    return paths
+
+def cached_paths(cache: LibraryCache) -> set:
+    return {row[0] for row in cache.conn.execute("SELECT path FROM library_files")}
+
+def test_rescan_drops_deleted_files(tmp_path):
+    root = str(tmp_path / "library")
+    paths = make_library(root, 3)
+    cache = LibraryCache(str(tmp_path / "catalog.sqlite"))
+    try:
+        cache.scan(root, workers=1)
+        os.remove(paths[0])
+        cache.scan(root, workers=1)
+        assert cached_paths(cache) == set(paths[1:])
+    finally:
+        cache.close()
+
+def test_unreadable_root_keeps_its_cached_files(tmp_path):
+    root = str(tmp_path / "library")
+    paths = make_library(root, 3)
+    cache = LibraryCache(str(tmp_path / "catalog.sqlite"))
+    try:
+        cache.scan(root, workers=1)
+        # e.g. a drive that isn't mounted right now
+        os.rename(root, root + "-away")
+        cache.scan(root, workers=1)
+        assert cached_paths(cache) == set(paths)
+    finally:
+        cache.close()
+
+def test_scan_returns_an_iterator(tmp_path):
+    root = str(tmp_path / "library")
+    make_library(root, 2)
+    cache = LibraryCache(str(tmp_path / "catalog.sqlite"))
+    try:
+        tracks = cache.scan(root, workers=1)
+        assert iter(tracks) is tracks
+        # the files have no tags, so no track has a title and artist
+        assert list(tracks) == []
+    finally:
+        cache.close()
+
+def _lengths(paths: list) -> list:
+    return [len(path) for path in paths]
+
+def test_map_chunks_reads_a_generator_lazily():
+    consumed = []
+    def items():
+        for i in range(1000):
+            consumed.append(i)
+            yield (f"item {i}",)
+
+    results = library_scanner.map_chunks(_lengths, items(), workers=2, chunk_size=10, min_parallel=20)
+    first = next(results)
+    # only the items needed to decide on the pool and fill the chunks in flight have been read
+    assert len(consumed) < 100
+    assert len(list(results)) + 1 == 1000
+    assert first[1] == len(first[0][0])
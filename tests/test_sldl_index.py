@@ -0,0 +1,112 @@
+import multiprocessing
+
+from sldl_index import INDEX_HEADER, SldlIndex, format_index_entry
+
+def snapshot_lines(index: SldlIndex) -> list:
+    with open(index.index_filepath, "r", encoding="utf-8") as index_file:
+        return index_file.read().splitlines()
+
+def test_upsert_then_get(tmp_path):
+    index = SldlIndex(str(tmp_path / "_index.sldl"))
+
+    entry = index.upsert("/music/a.mp3", "Artist", "Album", "Title", "200")
+
+    assert entry == format_index_entry("/music/a.mp3", "Artist", "Album", "Title", "200")
+    assert index.get("Artist", "Album", "Title") == entry
+    assert index.get("Artist", "Album", "Other") is None
+    # another instance (e.g. another helper process) sees it through the journal
+    assert SldlIndex(index.index_filepath).get("Artist", "Album", "Title") == entry
+
+def test_failed_entry_never_replaces_a_download(tmp_path):
+    index = SldlIndex(str(tmp_path / "_index.sldl"))
+    downloaded = index.upsert("/music/a.mp3", "Artist", "Album", "Title", "200")
+
+    index.upsert("", "Artist", "Album", "Title", "200")
+
+    assert index.get("Artist", "Album", "Title") == downloaded
+    assert index.has_download("Artist", "Album", "Title")
+
+def test_download_replaces_a_failed_entry(tmp_path):
+    index = SldlIndex(str(tmp_path / "_index.sldl"))
+    index.upsert("", "Artist", "Album", "Title", "200")
+    assert not index.has_download("Artist", "Album", "Title")
+
+    downloaded = index.upsert("/music/a.mp3", "Artist", "Album", "Title", "200")
+
+    assert index.get("Artist", "Album", "Title") == downloaded
+
+def test_last_download_wins(tmp_path):
+    index = SldlIndex(str(tmp_path / "_index.sldl"))
+    index.upsert("/music/a.mp3", "Artist", "Album", "Title", "200")
+
+    newer = index.upsert("/music/b.mp3", "Artist", "Album", "Title", "200")
+    index.compact()
+
+    assert index.get("Artist", "Album", "Title") == newer
+    assert snapshot_lines(index) == [INDEX_HEADER.strip(), newer]
+
+def test_compact_keeps_the_order_of_the_snapshot(tmp_path):
+    index = SldlIndex(str(tmp_path / "_index.sldl"))
+    for title in ("One", "Two", "Three"):
+        index.upsert(f"/music/{title}.mp3", "Artist", "Album", title, "200")
+    index.compact()
+
+    # updating the middle entry keeps it in its place, new entries go at the end
+    updated = index.upsert("/music/two-again.mp3", "Artist", "Album", "Two", "200")
+    added = index.upsert("/music/four.mp3", "Artist", "Album", "Four", "200")
+    index.compact()
+
+    lines = snapshot_lines(index)
+    assert lines[0] == INDEX_HEADER.strip()
+    assert [line.split(",")[3] for line in lines[1:]] == ['"One"', '"Two"', '"Three"', '"Four"']
+    assert lines[2] == updated and lines[4] == added
+    assert open(index.journal_filepath, encoding="utf-8").read() == ""
+
+def test_journal_is_compacted_past_the_threshold(tmp_path):
+    index = SldlIndex(str(tmp_path / "_index.sldl"), compact_threshold_bytes=200)
+
+    for i in range(20):
+        index.upsert(f"/music/{i}.mp3", "Artist", "Album", f"Title {i}", "200")
+
+    assert len(snapshot_lines(index)) > 1
+    assert SldlIndex(index.index_filepath).get("Artist", "Album", "Title 19") is not None
+
+def test_torn_last_journal_line_is_skipped_and_terminated(tmp_path):
+    index = SldlIndex(str(tmp_path / "_index.sldl"))
+    entry = index.upsert("/music/a.mp3", "Artist", "Album", "Title", "200")
+    # a writer that crashed in the middle of its line
+    with open(index.journal_filepath, "a", encoding="utf-8") as journal_file:
+        journal_file.write('"/music/torn.mp3","Artist","Album","Tor')
+
+    reader = SldlIndex(index.index_filepath)
+    assert reader.get("Artist", "Album", "Title") == entry
+    assert reader.get("Artist", "Album", "Torn") is None
+
+    # the next upsert starts on a new line, so the torn line can't swallow it
+    after = index.upsert("/music/b.mp3", "Artist", "Album", "After", "200")
+    assert SldlIndex(index.index_filepath).get("Artist", "Album", "After") == after
+    index.compact()
+    assert len(snapshot_lines(index)) == 3
+
+def _write_entries(index_filepath: str, writer: int, count: int) -> None:
+    index = SldlIndex(index_filepath, compact_threshold_bytes=2048)
+    for i in range(count):
+        index.upsert(f"/music/{writer}-{i}.mp3", f"Artist {writer}", "Album", f"Title {i}", "200")
+
+def test_concurrent_writers_lose_nothing(tmp_path):
+    index_filepath = str(tmp_path / "_index.sldl")
+    writers, count = 4, 50
+
+    # separate processes, like the helper processes sldl starts for concurrent downloads, compacting while the others append
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+    processes = [context.Process(target=_write_entries, args=(index_filepath, writer, count)) for writer in range(writers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    index = SldlIndex(index_filepath)
+    index.compact()
+    assert len(snapshot_lines(index)) == 1 + writers * count
+    assert all(index.has_download(f"Artist {writer}", "Album", f"Title {i}") for writer in range(writers) for i in range(count))
@@ -0,0 +1,28 @@
+import time
+
+from spotify_cache import SpotifyCache
+
+def playlist(playlist_id: str, name: str) -> dict:
+    return {"id": playlist_id, "name": name, "snapshot_id": f"snapshot-{playlist_id}"}
+
+def test_get_playlist_id(tmp_path):
+    cache = SpotifyCache(str(tmp_path / "catalog.sqlite"))
+    try:
+        cache.store_playlists([playlist("a", "Mix"), playlist("b", "Mix"), playlist("c", "Other")])
+        # the first playlist with the name wins, like the listing spotify returns
+        assert cache.get_playlist_id("Mix") == "a"
+        assert cache.get_playlist_id("Missing") is None
+    finally:
+        cache.close()
+
+def test_expired_listing_doesnt_resolve_names(tmp_path):
+    cache = SpotifyCache(str(tmp_path / "catalog.sqlite"), listing_ttl=60)
+    try:
+        cache.store_playlists([playlist("a", "Mix")])
+        with cache.conn:
+            cache.conn.execute("UPDATE spotify_cache_state SET value = ? WHERE key = 'playlists_fetched_at'", (time.time() - 120,))
+
+        assert cache.get_playlists() is None
+        assert cache.get_playlist_id("Mix") is None
+    finally:
+        cache.close()
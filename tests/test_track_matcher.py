@@ -0,0 +1,57 @@
+from collections import namedtuple
+
+from track_matcher import TrackMatcher, normalize_title, split_artists
+
+LibraryTrack = namedtuple("LibraryTrack", ["path", "title", "artist", "duration"])
+
+def test_normalize_title_drops_features_and_versions():
+    assert normalize_title("Song (feat. Someone) - 2011 Remaster") == normalize_title("Song")
+    assert normalize_title("Song [Radio Edit]") == normalize_title("song")
+
+def test_split_artists():
+    assert split_artists("Artist One & Artist Two feat. Artist Three") == split_artists(["artist one", "artist two", "artist three"])
+
+def test_exact_match():
+    matcher = TrackMatcher([LibraryTrack("home.mp3", "Home", "Alpha", 200), LibraryTrack("other.mp3", "Other", "Alpha", 180)])
+
+    match = matcher.match("Home", ["Alpha"], 200)
+
+    assert match.track.path == "home.mp3"
+    assert match.score == 1.0
+
+def test_same_title_by_another_artist_is_rejected():
+    matcher = TrackMatcher([LibraryTrack("home.mp3", "Home", "Alpha", 200)])
+
+    assert matcher.match("Home", ["Beta"], 200) is None
+
+def test_same_title_prefers_the_right_artist():
+    matcher = TrackMatcher([LibraryTrack("alpha.mp3", "Home", "Alpha", 200), LibraryTrack("beta.mp3", "Home", "Beta", 200)])
+
+    assert matcher.match("Home", ["Beta"], 200).track.path == "beta.mp3"
+
+def test_missing_artist_tag_still_matches_on_title():
+    matcher = TrackMatcher([LibraryTrack("home.mp3", "Home", "", 200)])
+
+    assert matcher.match("Home", ["Beta"], 200).track.path == "home.mp3"
+
+def test_title_that_only_shares_a_prefix_is_rejected():
+    matcher = TrackMatcher([LibraryTrack("hold-on-tight.mp3", "Hold On Tight", "Alpha", 200)])
+
+    assert matcher.match("Hold On", ["Alpha"], 200) is None
+
+def test_near_identical_title_picks_the_closest():
+    matcher = TrackMatcher([LibraryTrack("hold-on.mp3", "Hold On", "Alpha", 200), LibraryTrack("hold-on-tight.mp3", "Hold On Tight", "Alpha", 200)])
+
+    assert matcher.match("Hold On", ["Alpha"], 200).track.path == "hold-on.mp3"
+    assert matcher.match("Hold On Tight", ["Alpha"], 200).track.path == "hold-on-tight.mp3"
+
+def test_title_variants_still_match():
+    matcher = TrackMatcher([LibraryTrack("less.mp3", "The Less I Know The Better", "Tame Impala", 216)])
+
+    assert matcher.match("The Less I Know The Better - Remastered", ["Tame Impala"], 216).track.path == "less.mp3"
+    assert matcher.match("Less I Know The Better", ["Tame Impala"], 216).track.path == "less.mp3"
+
+def test_closest_duration_wins():
+    matcher = TrackMatcher([LibraryTrack("long.mp3", "Home", "Alpha", 260), LibraryTrack("short.mp3", "Home", "Alpha", 201)])
+
+    assert matcher.match("Home", ["Alpha"], 200).track.path == "short.mp3"